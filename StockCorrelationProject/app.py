@@ -1,33 +1,101 @@
-import matplotlib.pyplot as plt
+from typing import TYPE_CHECKING
+
 import streamlit as st
 
-from src.main.correlation_engine import CorrelationEngine
+from src.config.settings import CHART_MAX_POINTS, ROLLING_WINDOW_SIZE, CORRELATION_ESTIMATOR, CORRELATION_HALF_LIFE
+from src.main.instrumentation import instrumented_collect
 from src.main.returns_engine import ReturnEngine
 
+if TYPE_CHECKING:
+    from src.main.correlation_engine import CorrelationEngine
+    from src.main.result_cache import CorrelationCache
+    from src.main.returns_matrix import ReturnsMatrix
+
+# The correlation estimators the app offers, with the title of their chart
+ESTIMATORS = {
+    "rolling": f"Rolling {ROLLING_WINDOW_SIZE}-Day Correlation",
+    "ewma": f"Exponentially Weighted Correlation, {CORRELATION_HALF_LIFE}-Day Half-Life",
+    "shrinkage": f"Shrunk Exponentially Weighted Correlation, {CORRELATION_HALF_LIFE}-Day Half-Life",
+}
+
 
-def main(correlation_engine: CorrelationEngine, ticker_list: list[str]):
+def main(returns_engine: ReturnEngine):
     st.title("Stock Correlation Calculator")
-    calculate = st.button("Calculate")
-    selected_tickers = set(st.multiselect("Select Stocks", ticker_list))
+    # The tickers and the date bounds come from the store index, the returns are not opened to render the form
+    index = returns_engine.index()
+    first_date, last_date = index["start_date"], index["end_date"]
+    # A form only reruns the script on submit, not on every change of the selection
+    with st.form("selection"):
+        selected_tickers = set(st.multiselect("Select Stocks", index["tickers"]))
+        start_date, end_date = st.slider("Date range", min_value=first_date, max_value=last_date,
+                                         value=(first_date, last_date))
+        estimator = st.selectbox("Estimator", list(ESTIMATORS), index=list(ESTIMATORS).index(CORRELATION_ESTIMATOR),
+                                 format_func=ESTIMATORS.get)
+        calculate = st.form_submit_button("Calculate")
 
     if calculate and selected_tickers:
-        correlations = correlation_engine.get_correlations(set(selected_tickers)).collect()
-        # Plot the rolling correlation
-        plt.figure(figsize=(15, 6))  # Increased figure size
-        for name, group in correlations.group_by("Name"):
-            plt.plot(group["Date"], group["Correlation"], label=name)
-
-        plt.title("Rolling 20-Day Correlation of Selected Tickers", fontsize=20)
-        plt.xlabel("Date", fontsize=20)
-        plt.ylabel("Correlation", fontsize=20)
-        plt.legend(fontsize=10)
-        plt.grid()
-        st.pyplot(plt)
+        # Series are downsampled to the chart width inside the engine, and kept for later reruns. The full
+        # range is requested without bounds, so missing pairs are computed once and stored
+        st.session_state["correlations"] = instrumented_collect(load_correlation_engine(estimator).get_correlations(
+            selected_tickers, max_points=CHART_MAX_POINTS,
+            start_date=None if start_date == first_date else start_date,
+            end_date=None if end_date == last_date else end_date), "app.correlations", tickers=len(selected_tickers),
+            estimator=estimator)
+        st.session_state["estimator"] = estimator
+    correlations = st.session_state.get("correlations")
+    if correlations is not None:
+        st.subheader(f"{ESTIMATORS[st.session_state['estimator']]} of Selected Tickers")
+        st.line_chart(correlations, x="Date", y="Correlation", color="Name", height=500)
+
+        stats = load_result_cache().stats()
+        st.sidebar.caption(f"Result cache: {stats['hits']} hits, {stats['misses']} misses, "
+                           f"{stats['evictions']} evictions, {stats['bytes'] / 1e6:.1f} MB")
+
+@st.cache_resource
+def load_returns_engine() -> ReturnEngine:
+    """
+    Builds the returns engine once per server process. It is constructed instantly: the returns store is
+    only opened, and built if needed, when the correlation engine is loaded.
+    :return: The shared returns engine.
+    """
+    return ReturnEngine()
+
+@st.cache_resource
+def load_returns_matrix() -> "ReturnsMatrix":
+    """
+    Maps the returns matrix once per server process, on the first calculation, for the correlation
+    engines of every estimator.
+    :return: The shared returns matrix.
+    """
+    return load_returns_engine().matrix()
+
+@st.cache_resource
+def load_result_cache() -> "CorrelationCache":
+    """
+    Builds the result cache once per server process. The engines of every estimator share it, their
+    results are cached under keys of their own.
+    :return: The shared result cache.
+    """
+    from src.main.result_cache import CorrelationCache
+
+    return CorrelationCache()
+
+@st.cache_resource
+def load_correlation_engine(estimator: str = CORRELATION_ESTIMATOR) -> "CorrelationEngine":
+    """
+    Builds the correlation engine of an estimator once per server process, on its first calculation.
+    Every session shares it, together with the result cache and the memory-mapped returns matrix, so
+    switching back and forth between estimators serves their cached results. The correlation modules
+    are imported here, so they do not slow down the first render.
+    :param estimator: The estimator of the correlations, see CORRELATION_ESTIMATOR.
+    :return: The shared correlation engine.
+    """
+    from src.main.correlation_engine import CorrelationEngine
+
+    matrix = load_returns_matrix()
+    return CorrelationEngine(returns=load_returns_engine().returns, matrix=matrix, result_cache=load_result_cache(),
+                             data_version=matrix.fingerprint, estimator=estimator,
+                             window_size=ROLLING_WINDOW_SIZE if estimator == "rolling" else CORRELATION_HALF_LIFE)
 
 if __name__ == "__main__":
-    if "correlation_engine" not in st.session_state:
-        returns_engine = st.session_state.get("returns_engine", ReturnEngine())
-        st.session_state["correlation_engine"] = CorrelationEngine(returns=returns_engine.returns)
-    correlation_engine = st.session_state["correlation_engine"]
-    ticker_list = correlation_engine.returns.columns[1:]  # Exclude "Dat
-    main(correlation_engine, ticker_list)
\ No newline at end of file
+    main(load_returns_engine())
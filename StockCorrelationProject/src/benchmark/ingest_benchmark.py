@@ -0,0 +1,45 @@
+import argparse
+import json
+import tempfile
+from pathlib import Path
+
+from src.benchmark.synthetic_data import write_synthetic_zip
+from src.main.data_loader import ingest_zip
+
+
+def run(n_tickers: int, n_days: int, workers: int, executor: str, zip_file_path: str = None) -> dict:
+    """
+    Measures the throughput of the parallel zip ingestion, on the given archive or a synthetic one.
+    :param n_tickers: The number of tickers in the synthetic archive.
+    :param n_days: The number of trading days per ticker in the synthetic archive.
+    :param workers: The number of ingestion workers.
+    :param executor: "thread" or "process".
+    :param zip_file_path: An existing archive to ingest instead of a synthetic one.
+    :return: A dictionary with the ingestion throughput.
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        if zip_file_path is None:
+            zip_file_path = str(write_synthetic_zip(Path(temp_dir) / "stock_data.zip", n_tickers, n_days))
+        _, stats = ingest_zip(zip_file_path, staging_dir=Path(temp_dir) / "staging", workers=workers,
+                              executor=executor)
+
+    return {
+        "workers": workers,
+        "executor": executor,
+        "files": stats.files,
+        "rows": stats.rows,
+        "seconds": stats.seconds,
+        "rows_per_second": stats.rows_per_second,
+        "mb_per_second": stats.mb_per_second,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the parallel zip ingestion.")
+    parser.add_argument("--zip", dest="zip_file_path", default=None, help="Archive to ingest instead of a synthetic one.")
+    parser.add_argument("--tickers", type=int, default=2000)
+    parser.add_argument("--days", type=int, default=2500)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--executor", choices=["thread", "process"], default="thread")
+    args = parser.parse_args()
+    print(json.dumps(run(args.tickers, args.days, args.workers, args.executor, args.zip_file_path), indent=2))
@@ -0,0 +1,154 @@
+import argparse
+import json
+import multiprocessing
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Optional
+
+from src.benchmark.synthetic_data import write_synthetic_zip
+
+
+def peak_rss_mb() -> float:
+    """
+    Returns the peak resident set size of the current process.
+    :return: The peak RSS in MB.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / 1e6 if sys.platform == "darwin" else peak / 1e3
+
+
+def time_load_from_zip(zip_file_path: str, work_dir: str, n_correlation_tickers: int) -> dict:
+    """
+    Times load_from_zip: cold on the first read of the archive, warm once it is in the page cache.
+    :param zip_file_path: The path to the synthetic archive.
+    :param work_dir: The directory holding the caches of the run.
+    :param n_correlation_tickers: The number of tickers whose pairwise correlations are computed.
+    :return: The cold and warm timings in seconds.
+    """
+    from src.main.data_loader import load_from_zip
+
+    timings = {}
+    for run in ("cold", "warm"):
+        start = time.perf_counter()
+        load_from_zip(zip_file_path).collect()
+        timings[f"{run}_seconds"] = time.perf_counter() - start
+    return timings
+
+
+def time_get_returns(zip_file_path: str, work_dir: str, n_correlation_tickers: int) -> dict:
+    """
+    Times ReturnEngine.get_returns: cold builds the returns store, warm reuses it.
+    :param zip_file_path: The path to the synthetic archive.
+    :param work_dir: The directory holding the caches of the run.
+    :param n_correlation_tickers: The number of tickers whose pairwise correlations are computed.
+    :return: The cold and warm timings in seconds.
+    """
+    from src.main.returns_engine import ReturnEngine
+
+    cache_dir = Path(work_dir) / "returns"
+    timings = {}
+    for run in ("cold", "warm"):
+        start = time.perf_counter()
+        ReturnEngine(zip_file_path, cache_dir=cache_dir).returns.collect()
+        timings[f"{run}_seconds"] = time.perf_counter() - start
+    return timings
+
+
+def time_get_correlations(zip_file_path: str, work_dir: str, n_correlation_tickers: int) -> dict:
+    """
+    Times CorrelationEngine.get_correlations over all pairs of the first tickers: cold computes them and
+    fills the correlation store, warm reads them back. Runs after time_get_returns, whose store it reuses.
+    :param zip_file_path: The path to the synthetic archive.
+    :param work_dir: The directory holding the caches of the run.
+    :param n_correlation_tickers: The number of tickers whose pairwise correlations are computed.
+    :return: The cold and warm timings in seconds.
+    """
+    from src.main.correlation_engine import CorrelationEngine
+    from src.main.returns_engine import ReturnEngine
+
+    returns_engine = ReturnEngine(zip_file_path, cache_dir=Path(work_dir) / "returns")
+    tickers = set(returns_engine.ticker_list[:n_correlation_tickers])
+    timings = {"pairs": len(tickers) * (len(tickers) - 1) // 2}
+    for run in ("cold", "warm"):
+        engine = CorrelationEngine(returns=returns_engine.returns, cache_dir=Path(work_dir) / "correlation")
+        start = time.perf_counter()
+        engine.get_correlations(tickers).collect()
+        timings[f"{run}_seconds"] = time.perf_counter() - start
+    return timings
+
+
+def measure(stage, zip_file_path: str, work_dir: str, n_correlation_tickers: int) -> dict:
+    """
+    Runs one stage and records the peak RSS of the process it ran in.
+    :param stage: The stage function to run.
+    :param zip_file_path: The path to the synthetic archive.
+    :param work_dir: The directory holding the caches of the run.
+    :param n_correlation_tickers: The number of tickers whose pairwise correlations are computed.
+    :return: The timings of the stage and its peak RSS in MB.
+    """
+    result = stage(zip_file_path, work_dir, n_correlation_tickers)
+    result["peak_rss_mb"] = peak_rss_mb()
+    return result
+
+
+def git_commit() -> Optional[str]:
+    """
+    Returns the commit the benchmark runs on, so results can be compared between commits.
+    :return: The commit hash, or None outside a git checkout.
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=Path(__file__).parent).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(n_tickers: int, n_days: int, n_correlation_tickers: int) -> dict:
+    """
+    Benchmarks the ingestion -> returns -> correlation pipeline on a synthetic archive with mixed date
+    formats. Every stage runs in a freshly spawned process, so its peak RSS is its own, and is timed
+    cold and warm.
+    :param n_tickers: The number of tickers in the synthetic archive.
+    :param n_days: The number of trading days per ticker.
+    :param n_correlation_tickers: The number of tickers whose pairwise correlations are computed.
+    :return: A dictionary with the timings and peak RSS of every stage.
+    """
+    stages = {
+        "load_from_zip": time_load_from_zip,
+        "get_returns": time_get_returns,
+        "get_correlations": time_get_correlations,
+    }
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        zip_file_path = str(write_synthetic_zip(Path(work_dir) / "stock_data.zip", n_tickers, n_days))
+        for name, stage in stages.items():
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+                results[name] = pool.submit(measure, stage, zip_file_path, work_dir, n_correlation_tickers).result()
+
+    return {
+        "commit": git_commit(),
+        "machine": {"platform": platform.platform(), "processor": platform.processor(),
+                    "python": platform.python_version()},
+        "parameters": {"tickers": n_tickers, "days": n_days, "correlation_tickers": n_correlation_tickers},
+        "stages": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the ingestion -> returns -> correlation pipeline.")
+    parser.add_argument("--tickers", type=int, default=500)
+    parser.add_argument("--days", type=int, default=2500)
+    parser.add_argument("--correlation-tickers", type=int, default=100)
+    parser.add_argument("--output", type=Path, default=None, help="File to write the JSON results to.")
+    args = parser.parse_args()
+    report = json.dumps(run(args.tickers, args.days, args.correlation_tickers), indent=2)
+    if args.output is not None:
+        args.output.write_text(report)
+    print(report)
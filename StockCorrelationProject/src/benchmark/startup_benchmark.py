@@ -0,0 +1,78 @@
+import argparse
+import importlib
+import json
+import multiprocessing
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+# The modules app.py imports before its first render
+APP_IMPORTS = ["streamlit", "src.config.settings", "src.main.returns_engine"]
+
+
+def time_app_startup(zip_file_path: str, cache_dir: Path, startup_mode: str) -> dict:
+    """
+    Measures the startup of the app in a fresh process: the time to import the modules of app.py, and the
+    time until the first render has what it shows, the ticker list and the date bounds of the store.
+    Streamlit itself is skipped when it is not installed.
+    :param zip_file_path: The path to the synthetic archive.
+    :param cache_dir: The returns cache directory.
+    :param startup_mode: The startup mode of the returns engine, "lazy" or "eager".
+    :return: The import and first render timings in seconds.
+    """
+    start = time.perf_counter()
+    for module in APP_IMPORTS:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            pass
+    imported = time.perf_counter()
+
+    from src.main.returns_engine import ReturnEngine
+    ReturnEngine(zip_file_path, cache_dir=cache_dir, startup_mode=startup_mode).index()
+    rendered = time.perf_counter()
+    return {"import_seconds": imported - start, "first_render_seconds": rendered - imported,
+            "total_seconds": rendered - start}
+
+
+def run(n_tickers: int, n_days: int) -> dict:
+    """
+    Measures the ReturnEngine startup time against a synthetic archive: a cold start that ingests the
+    zip and builds the returns store, and a warm start that reuses the store. Then measures the startup
+    of the app on the warm store in a freshly spawned process per startup mode.
+    :param n_tickers: The number of tickers in the synthetic archive.
+    :param n_days: The number of trading days per ticker.
+    :return: A dictionary with the cold and warm startup times and the app startup times in seconds.
+    """
+    # Imported here, so the spawned app startup processes import them as part of their measurement
+    from src.benchmark.synthetic_data import write_synthetic_zip
+    from src.main.returns_engine import ReturnEngine
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        zip_file_path = write_synthetic_zip(Path(temp_dir) / "stock_data.zip", n_tickers, n_days)
+        cache_dir = Path(temp_dir) / "returns"
+
+        start = time.perf_counter()
+        ReturnEngine(str(zip_file_path), cache_dir=cache_dir).returns.collect()
+        cold = time.perf_counter() - start
+
+        start = time.perf_counter()
+        ReturnEngine(str(zip_file_path), cache_dir=cache_dir).returns.collect()
+        warm = time.perf_counter() - start
+
+        app = {}
+        for startup_mode in ("lazy", "eager"):
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+                app[startup_mode] = pool.submit(time_app_startup, str(zip_file_path), cache_dir, startup_mode).result()
+
+    return {"tickers": n_tickers, "days": n_days, "cold_start_seconds": cold, "warm_start_seconds": warm,
+            "app_startup": app}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark cold vs. warm ReturnEngine startup and app startup.")
+    parser.add_argument("--tickers", type=int, default=500)
+    parser.add_argument("--days", type=int, default=2500)
+    args = parser.parse_args()
+    print(json.dumps(run(args.tickers, args.days), indent=2))
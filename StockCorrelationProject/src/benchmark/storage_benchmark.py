@@ -0,0 +1,86 @@
+import argparse
+import json
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+
+from src.benchmark.synthetic_data import write_synthetic_zip
+from src.main.correlation_engine import CorrelationEngine
+from src.main.correlation_kernel import pair_indices
+from src.main.correlation_store import CorrelationStore
+from src.main.returns_engine import ReturnEngine
+
+
+def directory_bytes(path: Path) -> int:
+    """
+    Returns the size of the parquet files in a directory.
+    :param path: The directory.
+    :return: The size in bytes.
+    """
+    return sum(file.stat().st_size for file in path.glob("*.parquet") if file.name != "index.parquet")
+
+
+def run(n_tickers: int, n_days: int, n_correlation_tickers: int) -> dict:
+    """
+    Compares the standard (float64) and compact (float32, shared date axis) storage modes on a synthetic
+    archive: the disk size of the returns store and of the correlation store, the RAM of the returns
+    matrix, and the error of the compact correlations against the float64 ones. The compact correlations
+    are computed from float32 returns, as a compact deployment would.
+    :param n_tickers: The number of tickers in the synthetic archive.
+    :param n_days: The number of trading days per ticker.
+    :param n_correlation_tickers: The number of tickers whose pairwise correlations are stored.
+    :return: A dictionary with the sizes of both modes, their ratios and the numerical error.
+    """
+    with tempfile.TemporaryDirectory() as work_dir:
+        work_dir = Path(work_dir)
+        zip_file_path = str(write_synthetic_zip(work_dir / "stock_data.zip", n_tickers, n_days))
+        returns = ReturnEngine(zip_file_path, cache_dir=work_dir / "returns").returns.collect()
+        compact_returns = returns.with_columns(pl.exclude("Date").cast(pl.Float32))
+        returns.write_parquet(work_dir / "returns64.parquet")
+        compact_returns.write_parquet(work_dir / "returns32.parquet")
+
+        tickers = sorted(returns.columns[1:])[:n_correlation_tickers]
+        pairs = [(tickers[i], tickers[j]) for i, j in zip(*pair_indices(len(tickers)))]
+        standard = CorrelationEngine(returns=returns.lazy(), cache_dir=work_dir).calculate_correlations(pairs)
+        compact = CorrelationEngine(returns=compact_returns.lazy(), cache_dir=work_dir).calculate_correlations(pairs)
+        standard_store = CorrelationStore(work_dir / "standard", storage_mode="standard")
+        compact_store = CorrelationStore(work_dir / "compact", storage_mode="compact")
+        standard_store.write(standard)
+        compact_store.write(compact)
+        read_back = compact_store.read(standard_store.names()).collect()
+
+        error = standard.join(read_back, on=["Date", "Name"], suffix="Compact").select(
+            (pl.col("Correlation") - pl.col("CorrelationCompact")).abs()
+        ).to_series()
+        sizes = {
+            "returns_disk_bytes": (work_dir / "returns64.parquet").stat().st_size,
+            "returns_matrix_ram_bytes": returns.height * (returns.width - 1) * np.dtype("float64").itemsize,
+            "correlation_disk_bytes": directory_bytes(standard_store.store_dir),
+        }
+        compact_sizes = {
+            "returns_disk_bytes": (work_dir / "returns32.parquet").stat().st_size,
+            "returns_matrix_ram_bytes": returns.height * (returns.width - 1) * np.dtype("float32").itemsize,
+            "correlation_disk_bytes": directory_bytes(compact_store.store_dir),
+        }
+
+    return {
+        "tickers": n_tickers,
+        "days": n_days,
+        "pairs": len(pairs),
+        "standard": sizes,
+        "compact": compact_sizes,
+        "compact_ratio": {key: compact_sizes[key] / sizes[key] for key in sizes},
+        "correlation_max_abs_error": error.max(),
+        "correlation_mean_abs_error": error.mean(),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the standard and compact storage modes.")
+    parser.add_argument("--tickers", type=int, default=200)
+    parser.add_argument("--days", type=int, default=2500)
+    parser.add_argument("--correlation-tickers", type=int, default=50)
+    args = parser.parse_args()
+    print(json.dumps(run(args.tickers, args.days, args.correlation_tickers), indent=2))
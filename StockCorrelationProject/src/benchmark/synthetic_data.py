@@ -0,0 +1,40 @@
+import datetime
+from pathlib import Path
+from zipfile import ZipFile, ZIP_DEFLATED
+
+import numpy as np
+import polars as pl
+
+from src.config.settings import DATE_FORMATS
+
+
+def write_synthetic_zip(zip_file_path: Path, n_tickers: int, n_days: int, date_formats: list[str] = None,
+                        seed: int = 0) -> Path:
+    """
+    Writes a zip archive of synthetic price CSV files in the layout load_from_zip expects: one
+    Ticker,Date,Price file per ticker. Prices follow a random walk over consecutive weekdays, seeded per
+    ticker so an archive with fewer days holds a prefix of the same histories.
+    :param zip_file_path: The path of the zip file to write.
+    :param n_tickers: The number of tickers (CSV members) to generate.
+    :param n_days: The number of trading days per ticker.
+    :param date_formats: The date formats to cycle through, one per file. Defaults to all formats parse_date accepts.
+    :param seed: The random seed.
+    :return: The path of the written zip file.
+    """
+    date_formats = date_formats or DATE_FORMATS
+    dates = pl.date_range(datetime.date(2000, 1, 3), datetime.date(2000, 1, 3) + datetime.timedelta(days=n_days * 2),
+                          eager=True)
+    dates = dates.filter(dates.dt.weekday() <= 5).head(n_days)
+
+    zip_file_path.parent.mkdir(parents=True, exist_ok=True)
+    with ZipFile(zip_file_path, "w", compression=ZIP_DEFLATED) as zip_file:
+        for i in range(n_tickers):
+            ticker = f"T{i:05d}"
+            prices = 100 * np.exp(np.cumsum(np.random.default_rng([seed, i]).normal(0, 0.01, n_days)))
+            frame = pl.DataFrame({
+                "Ticker": [ticker] * n_days,
+                "Date": dates.dt.strftime(date_formats[i % len(date_formats)]),
+                "Price": prices,
+            })
+            zip_file.writestr(f"{ticker}.csv", frame.write_csv())
+    return zip_file_path
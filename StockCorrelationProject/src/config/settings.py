@@ -1,15 +1,54 @@
+import os
 from pathlib import Path
 import polars as pl
 
 #base directory of the project
 BASE_DIR = Path(__file__).resolve().parents[2]
 
+# Storage mode of the returns and correlation caches: "standard" keeps float64 values, "compact" stores
+# float32 values and writes the dates of a correlation segment once instead of on every row.
+# Run src/benchmark/storage_benchmark.py to compare the sizes and the numerical error of both modes.
+STORAGE_MODE = "standard"
+
+# Startup mode of the engines: "lazy" constructs them instantly and opens, builds or extends the returns
+# store on first use, "eager" opens it in the constructor. Run src/benchmark/startup_benchmark.py to
+# measure the startup time of the app.
+STARTUP_MODE = "lazy"
+
 # Path to the ZIP file containing stock data
 ZIP_FILE_PATH = str(BASE_DIR / "data" / "stock_data.zip")
 
 # Cache directory for storing correlation results
 CORRELATION_CACHE_PATH = BASE_DIR / "cache" / "correlation"
 
+# Number of pairs passed through the correlation kernel at once, bounding its working memory
+CORRELATION_PAIR_BLOCK_SIZE = 2048
+
+# Number of tickers correlated against the whole universe at once by the top-K screen, and number of
+# dates standardized at once; together they bound its working memory
+CORRELATION_SCREEN_BLOCK_SIZE = 512
+CORRELATION_SCREEN_DATE_CHUNK_SIZE = 64
+
+# Byte budget of the in-memory correlation result cache shared by all sessions of the app
+CORRELATION_RESULT_CACHE_BYTES = 512 * 1024 * 1024
+
+# Maximum number of pairs packed into one correlation store segment file
+CORRELATION_STORE_PAIRS_PER_SEGMENT = 5000
+
+# Number of correlation store segments above which the nightly refresh compacts the store
+CORRELATION_STORE_MAX_SEGMENTS = 64
+
+# Minimum number of rows per row group in a correlation store segment; short series share a row group
+CORRELATION_STORE_MIN_ROW_GROUP_ROWS = 16384
+
+# Zstd level of the correlation store segments. Correlation series barely compress, so higher levels
+# mostly cost write time
+CORRELATION_STORE_COMPRESSION_LEVEL = 3
+
+# Number of worker processes and of pairs per shard of the full-universe precompute
+PRECOMPUTE_WORKERS = os.cpu_count() or 1
+PRECOMPUTE_SHARD_PAIRS = 5000
+
 # Cache directory for storing returns results
 RETURNS_CACHE_PATH = BASE_DIR / "cache" / "returns"
 
@@ -25,12 +64,73 @@ RETURNS_SCHEMA = {'Date': pl.Date,
                   'Return': pl.Float64
                   }
 
+# Ingestion mode of ReturnEngine: "serial" reads the zip with load_from_zip, "parallel" uses ingest_zip
+INGEST_MODE = "serial"
+
+# Staging directory for the parquet parts written by the parallel zip ingestion
+INGEST_STAGING_PATH = BASE_DIR / "cache" / "staging"
+
+# Number of workers and executor type ("thread" or "process") of the parallel zip ingestion
+INGEST_WORKERS = os.cpu_count() or 1
+INGEST_EXECUTOR = "thread"
+
+# Number of CSV members parsed by one ingestion task and written to one staging part
+INGEST_MEMBERS_PER_PART = 64
+
+# Version of the on-disk returns store layout, bump whenever the stored format changes
+RETURNS_STORE_VERSION = 3
+
+# Schema of the wide returns store: the index column, followed by one RETURNS_STORE_DTYPE column per ticker
+RETURNS_STORE_INDEX = {'Date': pl.Date}
+RETURNS_STORE_DTYPE = pl.Float32 if STORAGE_MODE == "compact" else pl.Float64
+
+# NumPy dtype of the memory-mapped returns matrix, "float64" or "float32" to halve its size
+RETURNS_MATRIX_DTYPE = "float32" if STORAGE_MODE == "compact" else "float64"
+
+# Number of dates per row group of the returns store, about a trading year; date-range scans skip the others
+RETURNS_STORE_ROW_GROUP_ROWS = 256
+
+# Number of parts appended to the returns store before they are merged back into one
+RETURNS_STORE_MAX_PARTS = 32
+
 # Polars schema for the CSV files within the ZIP archive
 CSV_SCHEMA = {'Ticker': pl.String,
               'Date': pl.String,
               'Price': pl.Float64
               }
 
+# Date formats accepted in the CSV files, in the order ambiguous dates are resolved
+DATE_FORMATS = ["%m/%d/%Y", "%d/%m/%Y", "%Y/%m/%d", "%m-%d-%Y", "%d-%m-%Y", "%Y-%m-%d"]
+
+# Number of dates of every CSV file sampled to detect its date format
+DATE_SAMPLE_SIZE = 100
+
+# Number of points every correlation series is downsampled to for the chart of the app, about its pixel width
+CHART_MAX_POINTS = 1000
+
+# Instrumentation of the hot paths of the loader and the engines: when enabled, timing spans with the rows,
+# bytes and cache hits they processed are appended as JSON lines to INSTRUMENTATION_LOG_PATH.
+# INSTRUMENTATION_QUERY_PLANS adds the optimized Polars plan of the instrumented lazy queries to their spans
+INSTRUMENTATION_ENABLED = False
+INSTRUMENTATION_LOG_PATH = BASE_DIR / "logs" / "instrumentation.jsonl"
+INSTRUMENTATION_QUERY_PLANS = False
+
 # Rolling window size for correlation calculation
 ROLLING_WINDOW_SIZE = 20
 
+# Missing value mode of the rolling correlations: None yields a correlation only for windows without
+# missing returns, like pl.rolling_corr. A number switches to pairwise-complete windows, computed from the
+# rows in which both tickers have a return and valid with at least that many of them (capped at the
+# window size), so tickers with gaps, recent listings or delistings still yield correlations
+CORRELATION_MIN_OBSERVATIONS = None
+
+# Estimator of the correlations: "rolling" for the Pearson correlation over fixed windows, "ewma" for the
+# exponentially weighted correlation, and "shrinkage" for the exponentially weighted correlation matrix of
+# the whole universe shrunk towards the identity (Ledoit-Wolf) on every date. The exponentially weighted
+# estimators run as a recurrence over the returns, their window size is the half-life in days and
+# CORRELATION_MIN_OBSERVATIONS does not apply to them
+CORRELATION_ESTIMATOR = "rolling"
+
+# Half-life in days of the exponentially weighted estimators in the app
+CORRELATION_HALF_LIFE = 60
+
@@ -1,80 +1,301 @@
+import datetime
+from collections import defaultdict
+from pathlib import Path
 from typing import Optional
 
+import numpy as np
 import polars as pl
-from polars import LazyFrame
-from polars.io import parquet
+from polars import DataFrame, LazyFrame
 
-from src.config.settings import ROLLING_WINDOW_SIZE, CORRELATION_CACHE_PATH, CORRELATION_SCHEMA
+from src.config.settings import ROLLING_WINDOW_SIZE, CORRELATION_CACHE_PATH, CORRELATION_SCHEMA, \
+    CORRELATION_PAIR_BLOCK_SIZE, CORRELATION_SCREEN_BLOCK_SIZE, CORRELATION_SCREEN_DATE_CHUNK_SIZE, \
+    CORRELATION_MIN_OBSERVATIONS, CORRELATION_ESTIMATOR
+from src.main.correlation_kernel import rolling_correlations, rolling_correlations_multi, pair_indices, \
+    top_k_correlations, rolling_correlations_pairwise, ewma_correlations, shrinkage_intensities
+from src.main.correlation_store import CorrelationStore, store_path
+from src.main.downsampling import min_max_downsample
+from src.main.instrumentation import span, instrumented_collect
+from src.main.result_cache import CorrelationCache
+from src.main.returns_engine import date_range_filter
+from src.main.returns_matrix import ReturnsMatrix
 
 
 class CorrelationEngine:
-    def __init__(self,returns: LazyFrame, window_size: int = ROLLING_WINDOW_SIZE):
+    def __init__(self,returns: LazyFrame, window_size: int = ROLLING_WINDOW_SIZE, cache_dir: Path = CORRELATION_CACHE_PATH,
+                 matrix: Optional[ReturnsMatrix] = None, result_cache: Optional[CorrelationCache] = None,
+                 data_version: Optional[str] = None, min_observations: Optional[int] = CORRELATION_MIN_OBSERVATIONS,
+                 estimator: str = CORRELATION_ESTIMATOR):
+        if estimator not in ("rolling", "ewma", "shrinkage"):
+            raise ValueError(f"Unknown estimator: {estimator}")
         self.returns = returns
+        self.estimator = estimator
+        self.min_observations = min_observations if estimator == "rolling" else None
+        # Shrinkage intensities of the universe on every date, keyed by half-life
+        self._intensities = {}
+        self.matrix = matrix
+        self.result_cache = result_cache
+        self.data_version = data_version
         self.window_size = window_size
-        self.cache_dir = CORRELATION_CACHE_PATH
-        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.stores = {}
+        self.store = self.store_for(window_size)
 
-    def get_correlations(self, tickers: set[str]) -> LazyFrame:
+    def get_correlations(self, tickers: set[str], windows: Optional[list[int]] = None,
+                         max_points: Optional[int] = None, start_date: Optional[datetime.date] = None,
+                         end_date: Optional[datetime.date] = None) -> LazyFrame:
         """
-        Computes the pairwise correlations for the given list of tickers
+        Computes the pairwise correlations for the given list of tickers. Pairs held by the
+        in-memory result cache are served from RAM, pairs in the correlation store are read in
+        one scan, all missing pairs are computed together in a single vectorized pass and written
+        to the store as one batch. When the result cache is shared, concurrent sessions missing the
+        same pairs compute them once: the later sessions wait and read them from the store.
+        With a date range, the range is pushed down to the store scans, and missing pairs are computed
+        from the returns of the range and the warm-up rows before it only. Such partial series are kept
+        in the result cache, never written to the store, which holds full series. The exponentially
+        weighted estimators have no warm-up, their partial series are computed from the first row.
         :param tickers: List of ticker symbols to compute correlations for.
-        :return: A Polars DataFrame containing the pairwise correlations.
+        :param windows: Rolling window sizes to compute together, or half-lives for the exponentially
+            weighted estimators. The pairs missing for any of them are computed for all those windows in
+            one pass, and every window is cached on its own. Defaults to the window size of the engine.
+        :param max_points: Downsamples every series to about this many points with min_max_downsample,
+            e.g. to the pixel width of a chart. Caches always hold the full series.
+        :param start_date: The first date to return. Defaults to the first date of the returns.
+        :param end_date: The last date to return. Defaults to the last date of the returns.
+        :return: A Polars DataFrame containing the pairwise correlations, with an additional
+            Window column when windows are given.
         """
         if len(tickers) < 2:
             raise ValueError("At least two tickers are required to compute correlations.")
         try:
-            return pl.concat(
-                self.get_lazy_correlations(tickers),
-                parallel=True
-            )
+            with span("correlations.get", tickers=len(tickers), windows=windows, max_points=max_points,
+                      start_date=start_date, end_date=end_date) as record:
+                tickers = sorted(tickers)
+                pairs = {f"{tickers[i]}-{tickers[j]}": (tickers[i], tickers[j]) for i, j in zip(*pair_indices(len(tickers)))}
+                record["pairs"] = len(pairs)
+                window_sizes = [self.window_size] if windows is None else sorted(set(windows))
+                date_range = None if start_date is None and end_date is None else (start_date, end_date)
+                results = {}
+                missing_names = {}
+                for window_size in window_sizes:
+                    results[window_size], missing_names[window_size] = \
+                        self._lookup_correlations(pairs, window_size, date_range)
+
+                if self.result_cache is None:
+                    self._compute_missing(pairs, missing_names, results, date_range)
+                else:
+                    keys = {self._result_key(name, window_size, date_range): (name, window_size)
+                            for window_size, names in missing_names.items() for name in names}
+                    claimed, pending = self.result_cache.flights.claim(keys)
+                    try:
+                        owned_names = {window_size: set() for window_size in window_sizes}
+                        for key in claimed:
+                            name, window_size = keys[key]
+                            owned_names[window_size].add(name)
+                        self._compute_missing(pairs, owned_names, results, date_range)
+                    finally:
+                        self.result_cache.flights.release(claimed)
+                    record["waited_flights"] = len(pending)
+                    for flight in pending:
+                        flight.wait()
+                    # Pairs computed by another session are cached now, unless its computation failed
+                    for window_size in window_sizes:
+                        waited = {name: pairs[name] for name in missing_names[window_size]
+                                  if self._result_key(name, window_size, date_range) not in claimed}
+                        if waited:
+                            found, missing_names[window_size] = self._lookup_correlations(waited, window_size, date_range)
+                            results[window_size].extend(found)
+                        else:
+                            missing_names[window_size] = set()
+                    self._compute_missing(pairs, missing_names, results, date_range)
+
+                for window_size in window_sizes:
+                    results[window_size] = pl.concat(results[window_size], parallel=True)
+                    if max_points is not None:
+                        results[window_size] = min_max_downsample(results[window_size], max_points)
+                if windows is None:
+                    return results[self.window_size]
+                return pl.concat([
+                    results[window_size].with_columns(Window=pl.lit(window_size, dtype=pl.UInt16))
+                    for window_size in window_sizes
+                ], parallel=True)
         except pl.exceptions.PolarsError as e:
             raise RuntimeError(f"An error occurred while computing correlations: {e}")
 
-    def get_lazy_correlations(self, unique_tickers: set[str]) -> list[LazyFrame]:
+    def _compute_missing(self, pairs: dict[str, tuple[str, str]], missing_names: dict[int, set[str]],
+                         results: dict[int, list[LazyFrame]], date_range: Optional[tuple] = None):
         """
-        Generates lazy frames for all unique combinations of ticker pairs. Each pair's correlation
-        is represented as a Polars LazyFrame.
-        :param unique_tickers: A list of ticker symbols to compute pairwise correlations for.
-        :return: A list of Polars LazyFrames, each containing the correlation for a ticker pair.
+        Computes the missing pairs of every window size in one pass and appends them to the results. Full
+        series are written to the correlation stores. The series of a date range are computed from the
+        rows of the range, seeded with the warm-up rows of the largest window before it, and only cached.
+        :param pairs: The ticker pairs, keyed by correlation name.
+        :param missing_names: The names of the pairs to compute, keyed by window size.
+        :param results: The correlations found so far, keyed by window size, extended in place.
+        :param date_range: The (start date, end date) of the query, or None for the full history.
         """
-        results = [
-            self.get_correlation_for_pair(ticker1, ticker2)
-            for i, ticker1 in enumerate(unique_tickers)
-            for j, ticker2 in enumerate(unique_tickers)
-            if i < j
-        ]
-        return results
+        missing_windows = [window_size for window_size in sorted(missing_names) if missing_names[window_size]]
+        missing_pairs = [pair for name, pair in pairs.items()
+                         if any(name in missing_names[window_size] for window_size in missing_windows)]
+        if not missing_pairs:
+            return
+        with span("correlations.compute", pairs=len(missing_pairs), windows=missing_windows,
+                  partial=date_range is not None) as record:
+            if date_range is None:
+                computed = self.calculate_correlations(missing_pairs, windows=missing_windows)
+            else:
+                first_row, stop = self._date_rows(*date_range)
+                offset = max(first_row - max(missing_windows) + 1, 0) if self.estimator == "rolling" else 0
+                computed = self.calculate_correlations(missing_pairs, offset, windows=missing_windows, stop=stop) \
+                    .filter(date_range_filter(*date_range))
+            record["rows"] = computed.height
+        for (window_size,), result in computed.group_by("Window"):
+            result = result.drop("Window").filter(pl.col("Name").is_in(list(missing_names[window_size])))
+            if date_range is None:
+                self.store_for(window_size).write(result, self.data_version)
+            results[window_size].append(self._cache_results(result.lazy(), window_size, date_range))
 
-    def get_correlation_for_pair(self, ticker1: str, ticker2: str) -> LazyFrame:
+    def _date_rows(self, start_date: Optional[datetime.date], end_date: Optional[datetime.date]) -> tuple[int, int]:
         """
-        First attempts to retrieve the correlation from the Paquret cache. If the correlation
-        is not cached, it calculates the correlation, stores it in the cache, and returns the result as a LazyFrame.
-        :param ticker1: The first ticker symbol.
-        :param ticker2: The second ticker symbol.
-        :return: A Polars LazyFrame containing the correlation for the ticker pair.
-        """
-        correlation_name = '-'.join(sorted([ticker1, ticker2]))
-        cache_path = self.cache_dir / f"{correlation_name}.parquet"
-        cached_result = self.get_correlation_from_cache(correlation_name)
-        # Attempt to retrieve from cache
-        if cached_result is not None:
-            return cached_result
+        Locates a date range in the rows of the returns.
+        :param start_date: The first date of the range, or None for the first row.
+        :param end_date: The last date of the range, or None for the last row.
+        :return: The first row of the range and the row after its last one.
+        """
+        if self.matrix is not None:
+            dates = np.asarray(self.matrix.dates)
         else:
-            # Calculate correlation if not in cache
-            result = self.calculate_correlation(ticker1, ticker2, correlation_name)
-            result.collect().write_parquet(cache_path)
-            return result
+            dates = self.returns.select("Date").collect().to_series().to_numpy().astype("datetime64[D]")
+        first_row = 0 if start_date is None else int(np.searchsorted(dates, np.datetime64(start_date, "D"), side="left"))
+        stop = len(dates) if end_date is None else int(np.searchsorted(dates, np.datetime64(end_date, "D"), side="right"))
+        return first_row, stop
+
+    def top_correlations(self, k: int = 10, end_date: Optional[datetime.date] = None,
+                         start_date: Optional[datetime.date] = None, anchor: Optional[str] = None) -> DataFrame:
+        """
+        Screens the universe for the k most and k least correlated ticker pairs, as of end_date or by
+        their rolling correlation averaged over the dates from start_date to end_date. The correlations
+        are computed in blocks of tickers and reduced to the top pairs block by block, so the series of
+        every pair are never materialized and nothing is written to the correlation store. The screen
+        always ranks rolling windows of the window size, whatever the estimator of the engine.
+        :param k: The number of most and of least correlated pairs to return.
+        :param end_date: The date to screen as of, or the last date of the range. Defaults to the last date.
+        :param start_date: The first date of the range to average over. Defaults to end_date.
+        :param anchor: Screen only the pairs of this ticker against every other ticker.
+        :return: A Polars DataFrame with the columns Direction ("most" or "least"), Rank, Name and
+            Correlation, the most correlated pairs first.
+        :raises ValueError: If the anchor is not present in the data.
+        """
+        tickers = self.matrix.tickers if self.matrix is not None else self.returns.collect_schema().names()[1:]
+        tickers = sorted(tickers)
+        if anchor is not None and anchor not in tickers:
+            raise ValueError(f"Ticker not present in the data: {anchor}")
+        with span("correlations.top_select_returns", tickers=len(tickers)):
+            values, dates = self._select_returns(tickers, 0)
+        dates = dates.astype("datetime64[D]")
+        last_row = len(dates) - 1 if end_date is None else \
+            int(np.searchsorted(dates, np.datetime64(end_date, "D"), side="right")) - 1
+        first_row = last_row if start_date is None else \
+            int(np.searchsorted(dates, np.datetime64(start_date, "D"), side="left"))
+        # Only the rows of the windows ending within the range are read
+        offset = max(first_row - self.window_size + 1, 0)
+        with span("correlations.top_screen", tickers=len(tickers), dates=last_row - first_row + 1, k=k):
+            most, least = top_k_correlations(
+                values[offset:last_row + 1], self.window_size, first_row - offset, last_row - offset, k,
+                anchor=None if anchor is None else tickers.index(anchor),
+                block_size=CORRELATION_SCREEN_BLOCK_SIZE, date_chunk_size=CORRELATION_SCREEN_DATE_CHUNK_SIZE,
+            )
+        return pl.concat([
+            pl.DataFrame({
+                "Direction": [direction] * len(pairs),
+                "Rank": pl.Series(np.arange(1, len(pairs) + 1), dtype=pl.UInt32),
+                "Name": [f"{tickers[int(i)]}-{tickers[int(j)]}" for i, j in pairs[:, :2]],
+                "Correlation": pl.Series(pairs[:, 2], dtype=pl.Float64),
+            }, schema_overrides={"Direction": pl.String, "Name": pl.String})
+            for direction, pairs in (("most", most), ("least", least))
+        ])
+
+    def store_for(self, window_size: int) -> CorrelationStore:
+        """
+        Returns the correlation store of a rolling window size.
+        :param window_size: The rolling window size.
+        :return: The correlation store holding that window.
+        """
+        if window_size not in self.stores:
+            self.stores[window_size] = CorrelationStore(
+                store_path(self.cache_dir, window_size, self.min_observations, self.estimator), window_size)
+        return self.stores[window_size]
+
+    def _lookup_correlations(self, pairs: dict[str, tuple[str, str]], window_size: int,
+                             date_range: Optional[tuple] = None) -> tuple[list[LazyFrame], set[str]]:
+        """
+        Looks the pairs up in the result cache, then in the correlation store of a window size. For a date
+        range, full series cached in RAM are sliced, then series cached for the same range are used, and
+        the range is pushed down to the store scan.
+        :param pairs: The ticker pairs, keyed by correlation name.
+        :param window_size: The rolling window size.
+        :param date_range: The (start date, end date) of the query, or None for the full history.
+        :return: The correlations found and the names of the pairs that are missing.
+        """
+        with span("correlations.lookup", window=window_size, pairs=len(pairs)) as record:
+            results = []
+            missing = set(pairs)
+            if self.result_cache is not None:
+                for name in pairs:
+                    cached_result = self.result_cache.get(self._result_key(name, window_size))
+                    if cached_result is not None and date_range is not None:
+                        cached_result = cached_result.filter(date_range_filter(*date_range))
+                    elif date_range is not None:
+                        cached_result = self.result_cache.get(self._result_key(name, window_size, date_range))
+                    if cached_result is not None:
+                        results.append(cached_result.lazy())
+                        missing.discard(name)
+                record["cache_hits"], record["cache_misses"] = len(pairs) - len(missing), len(missing)
+
+            store = self.store_for(window_size)
+            cached_names = store.names() & missing
+            if cached_names:
+                stored = store.read(cached_names)
+                if date_range is not None:
+                    stored = stored.filter(date_range_filter(*date_range))
+                results.append(self._cache_results(stored, window_size, date_range))
+            record["store_hits"], record["store_misses"] = len(cached_names), len(missing - cached_names)
+            return results, missing - cached_names
+
+    def _result_key(self, correlation_name: str, window_size: int, date_range: Optional[tuple] = None) -> tuple:
+        """
+        Returns the result cache key of a pair, which also identifies the window size, the estimator, the
+        missing value mode, the returns version and, for a partial series, its date range.
+        :param correlation_name: The name of the correlation (e.g., "AAPL-MSFT").
+        :param window_size: The rolling window size.
+        :param date_range: The (start date, end date) of a partial series, or None for the full series.
+        :return: The cache key.
+        """
+        key = correlation_name, window_size, self.estimator, self.min_observations, self.data_version
+        return key if date_range is None else key + tuple(date_range)
+
+    def _cache_results(self, lf: LazyFrame, window_size: int, date_range: Optional[tuple] = None) -> LazyFrame:
+        """
+        Puts the correlations of every pair of a frame into the result cache, if the engine has one.
+        :param lf: A LazyFrame matching CORRELATION_SCHEMA.
+        :param window_size: The rolling window size of the correlations.
+        :param date_range: The (start date, end date) the correlations were limited to, or None.
+        :return: The correlations, collected if they were cached.
+        """
+        if self.result_cache is None:
+            return lf
+        df = instrumented_collect(lf, "correlations.collect", window=window_size)
+        for (name,), group in df.group_by("Name"):
+            self.result_cache.put(self._result_key(name, window_size, date_range), group)
+        return df.lazy()
 
     def get_correlation_from_cache(self, correlation_name: str) -> Optional[LazyFrame]:
         """
-        Checks if a cached parquet file exists for the specified ticker pair. If the file
-        exists and has a valid schema, it returns the cached result. Otherwise, it returns None.
+        Checks if the correlation store holds the specified ticker pair. If it does and the stored
+        rows have a valid schema, it returns the cached result. Otherwise, it returns None.
         :param correlation_name: The name of the ticker pair (e.g., "AAPL-MSFT").
         :return: A Polars LazyFrame containing the cached correlation, or None if not found.
         """
-        cache_path = self.cache_dir / f"{correlation_name}.parquet"
-        if cache_path.exists():
-            cached_result = parquet.scan_parquet(cache_path)
+        if correlation_name in self.store.names():
+            cached_result = self.store.read([correlation_name])
             if self._validate_schema(cached_result):
                 return cached_result
         return None
@@ -82,12 +303,19 @@ class CorrelationEngine:
     def calculate_correlation(self, ticker1: str, ticker2: str, correlation_name: str) -> LazyFrame:
         """
         Calculates the rolling correlation between the two tickers over the specified
-        window size and returns the result as a Polars LazyFrame.
+        window size and returns the result as a Polars LazyFrame. When the engine has a returns
+        matrix or an exponentially weighted estimator, the pair is computed by calculate_correlations
+        instead of planning a query over the returns frame.
         :param ticker1: The first ticker symbol.
         :param ticker2: The second ticker symbol.
         :param correlation_name: The name of the correlation (e.g., "AAPL-MSFT").
         :return: A Polars LazyFrame containing the rolling correlation for the ticker pair.
         """
+        if self.matrix is not None or self.estimator != "rolling":
+            columns = self.matrix.columns if self.matrix is not None else self.returns.collect_schema().names()
+            if ticker1 not in columns or ticker2 not in columns:
+                raise ValueError(f"One or both tickers ({ticker1}, {ticker2}) are not present in the data.")
+            return self.calculate_correlations([(ticker1, ticker2)]).with_columns(Name=pl.lit(correlation_name)).lazy()
         if ticker1 not in self.returns.columns or ticker2 not in self.returns.columns:
             raise ValueError(f"One or both tickers ({ticker1}, {ticker2}) are not present in the data.")
 
@@ -96,6 +324,162 @@ class CorrelationEngine:
             Name=pl.lit(correlation_name)
         ).select(CORRELATION_SCHEMA.keys())
 
+    def calculate_correlations(self, pairs: list[tuple[str, str]], offset: int = 0,
+                               windows: Optional[list[int]] = None, stop: Optional[int] = None) -> DataFrame:
+        """
+        Calculates the rolling correlation of many ticker pairs at once. The returns of all
+        involved tickers are collected into one matrix and passed through the vectorized kernel in
+        blocks of CORRELATION_PAIR_BLOCK_SIZE pairs, instead of building one rolling_corr plan per pair.
+        Several window sizes are computed in the same pass, sharing the prefix sums of the returns.
+        When the engine has min_observations, windows are computed from the rows in which both tickers
+        have a return and are valid with at least min_observations of them, see rolling_correlations_pairwise.
+        The exponentially weighted estimators run ewma_correlations instead, and the shrinkage estimator
+        scales the correlations of every date down by the shrinkage intensity of the universe.
+        :param pairs: The ticker pairs to compute, each given as (ticker1, ticker2).
+        :param offset: The first row of the returns to compute from; earlier rows are ignored, so the
+            exponentially weighted estimators start their recurrence there.
+        :param windows: The rolling window sizes, or half-lives, to compute. Defaults to the window size
+            of the engine.
+        :param stop: The row of the returns to stop before; later rows are ignored. Defaults to the end.
+        :return: A Polars DataFrame matching CORRELATION_SCHEMA with the correlations of all pairs,
+            laid out pair by pair in the order of the given pairs, with an additional Window column
+            when windows are given.
+        """
+        tickers = sorted({ticker for pair in pairs for ticker in pair})
+        with span("correlations.select_returns", tickers=len(tickers), offset=offset, stop=stop) as record:
+            values, dates = self._select_returns(tickers, offset, stop)
+            record["bytes_read"] = values.nbytes
+        column_index = {ticker: i for i, ticker in enumerate(tickers)}
+        window_sizes = [self.window_size] if windows is None else windows
+        blocks = []
+        for start in range(0, len(pairs), CORRELATION_PAIR_BLOCK_SIZE):
+            block = pairs[start:start + CORRELATION_PAIR_BLOCK_SIZE]
+            left = np.array([column_index[ticker1] for ticker1, _ in block], dtype=np.int64)
+            right = np.array([column_index[ticker2] for _, ticker2 in block], dtype=np.int64)
+            names = ['-'.join(sorted(pair)) for pair in block]
+            if windows is None and self.estimator == "rolling" and self.min_observations is None:
+                correlations, valid = rolling_correlations(values, left, right, self.window_size)
+                blocks.append(self._correlation_frame(names, dates, correlations, valid))
+                continue
+            if self.estimator != "rolling":
+                correlations, valid = ewma_correlations(values, left, right, window_sizes)
+                if self.estimator == "shrinkage":
+                    correlations *= 1.0 - self._shrinkage_intensities(window_sizes)[:, None, offset:stop]
+            elif self.min_observations is None:
+                correlations, valid = rolling_correlations_multi(values, left, right, window_sizes)
+            else:
+                correlations, valid = rolling_correlations_pairwise(values, left, right, window_sizes,
+                                                                    self.min_observations)
+            for k, window_size in enumerate(window_sizes):
+                frame = self._correlation_frame(names, dates, correlations[k], valid[k])
+                if windows is not None:
+                    frame = frame.with_columns(Window=pl.lit(window_size, dtype=pl.UInt16))
+                blocks.append(frame)
+        schema = CORRELATION_SCHEMA if windows is None else {**CORRELATION_SCHEMA, "Window": pl.UInt16}
+        if not blocks:
+            return pl.DataFrame(schema=schema)
+        result = pl.concat(blocks, rechunk=False).select(schema.keys())
+        # Blocks are emitted window by window, keep the pairs of a window together
+        return result if windows is None else result.sort("Window", maintain_order=True)
+
+    def _correlation_frame(self, names: list[str], dates: np.ndarray, correlations: np.ndarray,
+                           valid: np.ndarray) -> DataFrame:
+        """
+        Lays out the kernel output of a block of pairs as a correlation frame.
+        :param names: The correlation names of the pairs.
+        :param dates: The (T,) dates as days since the epoch.
+        :param correlations: The pair-major (P, T) correlations.
+        :param valid: The pair-major (P, T) mask of valid windows; invalid windows become null.
+        :return: A Polars DataFrame matching CORRELATION_SCHEMA.
+        """
+        # The kernel output is pair-major, so ravel() is a view and the rows come out pair by pair
+        return pl.DataFrame({
+            "Date": pl.Series(np.tile(dates, len(names))).cast(pl.Date),
+            "Name": pl.Series(names, dtype=pl.String).gather(np.repeat(np.arange(len(names)), len(dates))),
+            "Correlation": pl.Series(correlations.ravel()),
+            "Valid": pl.Series(valid.ravel()),
+        }).select("Date", "Name", Correlation=pl.when(pl.col("Valid")).then(pl.col("Correlation")))
+
+    def _shrinkage_intensities(self, half_lives: list[int]) -> np.ndarray:
+        """
+        Returns the shrinkage intensity of the correlation matrix of the whole universe on every date, see
+        shrinkage_intensities. The intensities of a half-life are computed once, in one pass over the
+        returns of every ticker, and kept for the lifetime of the engine, which serves one returns version.
+        :param half_lives: The half-lives.
+        :return: A (W, T) array of the intensities of every half-life on every row of the returns.
+        """
+        missing = [half_life for half_life in half_lives if half_life not in self._intensities]
+        if missing:
+            tickers = self.matrix.tickers if self.matrix is not None else self.returns.collect_schema().names()[1:]
+            with span("correlations.shrinkage", tickers=len(tickers), half_lives=missing) as record:
+                values, _ = self._select_returns(sorted(tickers), 0)
+                record["rows"] = len(values)
+                for half_life, intensities in zip(missing, shrinkage_intensities(values, missing)):
+                    self._intensities[half_life] = intensities
+        return np.stack([self._intensities[half_life] for half_life in half_lives])
+
+    def _select_returns(self, tickers: list[str], offset: int,
+                        stop: Optional[int] = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Selects the returns of the given tickers as a matrix, from the memory-mapped returns matrix when
+        the engine has one, otherwise by collecting them from the returns frame.
+        :param tickers: The ticker symbols, in the column order of the result.
+        :param offset: The first row of the returns to select.
+        :param stop: The row of the returns to stop before, or None to select up to the last row.
+        :return: A (T, N) float64 matrix of the returns and the (T,) dates as days since the epoch.
+        :raises ValueError: If a ticker is not present in the data.
+        """
+        available = self.matrix.columns if self.matrix is not None else set(self.returns.collect_schema().names())
+        unknown = [ticker for ticker in tickers if ticker not in available]
+        if unknown:
+            raise ValueError(f"Tickers not present in the data: {', '.join(unknown)}")
+
+        if self.matrix is not None:
+            values = np.asarray(self.matrix.select(tickers, offset, stop), dtype=np.float64)
+            return values, self.matrix.dates[offset:stop].astype(np.int32)
+        frame = self.returns.select("Date", *tickers).slice(offset, None if stop is None else stop - offset).collect()
+        return frame.select(tickers).to_numpy().astype(np.float64), frame["Date"].to_physical().to_numpy()
+
+    def update_cache(self) -> int:
+        """
+        Appends the dates that are newer than the cached correlations to every cached pair. Only the
+        new rows are computed, seeded with the trailing window of returns before them, and written to
+        the store as new segments, so a refresh takes time proportional to the new data. The exponentially
+        weighted estimators have no trailing window, they rerun their recurrence from the first row.
+        :return: The number of cached pairs that were extended.
+        """
+        dates = self.returns.select("Date").collect().to_series()
+        tickers = set(self.returns.collect_schema().names()[1:])
+        pending = defaultdict(list)
+        for correlation_name, last_date in self.store.end_dates().iter_rows():
+            pair = self._split_correlation_name(correlation_name, tickers)
+            if pair is not None and last_date is not None:
+                pending[last_date].append(pair)
+
+        extended = 0
+        for last_date, pairs in pending.items():
+            first_new_row = dates.search_sorted(last_date, side="right")
+            if first_new_row >= len(dates):
+                continue
+            offset = max(first_new_row - self.window_size + 1, 0) if self.estimator == "rolling" else 0
+            self.store.write(self.calculate_correlations(pairs, offset).filter(pl.col("Date") > last_date),
+                             self.data_version)
+            extended += len(pairs)
+        return extended
+
+    def _split_correlation_name(self, correlation_name: str, tickers: set[str]) -> Optional[tuple[str, str]]:
+        """
+        Splits a correlation name back into its ticker pair. Tickers may contain '-' themselves, so
+        the split point is chosen such that both halves are known tickers.
+        :param correlation_name: The name of the correlation (e.g., "AAPL-MSFT").
+        :param tickers: The known ticker symbols.
+        :return: The (ticker1, ticker2) pair, or None if the name does not match two known tickers.
+        """
+        for i, char in enumerate(correlation_name):
+            if char == '-' and correlation_name[:i] in tickers and correlation_name[i + 1:] in tickers:
+                return correlation_name[:i], correlation_name[i + 1:]
+        return None
+
     def _validate_schema(self, lf: LazyFrame) -> bool:
         """
         Validates the schema of the LazyFrame to ensure it contains the required columns.
@@ -0,0 +1,506 @@
+from typing import Iterator, Optional
+
+import numpy as np
+
+# Number of time steps after which the running window sums are recomputed exactly,
+# bounding the floating point drift of the add/subtract updates.
+RESYNC_INTERVAL = 1024
+
+# Relative variance below which a window is treated as constant
+VARIANCE_TOLERANCE = 1e-12
+
+
+def pair_indices(n_columns: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the column indices of every unique column pair (upper triangle, i < j).
+    :param n_columns: The number of columns in the returns matrix.
+    :return: Two arrays holding the left and right column index of every pair.
+    """
+    left, right = np.triu_indices(n_columns, k=1)
+    return left, right
+
+
+def rolling_correlations(values: np.ndarray, left: np.ndarray, right: np.ndarray,
+                         window_size: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Computes the rolling Pearson correlation of many column pairs in a single pass over the rows.
+    Rolling sums of x, x² and xy are kept for every column and pair and updated in O(N + P) per
+    time step, so the whole correlation matrix costs one pass instead of one plan per pair.
+    The semantics match pl.rolling_corr: a window is valid once it is full and contains no missing
+    values, and a window with zero variance yields NaN.
+    :param values: A (T, N) float matrix of returns, with NaN marking missing values.
+    :param left: The left column index of every pair.
+    :param right: The right column index of every pair.
+    :param window_size: The rolling window size.
+    :return: Two pair-major (P, T) arrays, the correlations and a mask of the windows that are valid,
+        so the series of every pair is contiguous and can be flattened without a copy.
+    """
+    if window_size < 1:
+        raise ValueError("The window size must be at least 1.")
+    values = np.asarray(values, dtype=np.float64)
+    n_rows = values.shape[0]
+    missing = np.isnan(values)
+    # Centering the columns keeps the running sums small and the cancellation error low
+    filled = np.where(missing, 0.0, values)
+    filled -= filled.sum(axis=0) / np.maximum((~missing).sum(axis=0), 1)
+    filled[missing] = 0.0
+
+    correlations = np.full((len(left), n_rows), np.nan)
+    valid = np.zeros((len(left), n_rows), dtype=bool)
+    sum_x = np.zeros(values.shape[1])
+    sum_xx = np.zeros(values.shape[1])
+    sum_xy = np.zeros(len(left))
+    n_missing = np.zeros(values.shape[1], dtype=np.int64)
+
+    for t in range(n_rows):
+        start = t - window_size + 1
+        if t % RESYNC_INTERVAL == 0 and start > 0:
+            window = filled[start:t + 1]
+            sum_x = window.sum(axis=0)
+            sum_xx = (window * window).sum(axis=0)
+            sum_xy = (window[:, left] * window[:, right]).sum(axis=0)
+            n_missing = missing[start:t + 1].sum(axis=0)
+        else:
+            x = filled[t]
+            sum_x += x
+            sum_xx += x * x
+            sum_xy += x[left] * x[right]
+            n_missing += missing[t]
+            if start > 0:
+                old = filled[start - 1]
+                sum_x -= old
+                sum_xx -= old * old
+                sum_xy -= old[left] * old[right]
+                n_missing -= missing[start - 1]
+        if start < 0:
+            continue
+
+        variance = window_size * sum_xx - sum_x * sum_x
+        # Rounding can leave a constant column with a tiny, even negative, variance
+        variance[variance <= VARIANCE_TOLERANCE * window_size * sum_xx] = 0.0
+        covariance = window_size * sum_xy - sum_x[left] * sum_x[right]
+        denominator = np.sqrt(variance[left] * variance[right])
+        with np.errstate(invalid="ignore", divide="ignore"):
+            correlations[:, t] = np.where(denominator > 0, covariance / denominator, np.nan)
+        valid[:, t] = (n_missing[left] == 0) & (n_missing[right] == 0)
+
+    np.clip(correlations, -1.0, 1.0, out=correlations)
+    return correlations, valid
+
+
+def rolling_correlations_multi(values: np.ndarray, left: np.ndarray, right: np.ndarray,
+                               windows: list[int]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Computes the rolling Pearson correlation of many column pairs for several window sizes at once.
+    Prefix sums of x, x² and xy are built in one pass over the rows and shared by every window: the
+    sums of a window are the difference of two prefix rows. Means and inverse deviations are derived
+    per column, so each extra window only costs a few elementwise operations per pair. The semantics
+    match rolling_correlations.
+    :param values: A (T, N) float matrix of returns, with NaN marking missing values.
+    :param left: The left column index of every pair.
+    :param right: The right column index of every pair.
+    :param windows: The rolling window sizes.
+    :return: Two (W, P, T) arrays, window by window in the given order and pair-major within a window:
+        the correlations and a mask of the windows that are valid.
+    """
+    if min(windows, default=1) < 1:
+        raise ValueError("The window size must be at least 1.")
+    values = np.asarray(values, dtype=np.float64)
+    n_rows = values.shape[0]
+    filled, missing = _centered_columns(values)
+
+    prefix_x = _prefix_sum(filled)
+    prefix_xx = _prefix_sum(filled * filled)
+    prefix_xy = _prefix_sum(filled[left] * filled[right])
+    prefix_missing = _prefix_sum(missing.astype(np.int32))
+
+    correlations = np.full((len(windows), len(left), n_rows), np.nan)
+    valid = np.zeros((len(windows), len(left), n_rows), dtype=bool)
+    for k, window_size in enumerate(windows):
+        if window_size > n_rows:
+            continue
+        sum_x = prefix_x[:, window_size:] - prefix_x[:, :-window_size]
+        sum_xx = prefix_xx[:, window_size:] - prefix_xx[:, :-window_size]
+        complete = (prefix_missing[:, window_size:] - prefix_missing[:, :-window_size]) == 0
+
+        variance = window_size * sum_xx - sum_x * sum_x
+        # Rounding can leave a constant column with a tiny, even negative, variance; it yields NaN
+        constant = variance <= VARIANCE_TOLERANCE * window_size * sum_xx
+        with np.errstate(divide="ignore", invalid="ignore"):
+            inverse_deviation = 1.0 / np.sqrt(np.where(constant, np.nan, variance))
+        scaled_sum = sum_x * inverse_deviation
+
+        # corr = (w * Σxy - Σx Σy) / (sqrt(var x) sqrt(var y)), evaluated in place in the output
+        out = correlations[k, :, window_size - 1:]
+        np.subtract(prefix_xy[:, window_size:], prefix_xy[:, :-window_size], out=out)
+        out *= window_size
+        out *= inverse_deviation[left]
+        out *= inverse_deviation[right]
+        out -= scaled_sum[left] * scaled_sum[right]
+        np.logical_and(complete[left], complete[right], out=valid[k, :, window_size - 1:])
+
+    np.clip(correlations, -1.0, 1.0, out=correlations)
+    return correlations, valid
+
+
+def rolling_correlations_pairwise(values: np.ndarray, left: np.ndarray, right: np.ndarray, windows: list[int],
+                                  min_observations: int, chunk_size: int = 256) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Computes the rolling Pearson correlation of many column pairs for several window sizes from the
+    pairwise-complete observations of every window, the rows in which both columns have a value. A full
+    window is valid when it holds at least min(min_observations, window size) such rows, so columns with
+    gaps, recent listings or delistings yield correlations wherever they overlap enough.
+    Only the windows that contain a missing value next to a value differ from rolling_correlations_multi,
+    so the dense kernel runs first and only the windows around the missing values of every column are
+    recomputed, for the pairs of that column, from prefix sums of the joint validity mask and of the
+    masked values. Pairs are recomputed in chunks of chunk_size pairs with similar missing rows, which
+    bounds memory and keeps the recomputed rows of a chunk tight, so the cost is proportional to the
+    rows affected by missing values rather than to the history.
+    :param values: A (T, N) float matrix of returns, with NaN marking missing values.
+    :param left: The left column index of every pair.
+    :param right: The right column index of every pair.
+    :param windows: The rolling window sizes.
+    :param min_observations: The number of rows with both values a window needs, at least 2.
+    :param chunk_size: The number of pairs recomputed at once.
+    :return: Two (W, P, T) arrays, window by window in the given order and pair-major within a window:
+        the correlations and a mask of the windows that are valid.
+    :raises ValueError: If a window size is smaller than 1 or min_observations smaller than 2.
+    """
+    if min_observations < 2:
+        raise ValueError("A correlation needs at least two observations.")
+    correlations, valid = rolling_correlations_multi(values, left, right, windows)
+    values = np.asarray(values, dtype=np.float64)
+    n_rows = values.shape[0]
+    filled, missing = _centered_columns(values)
+    present = ~missing
+    # Columns without any value are invalid in every window either way
+    has_missing = missing.any(axis=1) & present.any(axis=1)
+    if not (has_missing[left] | has_missing[right]).any():
+        return correlations, valid
+
+    # First and last missing row of every column that a window shares with one of its values: windows
+    # before the first or after the last value of a column hold none of its values and are invalid either
+    # way, so a recent listing or a delisting only affects the windows around it
+    first_present = present.argmax(axis=1)
+    last_present = n_rows - 1 - present[:, ::-1].argmax(axis=1)
+    first_missing = np.where(has_missing, np.maximum(missing.argmax(axis=1), first_present - 1), n_rows)
+    last_missing = np.where(has_missing, np.minimum(n_rows - 1 - missing[:, ::-1].argmax(axis=1), last_present + 1), -1)
+    longest = max(windows)
+
+    # The windows affected by the missing rows of the left columns, then of the right columns. The
+    # recomputation accounts for the missing rows of both columns, so overlapping windows agree, and the
+    # right pass skips the pairs whose missing rows the left pass already covered
+    covered = (has_missing[left] & (first_missing[left] <= first_missing[right])
+               & (last_missing[left] >= last_missing[right]))
+    for columns, skip in ((left, np.zeros_like(covered)), (right, covered)):
+        affected = np.flatnonzero(has_missing[columns] & ~skip)
+        affected = affected[np.lexsort((last_missing[columns[affected]], first_missing[columns[affected]]))]
+        for start in range(0, len(affected), chunk_size):
+            chunk = affected[start:start + chunk_size]
+            row_lo = max(int(first_missing[columns[chunk]].min()) - longest + 1, 0)
+            row_hi = min(int(last_missing[columns[chunk]].max()) + longest, n_rows)
+            _pairwise_correlations(filled, present, left, right, chunk, windows, min_observations, row_lo, row_hi,
+                                   correlations, valid)
+    np.clip(correlations, -1.0, 1.0, out=correlations)
+    return correlations, valid
+
+
+def _pairwise_correlations(filled: np.ndarray, present: np.ndarray, left: np.ndarray, right: np.ndarray,
+                           chunk: np.ndarray, windows: list[int], min_observations: int, row_lo: int, row_hi: int,
+                           correlations: np.ndarray, valid: np.ndarray):
+    """
+    Computes the pairwise-complete correlations of a chunk of pairs for the full windows within the rows
+    row_lo..row_hi and writes them into the outputs.
+    :param filled: The (N, T) centered returns with missing values set to 0.
+    :param present: The (N, T) mask of the values that are present.
+    :param left: The left column index of every pair.
+    :param right: The right column index of every pair.
+    :param chunk: The indices of the pairs to compute.
+    :param windows: The rolling window sizes.
+    :param min_observations: The number of rows with both values a window needs.
+    :param row_lo: The first row of the windows to compute.
+    :param row_hi: The row after the last window end to compute.
+    :param correlations: The (W, P, T) correlations, updated in place.
+    :param valid: The (W, P, T) validity mask, updated in place.
+    """
+    both = present[left[chunk], row_lo:row_hi] & present[right[chunk], row_lo:row_hi]
+    x = np.where(both, filled[left[chunk], row_lo:row_hi], 0.0)
+    y = np.where(both, filled[right[chunk], row_lo:row_hi], 0.0)
+    prefix_n = _prefix_sum(both.astype(np.int32))
+    prefix_x, prefix_y = _prefix_sum(x), _prefix_sum(y)
+    prefix_xx, prefix_yy, prefix_xy = _prefix_sum(x * x), _prefix_sum(y * y), _prefix_sum(x * y)
+
+    for k, window_size in enumerate(windows):
+        if window_size > row_hi - row_lo:
+            continue
+        n = prefix_n[:, window_size:] - prefix_n[:, :-window_size]
+        sum_x = prefix_x[:, window_size:] - prefix_x[:, :-window_size]
+        sum_y = prefix_y[:, window_size:] - prefix_y[:, :-window_size]
+        sum_xx = prefix_xx[:, window_size:] - prefix_xx[:, :-window_size]
+        sum_yy = prefix_yy[:, window_size:] - prefix_yy[:, :-window_size]
+        variance_x = n * sum_xx - sum_x * sum_x
+        variance_y = n * sum_yy - sum_y * sum_y
+        # Rounding can leave a constant column with a tiny, even negative, variance; it yields NaN
+        constant = (variance_x <= VARIANCE_TOLERANCE * n * sum_xx) | (variance_y <= VARIANCE_TOLERANCE * n * sum_yy)
+        covariance = n * (prefix_xy[:, window_size:] - prefix_xy[:, :-window_size]) - sum_x * sum_y
+        with np.errstate(divide="ignore", invalid="ignore"):
+            correlation = covariance / np.sqrt(variance_x * variance_y)
+        correlation[constant] = np.nan
+
+        ends = slice(row_lo + window_size - 1, row_hi)
+        correlations[k, chunk, ends] = correlation
+        valid[k, chunk, ends] = n >= min(min_observations, window_size)
+
+
+def ewma_correlations(values: np.ndarray, left: np.ndarray, right: np.ndarray,
+                      half_lives: list[int]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Computes the exponentially weighted Pearson correlation of many column pairs for several half-lives in
+    a single pass over the rows. The weighted means of every column and the weighted variances and
+    covariance of every pair are updated by a recurrence in O(N + P) per row, so the memory does not grow
+    with the history. A pair is only updated on the rows in which both columns have a value, and a
+    correlation is valid once the pair has at least half-life such rows; zero variance yields NaN.
+    :param values: A (T, N) float matrix of returns, with NaN marking missing values.
+    :param left: The left column index of every pair.
+    :param right: The right column index of every pair.
+    :param half_lives: The half-lives in rows, after which a return weighs half as much.
+    :return: Two (W, P, T) arrays, half-life by half-life in the given order and pair-major within a
+        half-life: the correlations and a mask of the correlations that are valid.
+    :raises ValueError: If a half-life is smaller than 1.
+    """
+    n_rows = len(values)
+    correlations = np.full((len(half_lives), len(left), n_rows), np.nan)
+    valid = np.zeros((len(half_lives), len(left), n_rows), dtype=bool)
+    required = np.asarray(half_lives)[:, None]
+    for t, (covariance, variance_left, variance_right, observations, _, _) in \
+            enumerate(_ewma_moments(values, left, right, half_lives)):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            correlations[:, :, t] = covariance / np.sqrt(variance_left * variance_right)
+        valid[:, :, t] = observations >= required
+
+    np.clip(correlations, -1.0, 1.0, out=correlations)
+    return correlations, valid
+
+
+def shrinkage_intensities(values: np.ndarray, half_lives: list[int]) -> np.ndarray:
+    """
+    Computes, for every row, the Ledoit-Wolf intensity with which the exponentially weighted correlation
+    matrix of all columns is shrunk towards the identity: the estimated sampling variance of the
+    correlations relative to their dispersion around the target, summed over the valid pairs (the
+    estimator of Schäfer and Strimmer for correlation matrices). The sampling variance of every pair comes
+    from the weighted fourth moment of its deviations and the effective number of its observations.
+    The shrunk correlation of a pair is its correlation times 1 minus the intensity. Runs the recurrence
+    of ewma_correlations over every pair, in O(N²) per row and memory independent of the history.
+    :param values: A (T, N) float matrix of returns, with NaN marking missing values.
+    :param half_lives: The half-lives in rows, after which a return weighs half as much.
+    :return: A (W, T) array of intensities between 0 and 1, NaN for the rows without any valid pair.
+    :raises ValueError: If a half-life is smaller than 1.
+    """
+    left, right = pair_indices(np.shape(values)[1])
+    decay = 0.5 ** (1.0 / np.asarray(half_lives, dtype=np.float64))[:, None]
+    required = np.asarray(half_lives)[:, None]
+    intensities = np.full((len(half_lives), len(values)), np.nan)
+    for t, (covariance, variance_left, variance_right, observations, fourth, weight) in \
+            enumerate(_ewma_moments(values, left, right, half_lives, fourth_moments=True)):
+        # After n updates the weights of the fourth moments sum to 1 - decay^n, from which follows the
+        # effective number of observations, the squared sum of the weights over the sum of their squares
+        effective = weight * (1.0 + decay) / ((1.0 - decay) * (2.0 - weight))
+        variances = variance_left * variance_right
+        pairs = (observations >= required) & (variances > 0)
+        if not pairs.any():
+            continue
+        with np.errstate(divide="ignore", invalid="ignore"):
+            squared = np.square(covariance) / variances
+            sampling = (fourth / (weight * variances) - squared) / effective
+        dispersion = squared.sum(axis=1, where=pairs)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            intensities[:, t] = np.where(pairs.any(axis=1), np.where(
+                dispersion > 0, sampling.sum(axis=1, where=pairs) / dispersion, 1.0), np.nan)
+    np.clip(intensities, 0.0, 1.0, out=intensities)
+    return intensities
+
+
+def _ewma_moments(values: np.ndarray, left: np.ndarray, right: np.ndarray, half_lives: list[int],
+                  fourth_moments: bool = False) -> Iterator[tuple[np.ndarray, ...]]:
+    """
+    Runs the exponentially weighted moment recurrence over the rows of the returns and yields the state
+    after every row. With d the deviation of a value from the running mean of its column and a the weight
+    of the newest row, the mean grows by a * d and a pair moment m becomes (1 - a) * (m + a * d_i * d_j),
+    the incremental form of the weighted central moments. A column starts its mean at its first value;
+    a pair is only updated on the rows in which both columns have a value.
+    :param values: A (T, N) float matrix of returns, with NaN marking missing values.
+    :param left: The left column index of every pair.
+    :param right: The right column index of every pair.
+    :param half_lives: The half-lives in rows.
+    :param fourth_moments: Whether to track the weighted sum of (d_i * d_j)² of every pair as well.
+    :return: Per row, the (W, P) covariances, variances of the left and of the right columns, the (P,)
+        number of updates of every pair, and the (W, P) fourth moments and sums of their weights, or
+        None. The arrays are updated in place by the next row.
+    :raises ValueError: If a half-life is smaller than 1.
+    """
+    if min(half_lives) < 1:
+        raise ValueError("The half-life must be at least 1.")
+    values = np.asarray(values, dtype=np.float64)
+    decay = 0.5 ** (1.0 / np.asarray(half_lives, dtype=np.float64))[:, None]
+    alpha = 1.0 - decay
+    mean = np.zeros((len(half_lives), values.shape[1]))
+    started = np.zeros(values.shape[1], dtype=bool)
+    covariance, variance_left, variance_right = (np.zeros((len(half_lives), len(left))) for _ in range(3))
+    fourth, weight = (np.zeros((len(half_lives), len(left))) if fourth_moments else None for _ in range(2))
+    observations = np.zeros(len(left), dtype=np.int64)
+
+    for row in values:
+        present = ~np.isnan(row)
+        first = present & ~started
+        mean[:, first] = row[first]
+        started |= present
+        deviation = np.where(present, row - mean, 0.0)
+        mean += alpha * deviation
+
+        deviation_left, deviation_right = deviation[:, left], deviation[:, right]
+        product = deviation_left * deviation_right
+        moments = [(covariance, product), (variance_left, np.square(deviation_left, out=deviation_left)),
+                   (variance_right, np.square(deviation_right, out=deviation_right))]
+        if present.all():
+            # Every pair is updated, in place
+            observations += 1
+            if fourth_moments:
+                # A weighted sum of the squared products, not a central moment, hence no (1 - a) factor
+                fourth *= decay
+                fourth += alpha * np.square(product)
+                weight *= decay
+                weight += alpha
+            for moment, update in moments:
+                update *= alpha
+                moment += update
+                moment *= decay
+        else:
+            joint = present[left] & present[right]
+            observations += joint
+            if fourth_moments:
+                np.copyto(fourth, decay * fourth + alpha * np.square(product), where=joint)
+                np.copyto(weight, decay * weight + alpha, where=joint)
+            for moment, update in moments:
+                np.copyto(moment, decay * (moment + alpha * update), where=joint)
+        yield covariance, variance_left, variance_right, observations, fourth, weight
+
+
+def _centered_columns(values: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Lays out the returns column-major, so every column and pair is a contiguous row and the outputs need
+    no transpose, and centers every column on its mean, which keeps the running sums small and the
+    cancellation error low.
+    :param values: A (T, N) float64 matrix of returns, with NaN marking missing values.
+    :return: The (N, T) centered returns with missing values set to 0, and the (N, T) missing value mask.
+    """
+    missing = np.isnan(values.T)
+    filled = np.where(missing, 0.0, values.T)
+    filled -= (filled.sum(axis=1) / np.maximum((~missing).sum(axis=1), 1))[:, None]
+    filled[missing] = 0.0
+    return filled, missing
+
+
+def _prefix_sum(values: np.ndarray) -> np.ndarray:
+    """
+    Returns the prefix sums along the rows of every column, with a leading zero so entry t holds the sum
+    of the first t values.
+    :param values: A (K, T) array.
+    :return: A (K, T + 1) array.
+    """
+    prefix = np.zeros((values.shape[0], values.shape[1] + 1), dtype=values.dtype)
+    np.cumsum(values, axis=1, out=prefix[:, 1:])
+    return prefix
+
+
+def top_k_correlations(values: np.ndarray, window_size: int, first_row: int, last_row: int, k: int,
+                       anchor: Optional[int] = None, block_size: int = 512,
+                       date_chunk_size: int = 64) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Finds the k most and k least correlated column pairs by their rolling correlation averaged over the
+    window end rows first_row..last_row (a single row for a screen as of one date). The columns of every
+    window are standardized, so the correlations of a block of columns against all columns are one matrix
+    product per chunk of window ends. Blocks are reduced with a partial selection (argpartition) before
+    the next one is computed, so memory stays at O(block_size * N) instead of O(N² T).
+    Windows that are not full, contain a missing value or have zero variance are skipped, so a pair is
+    averaged over the windows in which both columns are valid.
+    :param values: A (T, N) float matrix of returns, with NaN marking missing values.
+    :param window_size: The rolling window size.
+    :param first_row: The first window end row to average over.
+    :param last_row: The last window end row to average over, inclusive.
+    :param k: The number of most and of least correlated pairs to return.
+    :param anchor: Screen only the pairs of this column against every other column, instead of all pairs.
+    :param block_size: The number of columns correlated against all columns at once.
+    :param date_chunk_size: The number of window ends standardized at once.
+    :return: Two (k', 3) arrays of (left column, right column, correlation), the most correlated pairs
+        in descending and the least correlated pairs in ascending order of correlation. Columns are
+        returned as left < right, and k' is smaller than k when there are fewer valid pairs.
+    """
+    if window_size < 1:
+        raise ValueError("The window size must be at least 1.")
+    if k < 1:
+        raise ValueError("k must be at least 1.")
+    n_columns = values.shape[1]
+    first_row = max(first_row, window_size - 1)
+    ends = np.arange(first_row, last_row + 1)
+    most = np.empty((0, 3))
+    least = np.empty((0, 3))
+    blocks = [np.array([anchor])] if anchor is not None else \
+        [np.arange(start, min(start + block_size, n_columns)) for start in range(0, n_columns, block_size)]
+
+    for block in blocks:
+        sums = np.zeros((len(block), n_columns))
+        counts = np.zeros((len(block), n_columns))
+        for start in range(0, len(ends), date_chunk_size):
+            standardized, complete = _standardized_windows(values, ends[start:start + date_chunk_size], window_size)
+            sums += standardized[:, block].T @ standardized
+            counts += complete[:, block].T @ complete
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = np.clip(sums / counts, -1.0, 1.0)
+        # Every pair is screened once: against higher columns only, or against every other column for an anchor
+        mean[np.arange(n_columns)[None, :] <= block[:, None] if anchor is None else
+             np.arange(n_columns)[None, :] == block[:, None]] = np.nan
+        rows, columns = np.nonzero(~np.isnan(mean))
+        candidates = np.column_stack([
+            np.minimum(block[rows], columns), np.maximum(block[rows], columns), mean[rows, columns]
+        ])
+        most = _select(np.concatenate([most, candidates]), k, largest=True)
+        least = _select(np.concatenate([least, candidates]), k, largest=False)
+
+    return most[np.argsort(-most[:, 2], kind="stable")], least[np.argsort(least[:, 2], kind="stable")]
+
+
+def _standardized_windows(values: np.ndarray, ends: np.ndarray, window_size: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Standardizes the columns of the windows ending at the given rows, so the dot product of two columns
+    of a window is their Pearson correlation. Invalid windows of a column are zeroed.
+    :param values: A (T, N) float matrix of returns, with NaN marking missing values.
+    :param ends: The window end rows, each at least window_size - 1.
+    :param window_size: The rolling window size.
+    :return: The (len(ends) * window_size, N) standardized windows stacked row-wise, and a (len(ends), N)
+        float mask of the windows that are valid.
+    """
+    windows = values[ends[:, None] + np.arange(1 - window_size, 1)[None, :]].astype(np.float64)
+    raw_squares = (windows * windows).sum(axis=1, keepdims=True)
+    windows -= windows.mean(axis=1, keepdims=True)
+    sum_squares = (windows * windows).sum(axis=1, keepdims=True)
+    # NaN windows fail the comparison; rounding can leave a constant window with a tiny variance
+    complete = sum_squares > VARIANCE_TOLERANCE * raw_squares
+    with np.errstate(divide="ignore", invalid="ignore"):
+        windows /= np.sqrt(sum_squares)
+    windows[~np.broadcast_to(complete, windows.shape)] = 0.0
+    return windows.reshape(-1, values.shape[1]), complete[:, 0, :].astype(np.float64)
+
+
+def _select(candidates: np.ndarray, k: int, largest: bool) -> np.ndarray:
+    """
+    Keeps the k candidate pairs with the largest or smallest correlation, unordered.
+    :param candidates: A (P, 3) array of (left column, right column, correlation).
+    :param k: The number of pairs to keep.
+    :param largest: Whether to keep the largest correlations, otherwise the smallest.
+    :return: A (min(P, k), 3) array.
+    """
+    if len(candidates) <= k:
+        return candidates
+    keys = -candidates[:, 2] if largest else candidates[:, 2]
+    return candidates[np.argpartition(keys, k - 1)[:k]]
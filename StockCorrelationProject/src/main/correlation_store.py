@@ -0,0 +1,419 @@
+import argparse
+import fcntl
+import json
+import os
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+import polars as pl
+from polars import DataFrame, LazyFrame
+from polars.io import parquet
+
+from src.config.settings import CORRELATION_CACHE_PATH, CORRELATION_SCHEMA, ROLLING_WINDOW_SIZE, \
+    CORRELATION_STORE_PAIRS_PER_SEGMENT, CORRELATION_STORE_MIN_ROW_GROUP_ROWS, CORRELATION_STORE_COMPRESSION_LEVEL, \
+    STORAGE_MODE
+from src.main.instrumentation import span, file_bytes
+
+# Schema of the store index, one row per (pair, segment row group). Every entry records its row count,
+# its window size and the fingerprint of the returns it was computed from
+INDEX_SCHEMA = {'Name': pl.String,
+                'File': pl.String,
+                'RowGroup': pl.UInt32,
+                'StartDate': pl.Date,
+                'EndDate': pl.Date,
+                'Rows': pl.UInt32,
+                'Window': pl.UInt16,
+                'Fingerprint': pl.String
+                }
+
+
+class CorrelationStore:
+    """
+    Packs the correlation series of many pairs into large segment parquet files. Each segment is
+    sorted by Name and written with row groups aligned to pair boundaries, so the Name statistics
+    of every row group let a scan skip all pairs that were not asked for. An index maps every pair
+    to the (file, row group) locations holding its rows.
+    Several stores, e.g. one per Streamlit session, may share a directory: writers serialize on a lock
+    file and merge their segments into the index as it is on disk, and readers reload the index
+    whenever another writer has replaced it.
+    Entries are validated against the parquet footers of their segments when the index is loaded: the
+    entries of a segment that is missing, truncated or holds a different number of rows than recorded,
+    and entries of another window size, are dropped and their pairs are computed again.
+    Compact stores write the pairs of a segment that share one date axis without a Date column and with
+    float32 correlations; the axis is kept once in the metadata of the segment. Segments of both layouts
+    may share a store, so the mode can be changed without migrating the stored pairs.
+    """
+
+    def __init__(self, store_dir: Path, window_size: Optional[int] = None, storage_mode: str = STORAGE_MODE):
+        self.store_dir = store_dir
+        self.window_size = window_size
+        self.storage_mode = storage_mode
+        self._axes = {}
+        self.index_path = store_dir / "index.parquet"
+        self.lock_path = store_dir / ".lock"
+        self._index = None
+        self._index_mtime = None
+        self._names = None
+
+    def index(self) -> DataFrame:
+        """
+        Returns the pair index of the store, reloading it from disk whenever the index file changed.
+        :return: A Polars DataFrame matching INDEX_SCHEMA.
+        """
+        try:
+            stat = self.index_path.stat()
+            mtime = (stat.st_ino, stat.st_mtime_ns)
+        except FileNotFoundError:
+            mtime = None
+        if self._index is None or mtime != self._index_mtime:
+            if mtime is not None:
+                self._index = self._validate_index(pl.read_parquet(self.index_path))
+            else:
+                self._index = pl.DataFrame(schema=INDEX_SCHEMA)
+            self._index_mtime = mtime
+            self._names = None
+        return self._index
+
+    def names(self) -> set[str]:
+        """
+        Returns the names of all pairs held by the store.
+        :return: A set of correlation names (e.g., "AAPL-MSFT").
+        """
+        index = self.index()
+        if self._names is None:
+            self._names = set(index["Name"].unique().to_list())
+        return self._names
+
+    def read(self, names: Iterable[str]) -> LazyFrame:
+        """
+        Reads the correlations of a subset of pairs with a single scan over the segments that hold
+        them. The Name predicate is pushed down to the row group statistics.
+        :param names: The correlation names to read.
+        :return: A Polars LazyFrame matching CORRELATION_SCHEMA.
+        """
+        names = list(names)
+        files = sorted(self.index().filter(pl.col("Name").is_in(names))["File"].unique().to_list())
+        if not files:
+            return pl.DataFrame(schema=CORRELATION_SCHEMA).lazy()
+        with span("correlation_store.read", pairs=len(names), files=len(files)) as record:
+            # The scan is lazy: the size of the segments it may touch bounds the bytes it reads
+            record["segment_bytes"] = file_bytes(*(self.store_dir / file for file in files))
+            standard_files = [self.store_dir / file for file in files if self._date_axis(file) is None]
+            scans = [parquet.scan_parquet(standard_files).filter(pl.col("Name").is_in(names))] if standard_files else []
+            for file in files:
+                axis = self._date_axis(file)
+                if axis is not None:
+                    # Whole pairs are read in order, so the position of a row within its pair indexes the axis
+                    scans.append(
+                        parquet.scan_parquet(self.store_dir / file).filter(pl.col("Name").is_in(names))
+                        .with_columns(Date=pl.lit(axis).gather(pl.int_range(pl.len()).over("Name")))
+                        .select(Date=pl.col("Date"), Name=pl.col("Name"), Correlation=pl.col("Correlation").cast(pl.Float64))
+                    )
+            return pl.concat(scans)
+
+    def _date_axis(self, file: str) -> Optional[pl.Series]:
+        """
+        Returns the shared date axis of a compact segment, read once from the segment metadata.
+        Segment files are never modified, so the axis is cached for the lifetime of the store.
+        :param file: The file name of the segment.
+        :return: The dates of every pair of the segment, or None for a segment with a Date column.
+        """
+        if file not in self._axes:
+            axis = parquet.read_parquet_metadata(self.store_dir / file).get("dates")
+            self._axes[file] = None if axis is None else pl.Series("Date", json.loads(axis), dtype=pl.Int32).cast(pl.Date)
+        return self._axes[file]
+
+    def write(self, df: DataFrame, fingerprint: Optional[str] = None) -> list[str]:
+        """
+        Writes the correlations of many pairs as new segments and registers them in the index. Rows that
+        are not newer than the last stored date of their pair are dropped, so a pair computed twice, by
+        concurrent sessions or a repeated migration, is only stored once.
+        :param df: A Polars DataFrame matching CORRELATION_SCHEMA, with the rows of each pair in date order.
+        :param fingerprint: The fingerprint of the returns the correlations were computed from.
+        :return: The file names of the written segments.
+        """
+        with self._lock():
+            index = self.index()
+            df = df.join(self.end_dates(), on="Name", how="left").filter(
+                pl.col("EndDate").is_null() | (pl.col("Date") > pl.col("EndDate"))
+            ).drop("EndDate")
+            with span("correlation_store.write", rows=df.height) as record:
+                segments, new_index = self._write_segments(df)
+                record["segments"] = len(segments)
+                record["bytes_written"] = file_bytes(*(self.store_dir / segment for segment in segments))
+            if segments:
+                new_index = new_index.with_columns(Fingerprint=pl.lit(fingerprint, dtype=pl.String))
+                self._write_index(pl.concat([index, new_index]))
+        return segments
+
+    def segment_count(self) -> int:
+        """
+        Returns the number of segment files referenced by the index.
+        :return: The number of segments.
+        """
+        return self.index()["File"].n_unique()
+
+    def end_dates(self) -> DataFrame:
+        """
+        Returns the last stored date of every pair, read from the index without touching the segments.
+        :return: A Polars DataFrame with the Name and EndDate columns.
+        """
+        return self.index().group_by("Name").agg(pl.col("EndDate").max())
+
+    def compact(self):
+        """
+        Rewrites all segments into freshly packed segments, merging the segments that incremental
+        appends leave behind into one contiguous series per pair. Pairs are rewritten in batches of
+        CORRELATION_STORE_PAIRS_PER_SEGMENT, so only one batch is held in memory at a time. Frames
+        scanned from the old segments must be collected before compacting.
+        """
+        with self._lock():
+            old_index = self.index()
+            old_files = old_index["File"].unique().to_list()
+            if not old_files:
+                return
+            names = sorted(old_index["Name"].unique().to_list())
+            # A compacted pair reflects the returns its newest rows were computed from
+            fingerprints = old_index.sort("EndDate").group_by("Name").agg(pl.col("Fingerprint").last())
+            index_rows = []
+            for start in range(0, len(names), CORRELATION_STORE_PAIRS_PER_SEGMENT):
+                batch = self.read(names[start:start + CORRELATION_STORE_PAIRS_PER_SEGMENT]).collect()
+                _, index = self._write_segments(batch.sort("Name", "Date"))
+                index_rows.append(index.join(fingerprints, on="Name", how="left"))
+            self._write_index(pl.concat(index_rows))
+            for file in old_files:
+                (self.store_dir / file).unlink(missing_ok=True)
+
+    def _write_segments(self, df: DataFrame) -> tuple[list[str], DataFrame]:
+        """
+        Writes the correlations of many pairs as new segment files without registering them. Pairs are
+        grouped by series length, and in a compact store by first date as well, so every row group holds
+        whole pairs and the pairs of a segment share their dates. Batches that are already laid out pair
+        by pair in name order with equal lengths (and first dates) are sliced without being re-sorted.
+        :param df: A Polars DataFrame matching CORRELATION_SCHEMA, with the rows of each pair in date order.
+        :return: The file names of the written segments and their index rows, without a Fingerprint.
+        """
+        if df.is_empty():
+            return [], pl.DataFrame(schema=INDEX_SCHEMA)
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        df = df.select(CORRELATION_SCHEMA.keys())
+        compact = self.storage_mode == "compact"
+        keys = ["len", "start"] if compact else ["len"]
+        runs = self._runs(df)
+        if not (runs["value"].is_sorted() and runs["value"].is_unique().all() and runs.n_unique(keys) == 1):
+            df = df.with_columns(Rows=pl.len().over("Name"), Start=pl.col("Date").first().over("Name")) \
+                .sort(["Rows", "Start", "Name"] if compact else ["Rows", "Name"], maintain_order=True) \
+                .drop("Rows", "Start")
+            runs = self._runs(df)
+
+        segments = []
+        index_rows = []
+        offset = 0
+        for (n_rows, *_), group in runs.group_by(keys, maintain_order=True):
+            names = group["value"].to_list()
+            for start in range(0, len(names), CORRELATION_STORE_PAIRS_PER_SEGMENT):
+                segment_names = names[start:start + CORRELATION_STORE_PAIRS_PER_SEGMENT]
+                segment = df.slice(offset, len(segment_names) * n_rows)
+                file, index = self._write_segment(segment, segment_names, n_rows)
+                segments.append(file)
+                index_rows.append(index)
+                offset += segment.height
+        return segments, pl.concat(index_rows)
+
+    def _runs(self, df: DataFrame) -> DataFrame:
+        """
+        Lists the runs of consecutive rows of the same pair.
+        :param df: A Polars DataFrame matching CORRELATION_SCHEMA.
+        :return: A DataFrame with the name (value), the row count (len) and the first date (start) of every run.
+        """
+        runs = df["Name"].rle().struct.unnest()
+        return runs.with_columns(start=df["Date"].gather(runs["len"].cum_sum() - runs["len"]))
+
+    def _write_segment(self, segment: DataFrame, names: list[str], n_rows: int) -> tuple[str, DataFrame]:
+        """
+        Writes one segment file, packing as many whole pairs into each row group as needed to reach
+        CORRELATION_STORE_MIN_ROW_GROUP_ROWS. In a compact store, a segment whose pairs all have the same
+        dates is written without its Date column and with float32 correlations.
+        :param segment: The rows of the segment, laid out pair by pair in name order.
+        :param names: The sorted names of the pairs in the segment.
+        :param n_rows: The number of rows of every pair in the segment.
+        :return: The file name of the segment and its index rows.
+        """
+        pairs_per_group = max(1, CORRELATION_STORE_MIN_ROW_GROUP_ROWS // n_rows)
+        file = f"part-{uuid.uuid4().hex}.parquet"
+        temp_path = self.store_dir / f"{file}.tmp"
+        axis = segment["Date"].head(n_rows)
+        metadata = None
+        if self.storage_mode == "compact" and segment["Date"].equals(pl.concat([axis] * len(names))):
+            metadata = {"dates": json.dumps(axis.to_physical().to_list())}
+            self._axes[file] = axis
+            written = segment.select("Name", pl.col("Correlation").cast(pl.Float32))
+        else:
+            self._axes[file] = None
+            written = segment
+        written.write_parquet(temp_path, row_group_size=pairs_per_group * n_rows, metadata=metadata,
+                              compression_level=CORRELATION_STORE_COMPRESSION_LEVEL,
+                              statistics=True)
+        os.replace(temp_path, self.store_dir / file)
+
+        first_rows = pl.Series(range(0, len(names) * n_rows, n_rows))
+        index = pl.DataFrame({
+            "Name": names,
+            "File": [file] * len(names),
+            "RowGroup": [i // pairs_per_group for i in range(len(names))],
+            "StartDate": segment["Date"].gather(first_rows),
+            "EndDate": segment["Date"].gather(first_rows + n_rows - 1),
+            "Rows": [n_rows] * len(names),
+            "Window": [self.window_size] * len(names),
+        }).cast({column: dtype for column, dtype in INDEX_SCHEMA.items() if column != "Fingerprint"})
+        return file, index
+
+    def _validate_index(self, index: DataFrame) -> DataFrame:
+        """
+        Drops the index entries that cannot be served: entries of another window size, and all entries of
+        a segment whose parquet footer cannot be read or does not hold the rows the index recorded. Only
+        the footers are read. Indexes written before entries carried metadata are upgraded with nulls,
+        which skip the checks they cannot make.
+        :param index: The index as read from disk.
+        :return: The valid entries, matching INDEX_SCHEMA.
+        """
+        index = index.with_columns(
+            pl.lit(None, dtype=dtype).alias(column) for column, dtype in INDEX_SCHEMA.items() if column not in index.columns
+        ).select(INDEX_SCHEMA.keys())
+        if self.window_size is not None:
+            index = index.filter(pl.col("Window").is_null() | (pl.col("Window") == self.window_size))
+
+        invalid_files = []
+        expected_rows = index.group_by("File").agg(pl.col("Rows").sum(), Unknown=pl.col("Rows").is_null().any())
+        for file, rows, unknown in expected_rows.iter_rows():
+            try:
+                stored_rows = parquet.scan_parquet(self.store_dir / file).select(pl.len()).collect().item()
+            except (OSError, pl.exceptions.PolarsError):
+                invalid_files.append(file)
+                continue
+            if not unknown and stored_rows != rows:
+                invalid_files.append(file)
+        return index.filter(~pl.col("File").is_in(invalid_files))
+
+    def _write_index(self, index: DataFrame):
+        """
+        Atomically replaces the index of the store. Must be called while holding the store lock.
+        :param index: The new index, matching INDEX_SCHEMA.
+        """
+        temp_path = self.index_path.with_suffix(".parquet.tmp")
+        index.write_parquet(temp_path)
+        os.replace(temp_path, self.index_path)
+        self._index = None
+
+    @contextmanager
+    def _lock(self) -> Iterator[None]:
+        """
+        Holds the exclusive lock of the store directory, serializing the writers that share it.
+        """
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        with open(self.lock_path, "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def migrate_per_pair_cache(source_dir: Path, store: CorrelationStore, batch_size: int = 10000,
+                           delete: bool = False) -> int:
+    """
+    Migrates the legacy cache layout, one "<ticker1>-<ticker2>.parquet" file per pair, into a
+    correlation store. Files with an invalid schema are skipped, and pairs the store already holds
+    are not written again, so the migration can be rerun safely.
+    :param source_dir: The directory holding the per-pair parquet files.
+    :param store: The store to migrate into.
+    :param batch_size: The number of pair files packed per write.
+    :param delete: Whether to delete the legacy files whose pair is held by the store afterwards.
+    :return: The number of migrated pairs.
+    """
+    paths = sorted(source_dir.glob("*.parquet"))
+    migrated = 0
+    for start in range(0, len(paths), batch_size):
+        frames = []
+        stored_paths = []
+        stored_names = store.names()
+        for path in paths[start:start + batch_size]:
+            if path.stem in stored_names:
+                stored_paths.append(path)
+                continue
+            frame = pl.read_parquet(path)
+            if _has_correlation_schema(frame):
+                frames.append(frame.select(CORRELATION_SCHEMA.keys()))
+                stored_paths.append(path)
+        if frames:
+            store.write(pl.concat(frames))
+            migrated += len(frames)
+        if delete:
+            for path in stored_paths:
+                path.unlink()
+    return migrated
+
+
+def _has_correlation_schema(df: DataFrame) -> bool:
+    """
+    Checks that the DataFrame contains the CORRELATION_SCHEMA columns with the expected types.
+    :param df: The DataFrame to check.
+    :return: True if the schema matches, False otherwise.
+    """
+    return all(column in df.schema and df.schema[column] == dtype for column, dtype in CORRELATION_SCHEMA.items())
+
+
+def store_path(cache_dir: Path, window_size: int, min_observations: Optional[int] = None,
+               estimator: str = "rolling") -> Path:
+    """
+    Returns the directory of the correlation store for a rolling window size. Pairwise-complete
+    correlations and the correlations of the exponentially weighted estimators are stored apart.
+    :param cache_dir: The correlation cache directory.
+    :param window_size: The rolling window size, or the half-life of an exponentially weighted estimator.
+    :param min_observations: The minimum number of observations of pairwise-complete windows, or None for
+        windows without missing values.
+    :param estimator: The estimator of the correlations, see CORRELATION_ESTIMATOR.
+    :return: The store directory.
+    """
+    return _mode_dir(cache_dir, min_observations, estimator) / f"window={window_size}"
+
+
+def stored_windows(cache_dir: Path, min_observations: Optional[int] = None, estimator: str = "rolling") -> list[int]:
+    """
+    Returns the rolling window sizes that have a correlation store in the cache directory.
+    :param cache_dir: The correlation cache directory.
+    :param min_observations: The minimum number of observations of pairwise-complete windows, or None for
+        windows without missing values.
+    :param estimator: The estimator of the correlations, see CORRELATION_ESTIMATOR.
+    :return: The window sizes, in ascending order.
+    """
+    return sorted(int(path.name.split("=")[1])
+                  for path in _mode_dir(cache_dir, min_observations, estimator).glob("window=*") if path.is_dir())
+
+
+def _mode_dir(cache_dir: Path, min_observations: Optional[int], estimator: str = "rolling") -> Path:
+    """
+    Returns the directory holding the window stores of an estimator and missing value mode.
+    :param cache_dir: The correlation cache directory.
+    :param min_observations: The minimum number of observations of pairwise-complete windows, or None.
+    :param estimator: The estimator of the correlations; only rolling windows have a missing value mode.
+    :return: The directory of the mode.
+    """
+    if estimator != "rolling":
+        return cache_dir / f"estimator={estimator}"
+    return cache_dir if min_observations is None else cache_dir / f"min_observations={min_observations}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate the per-pair correlation cache into a correlation store.")
+    parser.add_argument("--source", type=Path, default=CORRELATION_CACHE_PATH,
+                        help="Directory holding the legacy per-pair parquet files.")
+    parser.add_argument("--window", type=int, default=ROLLING_WINDOW_SIZE,
+                        help="Rolling window size the legacy files were computed with.")
+    parser.add_argument("--delete", action="store_true", help="Delete the migrated legacy files.")
+    args = parser.parse_args()
+
+    target = CorrelationStore(store_path(CORRELATION_CACHE_PATH, args.window), args.window)
+    print(f"Migrated {migrate_per_pair_cache(args.source, target, delete=args.delete)} pairs into {target.store_dir}")
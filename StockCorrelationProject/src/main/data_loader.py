@@ -1,15 +1,52 @@
+import hashlib
+import multiprocessing
 import os
-from zipfile import ZipFile, BadZipFile, Path
+import tempfile
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, Optional
+from zipfile import ZipFile, BadZipFile
 
 import polars as pl
-from polars import LazyFrame
+from polars import DataFrame, LazyFrame
 
-from src.config.settings import CSV_SCHEMA
+from src.config.settings import CSV_SCHEMA, INGEST_STAGING_PATH, INGEST_WORKERS, INGEST_EXECUTOR, \
+    INGEST_MEMBERS_PER_PART, DATE_FORMATS, DATE_SAMPLE_SIZE
+from src.main.instrumentation import span
 
 
-def load_from_zip(zip_file_path: str) -> LazyFrame:
+class AmbiguousDateFormatWarning(UserWarning):
+    """Raised when the dates of a CSV file parse under more than one format, e.g. %m/%d/%Y and %d/%m/%Y."""
+
+
+@dataclass
+class IngestStats:
+    """Throughput of a parallel zip ingestion, and the run directory holding its staged parts."""
+    files: int
+    rows: int
+    bytes_read: int
+    seconds: float
+    run_dir: Path
+    ambiguous_files: list[str]
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+    @property
+    def mb_per_second(self) -> float:
+        return self.bytes_read / 1e6 / self.seconds if self.seconds else 0.0
+
+
+def load_from_zip(zip_file_path: str, members: Optional[Iterable[str]] = None) -> LazyFrame:
     """
     Uses ZipFile and Polars to efficiently read CSV files within the zip file without extracting them.
+    :param zip_file_path: The path to the zip file.
+    :param members: The names of the CSV members to read. Defaults to every CSV member.
+    The date format of every file is detected once and the file is parsed with it, see parse_file_dates.
     :return: A Polars LazyFrame with the following structure:
         - Ticker (str): The stock ticker symbol.
         - Date (date): The date of the record.
@@ -19,18 +56,117 @@ def load_from_zip(zip_file_path: str) -> LazyFrame:
     """
     if not os.path.exists(zip_file_path):
         raise FileNotFoundError(f"Zip file not found: {zip_file_path}")
+    try:
+        with span("load_from_zip") as record, ZipFile(zip_file_path) as zip_file:
+            files = [file for file in zip_file.namelist() if file.endswith('.csv')] if members is None else list(members)
+            record["files"] = len(files)
+            if not files:
+                return pl.DataFrame(schema=CSV_SCHEMA).lazy().pipe(parse_date)
+            with span("load_from_zip.decompress") as decompress:
+                lazy_frames = [read_file(zip_file, file) for file in files]
+                decompress["bytes_read"] = sum(zip_file.getinfo(file).compress_size for file in files)
+                decompress["bytes_decompressed"] = sum(zip_file.getinfo(file).file_size for file in files)
+            with span("load_from_zip.read_csv") as read_csv:
+                frames = pl.collect_all(lazy_frames)
+                read_csv["rows"] = sum(frame.height for frame in frames)
+            with span("load_from_zip.parse_dates") as parse_dates:
+                parsed = [parse_file_dates(frame, file) for frame, file in zip(frames, files)]
+                prices = pl.concat([frame for frame, _ in parsed])
+                parse_dates["rows"] = prices.height
+                # Files mixing date formats go through the slower parse_date coalesce
+                parse_dates["coalesce_files"] = sum(date_format.format is None for _, date_format in parsed)
+            return prices.lazy()
+    except BadZipFile:
+        raise BadZipFile(f"Invalid or corrupted zip file: {zip_file_path}")
+
+
+def ingest_zip(zip_file_path: str, staging_dir: Path = INGEST_STAGING_PATH, workers: int = INGEST_WORKERS,
+               executor: str = INGEST_EXECUTOR, members: Optional[Iterable[str]] = None) -> tuple[LazyFrame, IngestStats]:
+    """
+    Decompresses and parses the CSV members of the zip file in a pool of workers, streaming the parsed
+    prices into parquet parts in a run directory of its own under the staging directory. At most two
+    batches of INGEST_MEMBERS_PER_PART members per worker are in flight, so peak memory is bounded
+    regardless of the archive size. The caller owns the run directory and removes it once the returned
+    frame has been collected.
+    :param zip_file_path: The path to the zip file.
+    :param staging_dir: The directory the run directories are created in.
+    :param workers: The number of workers.
+    :param executor: "thread" or "process". Processes are spawned, since forking after the Polars thread
+        pool has started can deadlock the workers.
+    :param members: The names of the CSV members to ingest. Defaults to every CSV member.
+    :return: A Polars LazyFrame over the staged prices, with the same structure as load_from_zip, and
+        the throughput of the ingestion.
+    :raises FileNotFoundError: If the zip file does not exist.
+    :raises BadZipFile: If the zip file is invalid or corrupted.
+    """
+    if not os.path.exists(zip_file_path):
+        raise FileNotFoundError(f"Zip file not found: {zip_file_path}")
+    if executor not in ("thread", "process"):
+        raise ValueError(f"Unknown executor: {executor}")
     try:
         with ZipFile(zip_file_path) as zip_file:
-            return (
-                pl.concat(
-                    (read_file(zip_file, file) for file in zip_file.namelist() if file.endswith('.csv')),
-                    parallel=True
-                )
-                .pipe(parse_date)
-            )
+            if members is None:
+                members = [file for file in zip_file.namelist() if file.endswith('.csv')]
+            members = list(members)
     except BadZipFile:
         raise BadZipFile(f"Invalid or corrupted zip file: {zip_file_path}")
 
+    staging_dir.mkdir(parents=True, exist_ok=True)
+    run_dir = Path(tempfile.mkdtemp(prefix="ingest-", dir=staging_dir))
+    batches = [members[i:i + INGEST_MEMBERS_PER_PART] for i in range(0, len(members), INGEST_MEMBERS_PER_PART)]
+    if executor == "thread":
+        pool = ThreadPoolExecutor(max_workers=workers)
+    else:
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    rows = bytes_read = 0
+    ambiguous_files = []
+    start = time.perf_counter()
+    with pool:
+        pending = set()
+        for part, batch in enumerate(batches):
+            if len(pending) >= 2 * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    batch_rows, batch_bytes, batch_ambiguous = future.result()
+                    rows, bytes_read = rows + batch_rows, bytes_read + batch_bytes
+                    ambiguous_files += batch_ambiguous
+            pending.add(pool.submit(stage_members, zip_file_path, batch, run_dir / f"part-{part:06d}.parquet"))
+        for future in pending:
+            batch_rows, batch_bytes, batch_ambiguous = future.result()
+            rows, bytes_read = rows + batch_rows, bytes_read + batch_bytes
+            ambiguous_files += batch_ambiguous
+
+    stats = IngestStats(files=len(members), rows=rows, bytes_read=bytes_read, seconds=time.perf_counter() - start,
+                        run_dir=run_dir, ambiguous_files=sorted(ambiguous_files))
+    if not batches:
+        return pl.DataFrame(schema=CSV_SCHEMA).lazy().pipe(parse_date), stats
+    return pl.scan_parquet(run_dir / "part-*.parquet"), stats
+
+
+def stage_members(zip_file_path: str, members: list[str], part_path: Path) -> tuple[int, int, list[str]]:
+    """
+    Worker task of ingest_zip: decompresses and parses a batch of CSV members and writes them to one
+    parquet part. The archive is opened by the worker itself so the task can run in another process.
+    :param zip_file_path: The path to the zip file.
+    :param members: The names of the CSV members to stage.
+    :param part_path: The path of the parquet part to write.
+    :return: The number of rows staged, the number of uncompressed bytes read and the members whose date
+        format is ambiguous.
+    """
+    with ZipFile(zip_file_path) as zip_file:
+        frames = pl.collect_all([read_file(zip_file, member) for member in members])
+        bytes_read = sum(zip_file.getinfo(member).file_size for member in members)
+    with warnings.catch_warnings():
+        # Ambiguous members are reported through IngestStats, from any worker process
+        warnings.simplefilter("ignore", AmbiguousDateFormatWarning)
+        parsed = [parse_file_dates(frame, member) for frame, member in zip(frames, members)]
+    prices = pl.concat([frame for frame, _ in parsed])
+    ambiguous = [member for member, (_, date_format) in zip(members, parsed) if date_format.ambiguous]
+    temp_path = part_path.with_suffix(".parquet.tmp")
+    prices.write_parquet(temp_path)
+    os.replace(temp_path, part_path)
+    return prices.height, bytes_read, ambiguous
+
 
 def read_file(zip_file: ZipFile, file: str) -> LazyFrame:
     """
@@ -41,8 +177,9 @@ def read_file(zip_file: ZipFile, file: str) -> LazyFrame:
     :raises ValueError: If the CSV schema does not match the expected schema.
     """
     try:
+        # Read the member into memory so the frame does not outlive the archive's file handle
         return pl.scan_csv(
-            zip_file.open(file),
+            zip_file.read(file),
             has_header=True,
             try_parse_dates=False,
             schema_overrides=CSV_SCHEMA
@@ -52,17 +189,111 @@ def read_file(zip_file: ZipFile, file: str) -> LazyFrame:
 
 def parse_date(lf: LazyFrame) -> LazyFrame:
     """
-    Parses the 'Date' column in various formats and returns a LazyFrame with the parsed dates.
+    Parses the 'Date' column in various formats and returns a LazyFrame with the parsed dates. Every row is
+    tried against all DATE_FORMATS, so this is the fallback for columns that mix formats; files are parsed
+    with their detected format by parse_file_dates.
     :param lf: The LazyFrame containing the 'Date' column to be parsed.
     :return: A LazyFrame with the 'Date' column parsed into a date format.
     """
     return lf.with_columns(
         pl.coalesce(
-            pl.col("Date").str.strptime(pl.Date, "%m/%d/%Y", strict=False),
-            pl.col("Date").str.strptime(pl.Date, "%d/%m/%Y", strict=False),
-            pl.col("Date").str.strptime(pl.Date, "%Y/%m/%d", strict=False),
-            pl.col("Date").str.strptime(pl.Date, "%m-%d-%Y", strict=False),
-            pl.col("Date").str.strptime(pl.Date, "%d-%m-%Y", strict=False),
-            pl.col("Date").str.strptime(pl.Date, "%Y-%m-%d", strict=False),
+            *(pl.col("Date").str.strptime(pl.Date, date_format, strict=False) for date_format in DATE_FORMATS)
         ).cast(pl.Date).alias("Date")
     )
+
+
+@dataclass
+class DateFormat:
+    """The date format detected for a CSV file, None if the file mixes formats."""
+    format: Optional[str]
+    ambiguous: bool
+
+
+def date_format_candidates(dates: pl.Series, sample_size: int = DATE_SAMPLE_SIZE) -> list[str]:
+    """
+    Returns the DATE_FORMATS that parse every value of an evenly spaced sample of the dates.
+    :param dates: A string Series of dates.
+    :param sample_size: The number of dates to sample.
+    :return: The candidate formats, in DATE_FORMATS order.
+    """
+    dates = dates.drop_nulls()
+    sample = dates.gather_every(max(1, len(dates) // sample_size))
+    return [
+        date_format for date_format in DATE_FORMATS
+        if sample.str.strptime(pl.Date, date_format, strict=False).null_count() == 0
+    ]
+
+
+def parse_file_dates(df: DataFrame, file: str) -> tuple[DataFrame, DateFormat]:
+    """
+    Parses the 'Date' column of one CSV file with a single format. The candidate formats are detected on
+    a sample and validated on the full column, which stops at the first format that parses every date,
+    unless the sample left several candidates: then the next candidates are validated as well, and a
+    file whose dates parse under more than one format, e.g. only days up to 12 in %m/%d/%Y and %d/%m/%Y,
+    is resolved in DATE_FORMATS order with an AmbiguousDateFormatWarning. A file for which no single
+    format validates mixes formats and falls back to parse_date.
+    :param df: The DataFrame read from the CSV file, with the 'Date' column as strings.
+    :param file: The name of the file, used in the warning.
+    :return: The DataFrame with the parsed 'Date' column and the detected format.
+    """
+    dates = df["Date"]
+    parsed = None
+    valid_formats = []
+    for date_format in date_format_candidates(dates):
+        attempt = dates.str.strptime(pl.Date, date_format, strict=False)
+        if attempt.null_count() == dates.null_count():
+            valid_formats.append(date_format)
+            if parsed is None:
+                parsed = attempt
+            else:
+                break
+
+    if parsed is None:
+        return df.lazy().pipe(parse_date).collect(), DateFormat(format=None, ambiguous=False)
+    if len(valid_formats) > 1:
+        warnings.warn(f"Ambiguous date format in '{file}': {' or '.join(valid_formats)}, using {valid_formats[0]}",
+                      AmbiguousDateFormatWarning)
+    return df.with_columns(parsed.alias("Date")), DateFormat(format=valid_formats[0], ambiguous=len(valid_formats) > 1)
+
+
+def zip_members(zip_file_path: str) -> dict[str, list[int]]:
+    """
+    Lists the CSV members of the zip archive from its central directory, without decompressing them.
+    :param zip_file_path: The path to the zip file.
+    :return: The [size, CRC] of every CSV member, keyed by member name.
+    :raises FileNotFoundError: If the zip file does not exist.
+    :raises BadZipFile: If the zip file is invalid or corrupted.
+    """
+    if not os.path.exists(zip_file_path):
+        raise FileNotFoundError(f"Zip file not found: {zip_file_path}")
+    with ZipFile(zip_file_path) as zip_file:
+        return {
+            info.filename: [info.file_size, info.CRC]
+            for info in sorted(zip_file.infolist(), key=lambda info: info.filename)
+            if info.filename.endswith('.csv')
+        }
+
+
+def zip_fingerprint(zip_file_path: str) -> str:
+    """
+    Computes a fingerprint of the zip archive from its central directory (entry names, sizes and CRCs),
+    so a change in any CSV member is detected without decompressing the archive.
+    :param zip_file_path: The path to the zip file.
+    :return: A hex digest identifying the contents of the zip file.
+    :raises FileNotFoundError: If the zip file does not exist.
+    :raises BadZipFile: If the zip file is invalid or corrupted.
+    """
+    return members_fingerprint(zip_members(zip_file_path))
+
+
+def members_fingerprint(members: dict[str, list[int]]) -> str:
+    """
+    Computes the fingerprint of a zip archive from its member listing, as returned by zip_members.
+    :param members: The [size, CRC] of every CSV member, keyed by member name.
+    :return: A hex digest identifying the contents of the zip file.
+    """
+    digest = hashlib.sha256()
+    for name in sorted(members):
+        size, crc = members[name]
+        digest.update(f"{name}:{size}:{crc}\n".encode())
+    return digest.hexdigest()
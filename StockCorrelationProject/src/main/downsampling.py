@@ -0,0 +1,38 @@
+import polars as pl
+from polars import LazyFrame
+
+
+def min_max_downsample(lf: LazyFrame, max_points: int, group: str = "Name", x: str = "Date",
+                       y: str = "Correlation") -> LazyFrame:
+    """
+    Downsamples every series of a long frame to about max_points rows. The x range of the whole frame is
+    split into max_points // 2 buckets, one per pixel column of a chart, and the minimum and the maximum
+    of y in every bucket of every series are kept, so the extremes of the series survive and a line
+    chart of the result looks like the full series. A bucket without any value keeps its first row, so
+    gaps stay visible. Runs inside Polars with one aggregation and one join, without sorting.
+    :param lf: A LazyFrame in long format, one row per (group, x), with a temporal or integer x column.
+    :param max_points: The number of rows per series to aim for, at least 2. Ties of the minimum or the
+        maximum within a bucket are all kept.
+    :param group: The column identifying a series.
+    :param x: The column the series are ordered by.
+    :param y: The column whose extremes are kept.
+    :return: A LazyFrame with the same columns and rows in their original order.
+    """
+    if max_points < 2:
+        raise ValueError("At least two points per series are required.")
+    buckets = max_points // 2
+    position = pl.col(x).to_physical()
+    bucket = (position - position.min()) * buckets // (position.max() - position.min() + 1)
+    # A single integer key groups faster than (group, bucket). Two series only share a key if their hashes
+    # differ in the low bits alone, which at worst drops the points of one series in that bucket
+    lf = lf.with_columns(Bucket=pl.col(group).hash() ^ bucket.cast(pl.UInt64))
+    extremes = lf.group_by("Bucket").agg(Min=pl.col(y).min(), Max=pl.col(y).max(), First=position.min())
+    return (
+        lf.join(extremes, on="Bucket", maintain_order="left")
+        .filter(
+            (pl.col(y) == pl.col("Min"))
+            | (pl.col(y) == pl.col("Max"))
+            | (pl.col("Min").is_null() & (position == pl.col("First")))
+        )
+        .drop("Bucket", "Min", "Max", "First")
+    )
@@ -0,0 +1,87 @@
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+from polars import DataFrame, LazyFrame
+
+from src.config.settings import INSTRUMENTATION_ENABLED, INSTRUMENTATION_LOG_PATH, INSTRUMENTATION_QUERY_PLANS
+
+# Ids of the spans open in the current thread, innermost last
+_stack = threading.local()
+_write_lock = threading.Lock()
+
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[dict]:
+    """
+    Times a block of a hot path and appends it to the instrumentation log as one JSON line, with the
+    attributes it was opened with and the counters the block adds to the yielded record, e.g. rows,
+    bytes_read, bytes_written, cache_hits or cache_misses. Spans opened inside the block record it as
+    their parent. Does nothing but yield a throwaway record when INSTRUMENTATION_ENABLED is off.
+    :param name: The name of the span, e.g. "returns.pivot".
+    :param attributes: Attributes of the span known when it is opened.
+    :return: The record of the span, to be filled by the block.
+    """
+    if not INSTRUMENTATION_ENABLED:
+        yield {}
+        return
+    stack = _stack.__dict__.setdefault("ids", [])
+    record = {"span": name, "id": uuid.uuid4().hex[:16], "parent": stack[-1] if stack else None,
+              "pid": os.getpid(), "thread": threading.get_ident(), "start": time.time(), **attributes}
+    stack.append(record["id"])
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException as e:
+        record["error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        record["seconds"] = time.perf_counter() - start
+        stack.pop()
+        _write(record)
+
+
+def instrumented_collect(lf: LazyFrame, name: str, **attributes) -> DataFrame:
+    """
+    Collects a LazyFrame inside a span recording the number of rows it produced. With
+    INSTRUMENTATION_QUERY_PLANS on, the span records the optimized query plan as well.
+    :param lf: The LazyFrame to collect.
+    :param name: The name of the span.
+    :param attributes: Attributes of the span.
+    :return: The collected DataFrame.
+    """
+    with span(name, **attributes) as record:
+        if INSTRUMENTATION_ENABLED and INSTRUMENTATION_QUERY_PLANS:
+            record["plan"] = lf.explain()
+        df = lf.collect()
+        record["rows"] = df.height
+        return df
+
+
+def file_bytes(*paths: Path) -> int:
+    """
+    Returns the total size of files that exist, for the byte counters of spans.
+    :param paths: The file paths.
+    :return: The size in bytes, 0 when instrumentation is off.
+    """
+    if not INSTRUMENTATION_ENABLED:
+        return 0
+    return sum(path.stat().st_size for path in paths if path.exists())
+
+
+def _write(record: dict):
+    """
+    Appends a record to the instrumentation log. Every record is written with a single append, so the
+    lines of concurrent threads and processes do not interleave.
+    :param record: The record of a finished span.
+    """
+    line = json.dumps(record, default=str) + "\n"
+    with _write_lock:
+        INSTRUMENTATION_LOG_PATH.parent.mkdir(parents=True, exist_ok=True)
+        with open(INSTRUMENTATION_LOG_PATH, "a") as log_file:
+            log_file.write(line)
@@ -0,0 +1,165 @@
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Callable, Optional
+
+import numpy as np
+
+from src.config.settings import ZIP_FILE_PATH, ROLLING_WINDOW_SIZE, CORRELATION_CACHE_PATH, RETURNS_CACHE_PATH, \
+    PRECOMPUTE_WORKERS, PRECOMPUTE_SHARD_PAIRS, CORRELATION_STORE_MAX_SEGMENTS, CORRELATION_MIN_OBSERVATIONS, \
+    CORRELATION_ESTIMATOR
+from src.main.correlation_engine import CorrelationEngine
+from src.main.correlation_kernel import pair_indices
+from src.main.correlation_store import CorrelationStore, store_path
+from src.main.returns_engine import ReturnEngine
+from src.main.returns_matrix import ReturnsMatrix
+
+# State of a precompute worker process, set once by _init_worker
+_worker = {}
+
+
+def precompute(zip_file_path: str = ZIP_FILE_PATH, window_size: int = ROLLING_WINDOW_SIZE,
+               workers: int = PRECOMPUTE_WORKERS, shard_pairs: int = PRECOMPUTE_SHARD_PAIRS,
+               cache_dir: Path = CORRELATION_CACHE_PATH, returns_cache_dir: Path = RETURNS_CACHE_PATH,
+               restart: bool = False, progress: Optional[Callable[[str], None]] = print) -> dict:
+    """
+    Precomputes the correlations of every ticker pair of the universe into the correlation store. The
+    pair space is split into shards of shard_pairs pairs that are computed by a pool of spawned worker
+    processes, each mapping the shared returns matrix and writing its shard to the store atomically.
+    A job manifest in the store directory records the finished shards, so a run that was killed
+    resumes with the missing shards only. The manifest is discarded when the returns or the shard
+    layout changed since it was written.
+    :param zip_file_path: The path to the source zip file.
+    :param window_size: The rolling window size, or the half-life of the exponentially weighted estimators.
+    :param workers: The number of worker processes.
+    :param shard_pairs: The number of pairs per shard.
+    :param cache_dir: The correlation cache directory.
+    :param returns_cache_dir: The returns cache directory holding the returns matrix.
+    :param restart: Whether to discard the manifest and recompute every shard.
+    :param progress: Called with a progress line after every shard, or None to stay silent.
+    :return: A dictionary with the number of shards and pairs computed, the wall time, the overall
+        throughput and the throughput of every worker in pairs per second.
+    """
+    if shard_pairs < 1:
+        raise ValueError("A shard must hold at least one pair.")
+    matrix = ReturnEngine(zip_file_path, cache_dir=returns_cache_dir).matrix()
+    n_pairs = len(matrix.tickers) * (len(matrix.tickers) - 1) // 2
+    store = CorrelationStore(store_path(cache_dir, window_size, CORRELATION_MIN_OBSERVATIONS, CORRELATION_ESTIMATOR),
+                             window_size)
+    manifest_path = store.store_dir / "precompute.json"
+    job = {"fingerprint": matrix.fingerprint, "tickers": len(matrix.tickers), "shard_pairs": shard_pairs,
+           "shards": math.ceil(n_pairs / shard_pairs)}
+    manifest = None if restart else _read_manifest(manifest_path)
+    done = set(manifest["done"]) if manifest is not None and manifest["job"] == job else set()
+    pending = [shard for shard in range(job["shards"]) if shard not in done]
+
+    worker_pairs = defaultdict(int)
+    worker_seconds = defaultdict(float)
+    computed_pairs = 0
+    start = time.perf_counter()
+    if pending:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_init_worker,
+                                 initargs=(returns_cache_dir, cache_dir, window_size)) as pool:
+            futures = [pool.submit(compute_shard, shard, shard_pairs) for shard in pending]
+            for future in as_completed(futures):
+                shard, pid, pairs, seconds = future.result()
+                done.add(shard)
+                _write_manifest(manifest_path, {"job": job, "done": sorted(done)})
+                worker_pairs[pid] += pairs
+                worker_seconds[pid] += seconds
+                computed_pairs += pairs
+                if progress is not None:
+                    progress(f"shard {shard} done ({len(done)}/{job['shards']}), worker {pid}: "
+                             f"{pairs / seconds if seconds else 0:.0f} pairs/s")
+
+    if store.segment_count() > CORRELATION_STORE_MAX_SEGMENTS:
+        store.compact()
+    elapsed = time.perf_counter() - start
+    return {
+        "shards": job["shards"],
+        "resumed_shards": job["shards"] - len(pending),
+        "pairs": computed_pairs,
+        "seconds": elapsed,
+        "pairs_per_second": computed_pairs / elapsed if elapsed else None,
+        "workers": {pid: worker_pairs[pid] / worker_seconds[pid] if worker_seconds[pid] else None
+                    for pid in worker_pairs},
+    }
+
+
+def compute_shard(shard: int, shard_pairs: int) -> tuple[int, int, int, float]:
+    """
+    Computes one shard of the pair space in a worker process and writes it to the correlation store.
+    Pairs the store already holds, e.g. from an interrupted run or from the app, are skipped.
+    :param shard: The shard number.
+    :param shard_pairs: The number of pairs per shard.
+    :return: The shard number, the worker pid, the number of pairs computed and the seconds it took.
+    """
+    start = time.perf_counter()
+    engine = _worker["engine"]
+    tickers = _worker["tickers"]
+    left, right = _worker["pairs"]
+    stored = engine.store.names()
+    pairs = [(tickers[i], tickers[j]) for i, j in zip(left[shard * shard_pairs:(shard + 1) * shard_pairs].tolist(),
+                                                     right[shard * shard_pairs:(shard + 1) * shard_pairs].tolist())
+             if f"{tickers[i]}-{tickers[j]}" not in stored]
+    if pairs:
+        engine.store.write(engine.calculate_correlations(pairs), engine.data_version)
+    return shard, os.getpid(), len(pairs), time.perf_counter() - start
+
+
+def _init_worker(returns_cache_dir: Path, cache_dir: Path, window_size: int):
+    """
+    Maps the returns matrix and builds the correlation engine of a worker process, once per process.
+    :param returns_cache_dir: The returns cache directory holding the returns matrix.
+    :param cache_dir: The correlation cache directory.
+    :param window_size: The rolling window size.
+    """
+    matrix = ReturnsMatrix(returns_cache_dir)
+    tickers = sorted(matrix.tickers)
+    _worker["engine"] = CorrelationEngine(returns=None, window_size=window_size, cache_dir=cache_dir, matrix=matrix,
+                                          data_version=matrix.fingerprint)
+    _worker["tickers"] = tickers
+    _worker["pairs"] = tuple(indices.astype(np.int32) for indices in pair_indices(len(tickers)))
+
+
+def _read_manifest(path: Path) -> Optional[dict]:
+    """
+    Reads the job manifest of a precompute run.
+    :param path: The manifest path.
+    :return: The manifest, or None if it is missing or unreadable.
+    """
+    try:
+        return json.loads(path.read_text())
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def _write_manifest(path: Path, manifest: dict):
+    """
+    Atomically replaces the job manifest of a precompute run.
+    :param path: The manifest path.
+    :param manifest: The job description and the finished shards.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_suffix(".json.tmp")
+    temp_path.write_text(json.dumps(manifest))
+    os.replace(temp_path, path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompute the correlations of every ticker pair.")
+    parser.add_argument("--window", type=int, default=ROLLING_WINDOW_SIZE,
+                        help="Rolling window size, or half-life of the exponentially weighted estimators.")
+    parser.add_argument("--workers", type=int, default=PRECOMPUTE_WORKERS, help="Number of worker processes.")
+    parser.add_argument("--shard-pairs", type=int, default=PRECOMPUTE_SHARD_PAIRS, help="Number of pairs per shard.")
+    parser.add_argument("--restart", action="store_true", help="Ignore the manifest of a previous run.")
+    args = parser.parse_args()
+    print(json.dumps(precompute(window_size=args.window, workers=args.workers, shard_pairs=args.shard_pairs,
+                                restart=args.restart), indent=2))
@@ -0,0 +1,29 @@
+from src.config.settings import ZIP_FILE_PATH, CORRELATION_STORE_MAX_SEGMENTS, CORRELATION_CACHE_PATH, \
+    CORRELATION_MIN_OBSERVATIONS, CORRELATION_ESTIMATOR
+from src.main.correlation_engine import CorrelationEngine
+from src.main.correlation_store import stored_windows
+from src.main.returns_engine import ReturnEngine
+
+
+def refresh(zip_file_path: str = ZIP_FILE_PATH) -> int:
+    """
+    Nightly refresh: appends the new trading days of the source zip to the returns store, then extends
+    every cached correlation pair of every window size with the new dates. A correlation store is
+    compacted once the appended segments exceed CORRELATION_STORE_MAX_SEGMENTS.
+    :param zip_file_path: The path to the source zip file.
+    :return: The number of cached correlation pairs that were extended.
+    """
+    returns_engine = ReturnEngine(zip_file_path)
+    matrix = returns_engine.matrix()
+    extended = 0
+    for window_size in stored_windows(CORRELATION_CACHE_PATH, CORRELATION_MIN_OBSERVATIONS, CORRELATION_ESTIMATOR):
+        correlation_engine = CorrelationEngine(returns=returns_engine.returns, window_size=window_size, matrix=matrix,
+                                               data_version=matrix.fingerprint)
+        extended += correlation_engine.update_cache()
+        if correlation_engine.store.segment_count() > CORRELATION_STORE_MAX_SEGMENTS:
+            correlation_engine.store.compact()
+    return extended
+
+
+if __name__ == "__main__":
+    print(f"Extended {refresh()} cached correlation pairs.")
@@ -0,0 +1,114 @@
+import threading
+from collections import OrderedDict
+from typing import Hashable, Iterable, Optional
+
+from polars import DataFrame
+
+from src.config.settings import CORRELATION_RESULT_CACHE_BYTES
+
+
+class CorrelationCache:
+    """
+    Thread-safe, in-memory LRU cache of correlation results, bounded by the estimated size of the cached
+    frames. One instance is meant to be shared by every session of the process, keyed by
+    (pair, window size, data version) so results of an older returns store are never served.
+    """
+
+    def __init__(self, max_bytes: int = CORRELATION_RESULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.flights = SingleFlight()
+
+    def get(self, key: Hashable) -> Optional[DataFrame]:
+        """
+        Returns the cached frame of a key and marks it as most recently used.
+        :param key: The cache key.
+        :return: The cached frame, or None on a miss.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, df: DataFrame):
+        """
+        Caches a frame, evicting the least recently used entries until the cache fits its byte budget.
+        Frames larger than the whole budget are not cached.
+        :param key: The cache key.
+        :param df: The frame to cache. It is shared with every reader and must not be modified.
+        """
+        size = df.estimated_size()
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[1]
+            self._entries[key] = (df, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        """
+        Returns the counters of the cache.
+        :return: A dictionary with the hits, misses, evictions, entries and bytes of the cache.
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+            }
+
+
+class SingleFlight:
+    """
+    Deduplicates concurrent computations of the same keys within a process: the first caller to claim a
+    key computes it, later callers wait for it to finish and then read the result the first one stored.
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def claim(self, keys: Iterable[Hashable]) -> tuple[set, list[threading.Event]]:
+        """
+        Claims the keys that no other caller is computing.
+        :param keys: The keys to compute.
+        :return: The claimed keys, which the caller must compute and release, and the events of the keys
+            that are being computed by other callers.
+        """
+        claimed = set()
+        pending = []
+        with self._lock:
+            for key in keys:
+                flight = self._flights.get(key)
+                if flight is None:
+                    self._flights[key] = threading.Event()
+                    claimed.add(key)
+                elif flight not in pending:
+                    pending.append(flight)
+        return claimed, pending
+
+    def release(self, keys: Iterable[Hashable]):
+        """
+        Releases claimed keys, whether their computation succeeded or not, waking up the waiting callers.
+        :param keys: The claimed keys.
+        """
+        with self._lock:
+            for key in keys:
+                self._flights.pop(key).set()
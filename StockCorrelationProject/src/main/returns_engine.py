@@ -1,46 +1,264 @@
+import datetime
+import fcntl
+import json
+import os
+import shutil
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, Optional
+from zipfile import BadZipFile
+
 import polars as pl
-from polars import LazyFrame
+from polars import DataFrame, LazyFrame
 from polars.io import parquet
 
-from src.config.settings import ZIP_FILE_PATH, RETURNS_CACHE_PATH, RETURNS_SCHEMA
-from src.main.data_loader import load_from_zip
+from src.config.settings import ZIP_FILE_PATH, RETURNS_CACHE_PATH, RETURNS_SCHEMA, RETURNS_STORE_VERSION, \
+    RETURNS_STORE_INDEX, RETURNS_STORE_DTYPE, RETURNS_STORE_MAX_PARTS, INGEST_MODE, INGEST_STAGING_PATH, \
+    RETURNS_STORE_ROW_GROUP_ROWS, STARTUP_MODE
+from src.main.data_loader import load_from_zip, ingest_zip, zip_members, members_fingerprint
+from src.main.instrumentation import span, instrumented_collect, file_bytes
+from src.main.returns_matrix import ReturnsMatrix, write_returns_matrix
 
 
 class ReturnEngine:
-    def __init__(self, zip_file_path: str = ZIP_FILE_PATH):
+    def __init__(self, zip_file_path: str = ZIP_FILE_PATH, cache_dir: Path = RETURNS_CACHE_PATH,
+                 startup_mode: str = STARTUP_MODE):
         self.zip_file_path = zip_file_path
-        self.cache_dir = RETURNS_CACHE_PATH
-        self.cache_dir.mkdir(parents=True, exist_ok=True)
-        self.ticker_list = None
-        self.returns = self.get_returns()
+        self.cache_dir = cache_dir
+        self._ticker_list = None
+        self._returns = None
+        if startup_mode == "eager":
+            self._returns = self.get_returns()
+
+    @property
+    def returns(self) -> LazyFrame:
+        """
+        The returns of the whole store, which is opened, and built or extended if needed, on first use.
+        """
+        if self._returns is None:
+            self._returns = self.get_returns()
+        return self._returns
 
+    @property
+    def ticker_list(self) -> list[str]:
+        """
+        The tickers of the store, in column order, read from the store index without opening the returns.
+        """
+        if self._ticker_list is None:
+            self._ticker_list = self.index()["tickers"]
+        return self._ticker_list
+
+    def index(self) -> dict:
+        """
+        Returns the index of the returns store: its tickers and its first and last dates, read from the
+        store metadata without scanning the returns. Only when the metadata is missing or does not match
+        the source zip is the store opened, and built or extended, first.
+        :return: A dictionary with the tickers, the start_date and the end_date of the store.
+        """
+        members = self._source_members()
+        metadata = self._current_metadata(members_fingerprint(members) if members is not None else None)
+        if metadata is None:
+            self._returns = self.get_returns()
+            metadata = self._read_metadata()
+        return {
+            "tickers": metadata["tickers"],
+            "start_date": datetime.date.fromisoformat(metadata["start_date"]) if metadata.get("start_date") else None,
+            "end_date": datetime.date.fromisoformat(metadata["end_date"]) if metadata.get("end_date") else None,
+        }
 
-    def get_returns(self) -> LazyFrame:
+    def get_returns(self, start_date: Optional[datetime.date] = None, end_date: Optional[datetime.date] = None,
+                    tickers: Optional[list[str]] = None) -> LazyFrame:
         """
-        Returns a Polars LazyFrame containing the calculated returns.
+        Returns a Polars LazyFrame containing the calculated returns in wide format (Date plus one column
+        per ticker). The returns store is reused as long as it was built from the same source zip.
+        The date range and the tickers are pushed down to the parquet scan of the store: row groups
+        outside the range are skipped by their Date statistics and only the selected columns are read.
+        :param start_date: The first date to return. Defaults to the first stored date.
+        :param end_date: The last date to return. Defaults to the last stored date.
+        :param tickers: The tickers to return. Defaults to all tickers.
         :return: A Polars LazyFrame with the calculated returns.
+        :raises ValueError: If a ticker is not present in the data.
         """
-        cache_path = self.cache_dir / "returns.parquet"
+        returns = self._open_store()
+        if tickers is not None:
+            unknown = [ticker for ticker in tickers if ticker not in self.ticker_list]
+            if unknown:
+                raise ValueError(f"Tickers not present in the data: {', '.join(unknown)}")
+            returns = returns.select("Date", *tickers)
+        return returns.filter(date_range_filter(start_date, end_date))
 
+    def _open_store(self) -> LazyFrame:
+        """
+        Opens the returns store, building or extending it first when it does not match the source zip.
+        :return: A Polars LazyFrame over the whole store.
+        """
         try:
-            # If cached returns exist, load them
-            if cache_path.exists():
-                cached_result = parquet.scan_parquet(cache_path)
-                if self._validate_schema(cached_result):
+            with span("returns.open_store") as record:
+                members = self._source_members()
+                fingerprint = members_fingerprint(members) if members is not None else None
+
+                # If cached returns exist for this source, load them
+                cached_result = self.get_returns_from_cache(fingerprint)
+                if cached_result is not None:
+                    record["outcome"] = "cache"
                     return cached_result
 
-            # If cache does not exist or contains invalid returns, calculate returns
-            result_lazy = load_from_zip(self.zip_file_path).pipe(self._calculate_returns)
-            self.ticker_list = result_lazy.select("Ticker").unique().collect().to_series().to_list()
-            result = result_lazy.collect().pivot(index="Date", on="Ticker", values="Return")
-            result.write_parquet(cache_path)
-            return result.lazy()
+                # Only one process updates the store; the others wait and find it up to date
+                with self._lock():
+                    cached_result = self.get_returns_from_cache(fingerprint)
+                    if cached_result is not None:
+                        record["outcome"] = "cache"
+                        return cached_result
+
+                    # If the source only gained new trading days, append them to the store
+                    appended_result = self.append_new_returns(members)
+                    if appended_result is not None:
+                        record["outcome"] = "append"
+                        return appended_result
+
+                    # If cache does not exist or contains invalid returns, calculate returns
+                    record["outcome"] = "rebuild"
+                    prices = self._load_prices()
+                    result = self._pivot_returns(
+                        instrumented_collect(prices.lazy().pipe(self._calculate_returns), "returns.calculate"))
+                    self._ticker_list = result.columns[1:]
+                    self._write_cache(result, members, self._last_prices(prices))
+                    return result.lazy()
 
         except FileNotFoundError:
             raise ValueError(f"File not found: {self.zip_file_path}")
         except Exception as e:
             raise RuntimeError(f"error occurred in ReturnEngine: {e}")
 
+    def get_returns_from_cache(self, fingerprint: Optional[str]) -> Optional[LazyFrame]:
+        """
+        Checks the returns store metadata against the store version and the source fingerprint, and
+        returns a scan of the stored returns if they are still valid. Otherwise, it returns None. Every
+        part must hold the number of rows recorded for it, which is read from the parquet footers only,
+        so a truncated or replaced part is detected without reading the returns.
+        :param fingerprint: The fingerprint of the source zip, or None if the source is unavailable.
+        :return: A Polars LazyFrame over the stored returns, or None if the store is missing or stale.
+        """
+        metadata = self._current_metadata(fingerprint)
+        if metadata is None:
+            return None
+
+        part_paths = [self.cache_dir / part for part in metadata["parts"]]
+        if all(path.exists() for path in part_paths) and self._validate_rows(metadata):
+            cached_result = parquet.scan_parquet(part_paths)
+            if self._validate_schema(cached_result):
+                self._ticker_list = metadata["tickers"]
+                return cached_result
+        return None
+
+    def append_new_returns(self, members: Optional[dict[str, list[int]]]) -> Optional[LazyFrame]:
+        """
+        Extends the returns store with the trading days that are newer than its last stored date. Only
+        the zip members whose size or CRC changed, or that are new, are parsed. Their returns are computed
+        only for the new rows, seeded with each ticker's last stored price, and written as a new part of
+        the store, so the cost is proportional to the changed data.
+        The source history must be append-only. The store is rebuilt instead when a member was removed, a
+        new ticker appears, or the rows a changed member holds up to the stored end date no longer match
+        the stored row count and last price of their ticker.
+        :param members: The [size, CRC] of every CSV member of the source zip, keyed by member name.
+        :return: A Polars LazyFrame with the extended returns, or None if the store cannot be extended.
+        """
+        metadata = self._read_metadata()
+        last_prices_path = self.cache_dir / "last_prices.parquet"
+        if (members is None or metadata is None or metadata.get("version") != RETURNS_STORE_VERSION
+                or metadata.get("end_date") is None or not last_prices_path.exists()):
+            return None
+        stored_members = metadata["members"]
+        if not stored_members.keys() <= members.keys():
+            return None
+        cached_result = self.get_returns_from_cache(None)
+        if cached_result is None:
+            return None
+
+        end_date = datetime.date.fromisoformat(metadata["end_date"])
+        last_prices = pl.read_parquet(last_prices_path)
+        changed = [name for name, member in members.items() if stored_members.get(name) != member]
+        prices = self._load_prices(members=changed)
+        if not set(prices["Ticker"].unique()) <= set(metadata["tickers"]):
+            return None
+        if not self._history_matches(prices.filter(pl.col("Date") <= end_date), last_prices):
+            return None
+        new_prices = prices.filter(pl.col("Date") > end_date)
+        if new_prices.is_empty():
+            return None
+        new_returns = instrumented_collect(
+            pl.concat([last_prices.drop("Rows"), new_prices]).lazy()
+            .pipe(self._calculate_returns)
+            .filter(pl.col("Date") > end_date),
+            "returns.calculate"
+        )
+
+        new_part = self._pivot_returns(new_returns, metadata["tickers"])
+        new_last_prices = self._last_prices(new_prices)
+        last_prices = pl.concat([
+            last_prices.filter(~pl.col("Ticker").is_in(new_last_prices["Ticker"].implode())),
+            new_last_prices.join(last_prices.select("Ticker", "Rows"), on="Ticker", suffix="Old")
+            .with_columns(Rows=pl.col("Rows") + pl.col("RowsOld")).drop("RowsOld"),
+        ]).sort("Ticker")
+        self._ticker_list = metadata["tickers"]
+        return self._append_cache(new_part, members, last_prices, metadata)
+
+    def matrix(self) -> ReturnsMatrix:
+        """
+        Returns the memory-mapped returns matrix of the store, writing it first if it is missing or was
+        built from an older version of the store.
+        :return: The returns matrix.
+        """
+        # The ticker index brings the store up to date with the source first
+        tickers = self.ticker_list
+        fingerprint = (self._read_metadata() or {}).get("fingerprint")
+        try:
+            matrix = ReturnsMatrix(self.cache_dir)
+            if matrix.fingerprint == fingerprint and matrix.tickers == tickers:
+                return matrix
+        except (OSError, ValueError, KeyError):
+            pass
+        with span("returns.write_matrix", tickers=len(tickers)) as record:
+            matrix = write_returns_matrix(instrumented_collect(self.returns, "returns.read_store"), self.cache_dir,
+                                          fingerprint)
+            record["bytes_written"] = matrix.values.nbytes + matrix.dates.nbytes
+            return matrix
+
+    def _history_matches(self, history: DataFrame, last_prices: DataFrame) -> bool:
+        """
+        Checks that the rows of changed members up to the stored end date agree with the store: every
+        ticker they hold has as many rows as were stored, ending on the stored last date and price.
+        :param history: The rows of the changed members up to the stored end date.
+        :param last_prices: The stored last price and row count of every ticker.
+        :return: True if the history is unchanged, False if it was rewritten or backfilled.
+        """
+        if history.is_empty():
+            return True
+        observed = self._last_prices(history)
+        stored = last_prices.join(observed.select("Ticker"), on="Ticker", how="semi")
+        return observed.height == stored.height and observed.sort("Ticker").equals(stored.sort("Ticker"))
+
+    def _load_prices(self, members: Optional[list[str]] = None) -> DataFrame:
+        """
+        Loads the prices from the source zip, serially or with the parallel ingestion depending on INGEST_MODE.
+        The staged parts of a parallel ingestion are removed as soon as the prices are collected.
+        :param members: The names of the CSV members to load. Defaults to every CSV member.
+        :return: A Polars DataFrame with the Ticker, Date and Price columns.
+        """
+        with span("returns.load_prices", mode=INGEST_MODE, members=None if members is None else len(members)) as record:
+            if INGEST_MODE == "parallel":
+                prices, stats = ingest_zip(self.zip_file_path, staging_dir=INGEST_STAGING_PATH, members=members)
+                record["bytes_read"] = stats.bytes_read
+                try:
+                    prices = prices.collect()
+                finally:
+                    shutil.rmtree(stats.run_dir, ignore_errors=True)
+            else:
+                prices = load_from_zip(self.zip_file_path, members=members).collect()
+            record["rows"] = prices.height
+            return prices
+
     def _calculate_returns(self, lf: LazyFrame) -> LazyFrame:
         """
         Calculates the percentage change in the 'Price' column for each ticker and returns a LazyFrame with the calculated returns.
@@ -51,16 +269,216 @@ class ReturnEngine:
                 Return = pl.col("Price").pct_change().over("Ticker")
             ).select(list(RETURNS_SCHEMA.keys()))
 
+    def _pivot_returns(self, df: DataFrame, tickers: Optional[list[str]] = None) -> DataFrame:
+        """
+        Pivots long returns (Date, Ticker, Return) into the wide store layout: Date plus one column per
+        ticker, with the tickers in sorted order and the rows sorted by date.
+        :param df: A DataFrame matching RETURNS_SCHEMA.
+        :param tickers: The ticker columns of the result, missing tickers being all null. Defaults to the
+            tickers of the returns.
+        :return: A DataFrame in the wide returns store layout.
+        """
+        with span("returns.pivot", rows=df.height) as record:
+            wide = df.pivot(index="Date", on="Ticker", values="Return").sort("Date")
+            tickers = sorted(wide.columns[1:]) if tickers is None else tickers
+            record["dates"], record["tickers"] = wide.height, len(tickers)
+            return wide.select(
+                *(pl.col(column).cast(dtype) for column, dtype in RETURNS_STORE_INDEX.items()),
+                *((pl.col(ticker) if ticker in wide.columns else pl.lit(None)).cast(RETURNS_STORE_DTYPE).alias(ticker)
+                  for ticker in tickers)
+            )
+
+    def _last_prices(self, prices: DataFrame) -> DataFrame:
+        """
+        Selects the last known price and the number of prices of every ticker, the state needed to compute
+        returns for new dates and to check that the history of the source was not rewritten.
+        :param prices: A DataFrame with the Ticker, Date and Price columns.
+        :return: A DataFrame with one (Ticker, Date, Price, Rows) row per ticker.
+        """
+        return (
+            prices.sort("Date").group_by("Ticker", maintain_order=True)
+            .agg(pl.col("Date").last(), pl.col("Price").last(), Rows=pl.len().cast(pl.UInt32))
+            .sort("Ticker")
+        )
+
+    def _write_cache(self, df: DataFrame, members: Optional[dict[str, list[int]]], last_prices: DataFrame):
+        """
+        Writes the wide returns as the single base part of the returns store, together with the last price
+        of every ticker and the metadata, and removes the parts of earlier appends.
+        :param df: The wide returns DataFrame to store.
+        :param members: The member listing of the source zip the returns were computed from.
+        :param last_prices: The last price of every ticker, used to append new dates later on.
+        """
+        metadata_path = self.cache_dir / "returns.json"
+        metadata_path.unlink(missing_ok=True)
+        for stale_part in self.cache_dir.glob("returns-*.parquet"):
+            stale_part.unlink()
+
+        self._write_parquet(df, self.cache_dir / "returns.parquet")
+        self._write_parquet(last_prices, self.cache_dir / "last_prices.parquet")
+        dates = df["Date"]
+        self._write_metadata({
+            "version": RETURNS_STORE_VERSION,
+            "fingerprint": members_fingerprint(members) if members is not None else None,
+            "members": members or {},
+            "parts": ["returns.parquet"],
+            "part_rows": [df.height],
+            "tickers": df.columns[1:],
+            "rows": df.height,
+            "start_date": str(dates.min()) if df.height else None,
+            "end_date": str(dates.max()) if df.height else None,
+        })
+
+    def _append_cache(self, df: DataFrame, members: dict[str, list[int]], last_prices: DataFrame,
+                      metadata: dict) -> LazyFrame:
+        """
+        Writes the returns of new dates as an extra part of the returns store, leaving the existing parts
+        untouched. Once the store holds more than RETURNS_STORE_MAX_PARTS parts, they are merged back
+        into a single base part.
+        :param df: The wide returns of the new dates, with the same columns as the stored parts.
+        :param members: The member listing of the source zip.
+        :param last_prices: The updated last price of every ticker.
+        :param metadata: The current metadata of the store.
+        :return: A Polars LazyFrame over all parts of the store.
+        """
+        parts = metadata["parts"] + [f"returns-{len(metadata['parts']):06d}.parquet"]
+        if len(parts) > RETURNS_STORE_MAX_PARTS:
+            with span("returns.merge_parts", parts=len(parts)) as record:
+                part_paths = [self.cache_dir / part for part in metadata["parts"]]
+                record["bytes_read"] = file_bytes(*part_paths)
+                result = pl.concat([parquet.read_parquet(path) for path in part_paths] + [df])
+            self._write_cache(result, members, last_prices)
+            return parquet.scan_parquet(self.cache_dir / "returns.parquet")
+
+        (self.cache_dir / "returns.json").unlink(missing_ok=True)
+        self._write_parquet(df, self.cache_dir / parts[-1])
+        self._write_parquet(last_prices, self.cache_dir / "last_prices.parquet")
+        self._write_metadata({
+            **metadata,
+            "fingerprint": members_fingerprint(members),
+            "members": members,
+            "parts": parts,
+            "part_rows": metadata["part_rows"] + [df.height],
+            "rows": metadata["rows"] + df.height,
+            "end_date": str(df["Date"].max()),
+        })
+        return parquet.scan_parquet([self.cache_dir / part for part in parts])
+
+    def _write_parquet(self, df: DataFrame, path: Path):
+        """
+        Writes a parquet file of the store through a temporary file, so a reader never sees it half written.
+        Row groups of RETURNS_STORE_ROW_GROUP_ROWS dates let date-range scans skip the rest of the history.
+        :param df: The DataFrame to write.
+        :param path: The path of the parquet file.
+        """
+        with span("returns.write", file=path.name, rows=df.height) as record:
+            temp_path = path.with_suffix(f".parquet.{uuid.uuid4().hex}.tmp")
+            df.write_parquet(temp_path, row_group_size=RETURNS_STORE_ROW_GROUP_ROWS, statistics=True)
+            os.replace(temp_path, path)
+            record["bytes_written"] = file_bytes(path)
+
+    def _write_metadata(self, metadata: dict):
+        """
+        Writes the metadata of the returns store. It is written last, so a partially written store is never
+        considered valid.
+        :param metadata: The metadata dictionary.
+        """
+        metadata_path = self.cache_dir / "returns.json"
+        temp_path = metadata_path.with_suffix(f".json.{uuid.uuid4().hex}.tmp")
+        temp_path.write_text(json.dumps(metadata, indent=2))
+        os.replace(temp_path, metadata_path)
+
+    def _read_metadata(self) -> Optional[dict]:
+        """
+        Reads the metadata of the returns store.
+        :return: The metadata dictionary, or None if it does not exist or cannot be read.
+        """
+        try:
+            return json.loads((self.cache_dir / "returns.json").read_text())
+        except (OSError, ValueError):
+            return None
+
+    def _current_metadata(self, fingerprint: Optional[str]) -> Optional[dict]:
+        """
+        Reads the metadata of the returns store if it matches the store version and the source fingerprint.
+        :param fingerprint: The fingerprint of the source zip, or None if the source is unavailable.
+        :return: The metadata dictionary, or None if it is missing or stale.
+        """
+        metadata = self._read_metadata()
+        if metadata is None or metadata.get("version") != RETURNS_STORE_VERSION:
+            return None
+        if fingerprint is not None and metadata.get("fingerprint") != fingerprint:
+            return None
+        return metadata
+
+    def _validate_rows(self, metadata: dict) -> bool:
+        """
+        Checks that every part of the store holds the number of rows its metadata recorded, reading only
+        the parquet footers.
+        :param metadata: The metadata of the store.
+        :return: True if every part is complete, False if one is truncated, replaced or unreadable.
+        """
+        part_rows = metadata.get("part_rows")
+        if part_rows is None or len(part_rows) != len(metadata["parts"]):
+            return False
+        try:
+            return all(
+                parquet.scan_parquet(self.cache_dir / part).select(pl.len()).collect().item() == rows
+                for part, rows in zip(metadata["parts"], part_rows)
+            )
+        except (OSError, pl.exceptions.PolarsError):
+            return False
+
+    @contextmanager
+    def _lock(self) -> Iterator[None]:
+        """
+        Holds the exclusive lock of the returns store, so concurrent processes never build or extend it twice.
+        """
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        with open(self.cache_dir / ".lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _source_members(self) -> Optional[dict[str, list[int]]]:
+        """
+        Lists the CSV members of the source zip file.
+        :return: The [size, CRC] of every member keyed by name, or None if the source cannot be read.
+        """
+        try:
+            return zip_members(self.zip_file_path)
+        except (OSError, BadZipFile):
+            return None
+
     def _validate_schema(self, lf: LazyFrame) -> bool:
         """
-        Validates the schema of the LazyFrame to ensure it contains the required columns.
+        Validates the schema of the LazyFrame against the wide returns store layout: the index columns
+        first, followed by one RETURNS_STORE_DTYPE column per ticker.
         :param lf: The LazyFrame to validate.
         :return: True if the schema is valid, False otherwise.
         """
-        expected_schema = RETURNS_SCHEMA
         actual_schema = lf.collect_schema()
+        index_columns = list(actual_schema.items())[:len(RETURNS_STORE_INDEX)]
+
+        return index_columns == list(RETURNS_STORE_INDEX.items()) and all(
+            dtype == RETURNS_STORE_DTYPE
+            for column, dtype in actual_schema.items()
+            if column not in RETURNS_STORE_INDEX
+        )
+
 
-        return all(
-            column in actual_schema and actual_schema[column] == dtype
-            for column, dtype in expected_schema.items()
-        )
\ No newline at end of file
+def date_range_filter(start_date: Optional[datetime.date], end_date: Optional[datetime.date]) -> pl.Expr:
+    """
+    Builds the predicate of a date range on the Date column, which Polars pushes down to parquet scans.
+    :param start_date: The first date of the range, or None for no lower bound.
+    :param end_date: The last date of the range, or None for no upper bound.
+    :return: A boolean Polars expression.
+    """
+    predicate = pl.lit(True)
+    if start_date is not None:
+        predicate &= pl.col("Date") >= start_date
+    if end_date is not None:
+        predicate &= pl.col("Date") <= end_date
+    return predicate
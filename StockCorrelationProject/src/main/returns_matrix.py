@@ -0,0 +1,91 @@
+import json
+import os
+import shutil
+import uuid
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import polars as pl
+from polars import DataFrame
+
+from src.config.settings import RETURNS_MATRIX_DTYPE
+
+
+class ReturnsMatrix:
+    """
+    Read-only view of the wide returns as a memory-mapped (dates x tickers) NumPy matrix. The matrix is
+    stored column-major, so the returns of one ticker are a contiguous zero-copy view, and the pages are
+    shared through the OS page cache by every session and worker process that maps the same file.
+    """
+
+    def __init__(self, cache_dir: Path):
+        metadata = json.loads((cache_dir / "matrix.json").read_text())
+        matrix_dir = cache_dir / metadata["directory"]
+        self.fingerprint = metadata["fingerprint"]
+        self.tickers = metadata["tickers"]
+        self.columns = {ticker: i for i, ticker in enumerate(self.tickers)}
+        self.values = np.load(matrix_dir / "values.npy", mmap_mode="r")
+        self.dates = np.load(matrix_dir / "dates.npy", mmap_mode="r")
+
+    def column(self, ticker: str) -> np.ndarray:
+        """
+        Returns the returns of one ticker as a zero-copy view of the mapped matrix.
+        :param ticker: The ticker symbol.
+        :return: A read-only (T,) array.
+        :raises KeyError: If the ticker is not in the matrix.
+        """
+        return self.values[:, self.columns[ticker]]
+
+    def select(self, tickers: list[str], offset: int = 0, stop: Optional[int] = None) -> np.ndarray:
+        """
+        Returns the returns of a subset of tickers from row offset up to row stop. A run of adjacent
+        tickers is a zero-copy view of the mapped matrix, any other subset is gathered into a new array.
+        :param tickers: The ticker symbols, in the column order of the result.
+        :param offset: The first row to return.
+        :param stop: The row to stop before, or None to return up to the last row.
+        :return: A (stop - offset, len(tickers)) array.
+        :raises KeyError: If a ticker is not in the matrix.
+        """
+        columns = [self.columns[ticker] for ticker in tickers]
+        if columns and columns == list(range(columns[0], columns[0] + len(columns))):
+            return self.values[offset:stop, columns[0]:columns[0] + len(columns)]
+        return self.values[offset:stop, columns]
+
+    def date_series(self, offset: int = 0) -> pl.Series:
+        """
+        Returns the dates of the matrix rows from row offset on.
+        :param offset: The first row to return.
+        :return: A Polars Series of dates.
+        """
+        return pl.Series("Date", self.dates[offset:], dtype=pl.Date)
+
+
+def write_returns_matrix(df: DataFrame, cache_dir: Path, fingerprint: Optional[str]) -> ReturnsMatrix:
+    """
+    Writes the wide returns as a memory-mapped returns matrix. Every version is written to a directory of
+    its own and published by atomically replacing matrix.json, so processes that still map an older
+    version keep reading consistent files.
+    :param df: The wide returns, Date followed by one column per ticker.
+    :param cache_dir: The returns cache directory.
+    :param fingerprint: The fingerprint of the returns store the matrix was built from.
+    :return: The written returns matrix.
+    """
+    directory = f"matrix-{uuid.uuid4().hex}"
+    matrix_dir = cache_dir / directory
+    matrix_dir.mkdir(parents=True)
+    tickers = df.columns[1:]
+    values = df.select(tickers).to_numpy(order="fortran").astype(RETURNS_MATRIX_DTYPE, order="F", copy=False)
+    np.save(matrix_dir / "values.npy", values)
+    np.save(matrix_dir / "dates.npy", df["Date"].to_numpy().astype("datetime64[D]"))
+
+    metadata_path = cache_dir / "matrix.json"
+    temp_path = cache_dir / f"matrix.json.{directory}.tmp"
+    temp_path.write_text(json.dumps({"fingerprint": fingerprint, "directory": directory, "tickers": tickers}))
+    os.replace(temp_path, metadata_path)
+
+    # Unlinking older versions is safe for processes that still map them
+    for stale_dir in cache_dir.glob("matrix-*"):
+        if stale_dir.name != directory:
+            shutil.rmtree(stale_dir, ignore_errors=True)
+    return ReturnsMatrix(cache_dir)
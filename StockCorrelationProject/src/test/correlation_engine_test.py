@@ -1,15 +1,18 @@
 import datetime
+import threading
 
+import numpy as np
 import pytest
 import polars as pl
 from polars import LazyFrame
 from src.main.correlation_engine import CorrelationEngine
+from src.main.result_cache import CorrelationCache
 from src.config.settings import CORRELATION_SCHEMA
 
 @pytest.fixture
 def sample_returns():
     data = {
-        "Date": ["2023-01-01", "2023-01-02", "2023-01-03"],
+        "Date": [datetime.date(2023, 1, 1), datetime.date(2023, 1, 2), datetime.date(2023, 1, 3)],
         "AAPL": [100, 101, 102],
         "MSFT": [200, 202, 204],
         "GOOG": [300, 303, 306],
@@ -17,8 +20,8 @@ def sample_returns():
     return pl.DataFrame(data).lazy()
 
 @pytest.fixture
-def correlation_engine(sample_returns):
-    return CorrelationEngine(returns=sample_returns)
+def correlation_engine(sample_returns, tmp_path):
+    return CorrelationEngine(returns=sample_returns, cache_dir=tmp_path)
 
 def test_get_correlations_invalid_tickers(correlation_engine):
     with pytest.raises(ValueError, match="At least two tickers are required to compute correlations."):
@@ -28,36 +31,16 @@ def test_get_correlations_valid_tickers(correlation_engine):
     result = correlation_engine.get_correlations({"AAPL", "MSFT"})
     assert isinstance(result, LazyFrame)
 
-def test_get_lazy_correlations_empty_tickers(correlation_engine):
-    result = correlation_engine.get_lazy_correlations(set())
-    assert result == []
-
-def test_get_lazy_correlations_valid_tickers(correlation_engine):
-    result = correlation_engine.get_lazy_correlations({"AAPL", "MSFT"})
-    assert len(result) == 1
-    assert isinstance(result[0], LazyFrame)
-
-def test_get_correlation_for_pair_cache_hit(mocker, correlation_engine):
-    mocker.patch(
-        "src.main.correlation_engine.CorrelationEngine.get_correlation_from_cache",
-        return_value = pl.DataFrame({"Date": [], "Correlation": []}).lazy())
-    result = correlation_engine.get_correlation_for_pair("AAPL", "MSFT")
-    assert isinstance(result, LazyFrame)
-
-def test_get_correlation_for_pair_cache_miss(mocker, correlation_engine):
-    mocker.patch("src.main.correlation_engine.CorrelationEngine.get_correlation_from_cache", return_value=None)
-    mocker.patch("src.main.correlation_engine.CorrelationEngine.calculate_correlation", return_value=pl.DataFrame({"Date": [], "Correlation": []}).lazy())
-    result = correlation_engine.get_correlation_for_pair("AAPL", "MSFT")
-    assert isinstance(result, LazyFrame)
-
 def test_get_correlation_from_cache_valid_schema(mocker, correlation_engine):
-    mocker.patch("src.main.correlation_engine.parquet.scan_parquet", return_value=pl.DataFrame({"Date": [], "Correlation": []}).lazy())
+    mocker.patch.object(correlation_engine.store, "names", return_value={"AAPL-MSFT"})
+    mocker.patch.object(correlation_engine.store, "read", return_value=pl.DataFrame({"Date": [], "Correlation": []}).lazy())
     mocker.patch("src.main.correlation_engine.CorrelationEngine._validate_schema", return_value=True)
     result = correlation_engine.get_correlation_from_cache("AAPL-MSFT")
     assert isinstance(result, LazyFrame)
 
 def test_get_correlation_from_cache_invalid_schema(mocker, correlation_engine):
-    mocker.patch("src.main.correlation_engine.parquet.scan_parquet", return_value=pl.DataFrame({"Date": [], "Correlation": []}).lazy())
+    mocker.patch.object(correlation_engine.store, "names", return_value={"AAPL-MSFT"})
+    mocker.patch.object(correlation_engine.store, "read", return_value=pl.DataFrame({"Date": [], "Correlation": []}).lazy())
     mocker.patch("src.main.correlation_engine.CorrelationEngine._validate_schema", return_value=False)
     result = correlation_engine.get_correlation_from_cache("AAPL-MSFT")
     assert result is None
@@ -77,4 +60,228 @@ def test_validate_schema_invalid_column_type(correlation_engine, sample_returns)
 
 def test_validate_schema_invalid_column_name(correlation_engine, sample_returns):
     invalid_lf = pl.DataFrame({"Date": [datetime.date(2025, 2, 1)], "NotACollumn": [float(100.001)]}).lazy()
-    assert correlation_engine._validate_schema(invalid_lf) is False
\ No newline at end of file
+    assert correlation_engine._validate_schema(invalid_lf) is False
+
+def test_calculate_correlations_matches_calculate_correlation(correlation_engine):
+    correlation_engine.window_size = 2
+    result = correlation_engine.calculate_correlations([("MSFT", "AAPL"), ("AAPL", "GOOG")]).sort("Name", "Date")
+    expected = pl.concat([
+        correlation_engine.calculate_correlation("AAPL", "GOOG", "AAPL-GOOG").collect(),
+        correlation_engine.calculate_correlation("MSFT", "AAPL", "AAPL-MSFT").collect(),
+    ]).sort("Name", "Date")
+    assert result["Name"].to_list() == expected["Name"].to_list()
+    assert result["Correlation"].is_null().to_list() == expected["Correlation"].is_null().to_list()
+    assert result.drop_nulls()["Correlation"].to_list() == pytest.approx(expected.drop_nulls()["Correlation"].to_list())
+
+def test_calculate_correlations_in_pair_blocks(mocker, correlation_engine):
+    correlation_engine.window_size = 2
+    pairs = [("AAPL", "GOOG"), ("AAPL", "MSFT"), ("GOOG", "MSFT")]
+    expected = correlation_engine.calculate_correlations(pairs)
+    mocker.patch("src.main.correlation_engine.CORRELATION_PAIR_BLOCK_SIZE", 2)
+    assert correlation_engine.calculate_correlations(pairs).equals(expected)
+
+def test_calculate_correlations_unknown_ticker(correlation_engine):
+    with pytest.raises(ValueError, match="Tickers not present in the data: TSLA"):
+        correlation_engine.calculate_correlations([("AAPL", "TSLA")])
+
+def test_get_correlations_computes_missing_pairs_in_one_batch(mocker, correlation_engine):
+    spy = mocker.spy(correlation_engine, "calculate_correlations")
+    result = correlation_engine.get_correlations({"AAPL", "MSFT", "GOOG"}).collect()
+    assert spy.call_count == 1
+    assert set(result["Name"].unique()) == {"AAPL-GOOG", "AAPL-MSFT", "GOOG-MSFT"}
+    assert correlation_engine.store.names() == {"AAPL-GOOG", "AAPL-MSFT", "GOOG-MSFT"}
+
+def test_get_correlations_reads_cached_pairs_from_store(mocker, correlation_engine):
+    correlation_engine.get_correlations({"AAPL", "MSFT"}).collect()
+    spy = mocker.spy(correlation_engine, "calculate_correlations")
+    result = correlation_engine.get_correlations({"AAPL", "MSFT", "GOOG"}).collect()
+    assert spy.call_args.args[0] == [("AAPL", "GOOG"), ("GOOG", "MSFT")]
+    assert result.height == 9
+
+def test_update_cache_appends_new_dates(tmp_path):
+    returns = pl.DataFrame({
+        "Date": pl.date_range(datetime.date(2023, 1, 1), datetime.date(2023, 1, 30), eager=True),
+        "AAPL": [float((i * 7) % 11) for i in range(30)],
+        "MSFT": [float((i * 5) % 13) for i in range(30)],
+        "GOOG": [float((i * 3) % 7) for i in range(30)],
+    })
+    engine = CorrelationEngine(returns=returns.head(20).lazy(), window_size=5, cache_dir=tmp_path)
+    engine.get_correlations({"AAPL", "MSFT", "GOOG"}).collect()
+
+    updated_engine = CorrelationEngine(returns=returns.lazy(), window_size=5, cache_dir=tmp_path)
+    assert updated_engine.update_cache() == 3
+    assert updated_engine.update_cache() == 0
+
+    result = updated_engine.get_correlation_from_cache("AAPL-MSFT").collect().sort("Date")
+    expected = updated_engine.calculate_correlation("AAPL", "MSFT", "AAPL-MSFT").collect()
+    assert result["Date"].to_list() == expected["Date"].to_list()
+    assert result["Correlation"].to_list() == pytest.approx(expected["Correlation"].to_list(), nan_ok=True)
+
+def test_get_correlations_serves_pairs_from_result_cache(mocker, sample_returns, tmp_path):
+    result_cache = CorrelationCache()
+    engine = CorrelationEngine(returns=sample_returns, cache_dir=tmp_path, result_cache=result_cache, data_version="v1")
+    expected = engine.get_correlations({"AAPL", "MSFT", "GOOG"}).collect().sort("Name", "Date")
+    read = mocker.spy(engine.store, "read")
+    result = engine.get_correlations({"AAPL", "MSFT"}).collect()
+    assert read.call_count == 0
+    assert result.equals(expected.filter(pl.col("Name") == "AAPL-MSFT"))
+    assert result_cache.stats()["hits"] == 1
+
+    other_version = CorrelationEngine(returns=sample_returns, cache_dir=tmp_path, result_cache=result_cache,
+                                      data_version="v2")
+    other_version.get_correlations({"AAPL", "MSFT"}).collect()
+    assert result_cache.stats()["hits"] == 1
+
+def test_get_correlations_multiple_windows(mocker, tmp_path):
+    returns = pl.DataFrame({
+        "Date": pl.date_range(datetime.date(2023, 1, 1), datetime.date(2023, 1, 30), eager=True),
+        "AAPL": [float((i * 7) % 11) for i in range(30)],
+        "MSFT": [float((i * 5) % 13) for i in range(30)],
+        "GOOG": [float((i * 3) % 7) for i in range(30)],
+    }).lazy()
+    engine = CorrelationEngine(returns=returns, window_size=5, cache_dir=tmp_path)
+    engine.get_correlations({"AAPL", "MSFT"}).collect()
+    spy = mocker.spy(engine, "calculate_correlations")
+    result = engine.get_correlations({"AAPL", "MSFT", "GOOG"}, windows=[10, 5]).collect()
+    assert spy.call_count == 1
+    assert spy.call_args.kwargs["windows"] == [5, 10]
+    assert result.group_by("Window").len().sort("Window").rows() == [(5, 90), (10, 90)]
+    for window_size in (5, 10):
+        expected = CorrelationEngine(returns=returns, window_size=window_size, cache_dir=tmp_path / "expected") \
+            .calculate_correlation("AAPL", "GOOG", "AAPL-GOOG").collect()
+        actual = result.filter((pl.col("Window") == window_size) & (pl.col("Name") == "AAPL-GOOG")).sort("Date")
+        assert actual["Correlation"].to_list() == pytest.approx(expected["Correlation"].to_list(), nan_ok=True)
+        assert engine.store_for(window_size).names() == {"AAPL-GOOG", "AAPL-MSFT", "GOOG-MSFT"}
+def test_top_correlations(tmp_path):
+    returns = pl.DataFrame({
+        "Date": pl.date_range(datetime.date(2023, 1, 1), datetime.date(2023, 1, 30), eager=True),
+        "AAPL": [float((i * 7) % 11) for i in range(30)],
+        "MSFT": [float((i * 5) % 13) for i in range(30)],
+        "GOOG": [float((i * 3) % 7) for i in range(30)],
+    }).lazy()
+    engine = CorrelationEngine(returns=returns, window_size=5, cache_dir=tmp_path)
+    as_of = engine.top_correlations(k=1, end_date=datetime.date(2023, 1, 20))
+    expected = engine.get_correlations({"AAPL", "MSFT", "GOOG"}).filter(pl.col("Date") == datetime.date(2023, 1, 20)) \
+        .collect().sort("Correlation")
+    assert as_of.rows() == [("most", 1, expected["Name"][-1], pytest.approx(expected["Correlation"][-1])),
+                            ("least", 1, expected["Name"][0], pytest.approx(expected["Correlation"][0]))]
+
+    averaged = engine.top_correlations(k=3, start_date=datetime.date(2023, 1, 10), anchor="MSFT")
+    expected = engine.get_correlations({"AAPL", "MSFT", "GOOG"}).filter(pl.col("Date") >= datetime.date(2023, 1, 10)) \
+        .group_by("Name").agg(pl.col("Correlation").mean()).filter(pl.col("Name").str.contains("MSFT")).sort("Correlation") \
+        .collect()
+    assert averaged.filter(pl.col("Direction") == "least")["Name"].to_list() == expected["Name"].to_list()
+    assert averaged.filter(pl.col("Direction") == "least")["Correlation"].to_list() == \
+        pytest.approx(expected["Correlation"].to_list())
+@pytest.mark.timeout(30)
+def test_get_correlations_waits_for_concurrent_miss(mocker, sample_returns, tmp_path):
+    result_cache = CorrelationCache()
+    engine = CorrelationEngine(returns=sample_returns, cache_dir=tmp_path, result_cache=result_cache)
+    other = CorrelationEngine(returns=sample_returns, cache_dir=tmp_path, result_cache=result_cache)
+    # Another session is computing AAPL-MSFT: it is not computed twice, but read back once it was stored
+    claimed, _ = result_cache.flights.claim([other._result_key("AAPL-MSFT", other.window_size)])
+    threading.Timer(0.2, lambda: (other.store.write(other.calculate_correlations([("AAPL", "MSFT")])),
+                                  result_cache.flights.release(claimed))).start()
+    spy = mocker.spy(engine, "calculate_correlations")
+    result = engine.get_correlations({"AAPL", "MSFT", "GOOG"}).collect()
+    assert spy.call_args.args[0] == [("AAPL", "GOOG"), ("GOOG", "MSFT")]
+    assert result.height == 9
+def test_get_correlations_downsampled(tmp_path):
+    returns = pl.DataFrame({
+        "Date": pl.date_range(datetime.date(2023, 1, 1), datetime.date(2023, 4, 30), eager=True),
+        "AAPL": [float((i * 7) % 11) for i in range(120)],
+        "MSFT": [float((i * 5) % 13) for i in range(120)],
+    }).lazy()
+    engine = CorrelationEngine(returns=returns, window_size=5, cache_dir=tmp_path)
+    result = engine.get_correlations({"AAPL", "MSFT"}, max_points=20).collect()
+    assert 2 <= result.height <= 20
+    assert engine.store.read(["AAPL-MSFT"]).collect().height == 120
+def test_get_correlations_date_range(mocker, tmp_path):
+    returns = pl.DataFrame({
+        "Date": pl.date_range(datetime.date(2023, 1, 1), datetime.date(2023, 4, 30), eager=True),
+        "AAPL": [float((i * 7) % 11) for i in range(120)],
+        "MSFT": [float((i * 5) % 13) for i in range(120)],
+    }).lazy()
+    start_date, end_date = datetime.date(2023, 2, 1), datetime.date(2023, 2, 28)
+    full = CorrelationEngine(returns=returns, window_size=5, cache_dir=tmp_path / "full") \
+        .get_correlations({"AAPL", "MSFT"}).collect()
+    engine = CorrelationEngine(returns=returns, window_size=5, cache_dir=tmp_path / "range",
+                               result_cache=CorrelationCache())
+    select_returns = mocker.spy(engine, "_select_returns")
+    result = engine.get_correlations({"AAPL", "MSFT"}, start_date=start_date, end_date=end_date).collect()
+    expected = full.filter(pl.col("Date").is_between(start_date, end_date))
+    assert result["Date"].equals(expected["Date"])
+    assert result["Correlation"].to_list() == pytest.approx(expected["Correlation"].to_list(), nan_ok=True)
+    # Only the range and the warm-up rows before it were computed, and the partial series was not stored
+    assert select_returns.call_args.args[1:] == (27, 59)
+    assert engine.store.names() == set()
+    # The second query is served by the result cache
+    select_returns.reset_mock()
+    again = engine.get_correlations({"AAPL", "MSFT"}, start_date=start_date, end_date=end_date).collect()
+    assert again.equals(result)
+    select_returns.assert_not_called()
+def test_get_correlations_date_range_from_store(tmp_path):
+    returns = pl.DataFrame({
+        "Date": pl.date_range(datetime.date(2023, 1, 1), datetime.date(2023, 4, 30), eager=True),
+        "AAPL": [float((i * 7) % 11) for i in range(120)],
+        "MSFT": [float((i * 5) % 13) for i in range(120)],
+    }).lazy()
+    engine = CorrelationEngine(returns=returns, window_size=5, cache_dir=tmp_path)
+    full = engine.get_correlations({"AAPL", "MSFT"}).collect()
+    result = engine.get_correlations({"AAPL", "MSFT"}, start_date=datetime.date(2023, 4, 1)).collect()
+    expected = full.filter(pl.col("Date") >= datetime.date(2023, 4, 1))
+    assert result["Date"].equals(expected["Date"])
+    assert result["Correlation"].to_list() == pytest.approx(expected["Correlation"].to_list(), nan_ok=True)
+def test_get_correlations_min_observations(tmp_path):
+    returns = pl.DataFrame({
+        "Date": pl.date_range(datetime.date(2023, 1, 1), datetime.date(2023, 1, 30), eager=True),
+        "AAPL": [float((i * 7) % 11) for i in range(30)],
+        "MSFT": [None] * 12 + [float((i * 5) % 13) for i in range(12, 30)],
+    }).lazy()
+    dense = CorrelationEngine(returns=returns, window_size=10, cache_dir=tmp_path).get_correlations(
+        {"AAPL", "MSFT"}).drop_nulls().collect()
+    engine = CorrelationEngine(returns=returns, window_size=10, cache_dir=tmp_path, min_observations=5)
+    result = engine.get_correlations({"AAPL", "MSFT"}).drop_nulls().collect()
+    # The windows overlapping the listing of MSFT by at least 5 days are valid in the pairwise mode only
+    assert dense["Date"].min() == datetime.date(2023, 1, 22)
+    assert result["Date"].min() == datetime.date(2023, 1, 17)
+    expected = result.filter(pl.col("Date") >= datetime.date(2023, 1, 22))
+    assert expected["Correlation"].to_list() == pytest.approx(dense["Correlation"].to_list(), nan_ok=True)
+    # Each mode has its own store
+    assert engine.store.store_dir != CorrelationEngine(returns=returns, window_size=10, cache_dir=tmp_path).store.store_dir
+    assert engine.store.names() == {"AAPL-MSFT"}
+def test_get_correlations_ewma_and_shrinkage(tmp_path):
+    returns = pl.DataFrame({
+        "Date": pl.date_range(datetime.date(2023, 1, 1), datetime.date(2023, 4, 30), eager=True),
+        "AAPL": [float((i * 7) % 11) for i in range(120)],
+        "MSFT": [float((i * 5) % 13) for i in range(120)],
+        "GOOG": [float((i * 3) % 7) for i in range(120)],
+    }).lazy()
+    result_cache = CorrelationCache()
+    ewma = CorrelationEngine(returns=returns, window_size=10, cache_dir=tmp_path, result_cache=result_cache,
+                             estimator="ewma")
+    shrinkage = CorrelationEngine(returns=returns, window_size=10, cache_dir=tmp_path, result_cache=result_cache,
+                                  estimator="shrinkage")
+    rolling = CorrelationEngine(returns=returns, window_size=10, cache_dir=tmp_path, result_cache=result_cache)
+    tickers = {"AAPL", "MSFT", "GOOG"}
+    expected = ewma.get_correlations(tickers).collect().sort("Name", "Date")
+    shrunk = shrinkage.get_correlations(tickers).collect().sort("Name", "Date")
+    assert rolling.get_correlations(tickers).collect().height == expected.height == shrunk.height == 360
+    assert expected["Date"].min() == datetime.date(2023, 1, 1) and expected.drop_nulls()["Date"].min() == \
+        datetime.date(2023, 1, 10)
+    # Every estimator has its own store and result cache keys
+    assert len({engine.store.store_dir for engine in (ewma, shrinkage, rolling)}) == 3
+    assert result_cache.stats()["entries"] == 9
+    # The shrunk correlations are the exponentially weighted ones scaled down by one intensity per date
+    ratio = (shrunk["Correlation"] / expected["Correlation"]).to_numpy().reshape(3, 120)
+    assert np.allclose(ratio[:, 9:], ratio[0, 9:])
+    assert ((ratio[0, 9:] >= 0) & (ratio[0, 9:] < 1)).all() and (ratio[0, 9:] > 0).any()
+    # A date range is computed from the first row, so it matches the full series
+    start_date = datetime.date(2023, 3, 1)
+    ranged = CorrelationEngine(returns=returns, window_size=10, cache_dir=tmp_path / "range", estimator="ewma") \
+        .get_correlations(tickers, start_date=start_date).collect().sort("Name", "Date")
+    assert ranged["Correlation"].to_list() == \
+        pytest.approx(expected.filter(pl.col("Date") >= start_date)["Correlation"].to_list(), nan_ok=True)
+def test_unknown_estimator(sample_returns, tmp_path):
+    with pytest.raises(ValueError, match="Unknown estimator: garch"):
+        CorrelationEngine(returns=sample_returns, cache_dir=tmp_path, estimator="garch")
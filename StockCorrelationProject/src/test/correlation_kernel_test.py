@@ -0,0 +1,187 @@
+import numpy as np
+import polars as pl
+import pytest
+
+from src.main.correlation_kernel import pair_indices, rolling_correlations, rolling_correlations_multi, RESYNC_INTERVAL, \
+    rolling_correlations_pairwise, top_k_correlations, ewma_correlations, shrinkage_intensities
+
+
+@pytest.fixture
+def sample_values():
+    rng = np.random.default_rng(42)
+    values = rng.normal(size=(120, 4))
+    values[0] = np.nan
+    values[50, 1] = np.nan
+    return values
+
+
+def test_pair_indices():
+    left, right = pair_indices(3)
+    assert list(zip(left.tolist(), right.tolist())) == [(0, 1), (0, 2), (1, 2)]
+
+
+def test_rolling_correlations_matches_polars(sample_values):
+    left, right = pair_indices(4)
+    correlations, valid = rolling_correlations(sample_values, left, right, window_size=20)
+    frame = pl.DataFrame(sample_values, schema=["a", "b", "c", "d"]).fill_nan(None)
+    names = frame.columns
+    for pair, (i, j) in enumerate(zip(left, right)):
+        expected = frame.select(pl.rolling_corr(names[i], names[j], window_size=20)).to_series()
+        assert (expected.is_null().to_numpy() == ~valid[pair]).all()
+        np.testing.assert_allclose(correlations[pair, valid[pair]], expected.drop_nulls().to_numpy(), atol=1e-10)
+
+
+def test_rolling_correlations_resync_matches_polars():
+    rng = np.random.default_rng(7)
+    values = rng.normal(0.001, 0.02, size=(3 * RESYNC_INTERVAL, 3))
+    # Missing values right before, on and after the resync boundaries
+    values[RESYNC_INTERVAL - 3, 0] = np.nan
+    values[RESYNC_INTERVAL, 1] = np.nan
+    values[2 * RESYNC_INTERVAL + 2, 2] = np.nan
+    left, right = pair_indices(3)
+    correlations, valid = rolling_correlations(values, left, right, window_size=20)
+    frame = pl.DataFrame(values, schema=["a", "b", "c"]).fill_nan(None)
+    for pair, (i, j) in enumerate(zip(left, right)):
+        expected = frame.select(pl.rolling_corr(frame.columns[i], frame.columns[j], window_size=20)).to_series()
+        assert (expected.is_null().to_numpy() == ~valid[pair]).all()
+        np.testing.assert_allclose(correlations[pair, valid[pair]], expected.drop_nulls().to_numpy(), atol=1e-10)
+
+
+def test_rolling_correlations_constant_column_is_nan():
+    values = np.column_stack([np.arange(30, dtype=float), np.full(30, 2.5)])
+    correlations, valid = rolling_correlations(values, *pair_indices(2), window_size=5)
+    assert valid[0, 4:].all()
+    assert np.isnan(correlations[0, 4:]).all()
+
+
+def test_rolling_correlations_invalid_window(sample_values):
+    with pytest.raises(ValueError, match="The window size must be at least 1."):
+        rolling_correlations(sample_values, *pair_indices(4), window_size=0)
+
+
+def test_rolling_correlations_multi_matches_single_window(sample_values):
+    left, right = pair_indices(4)
+    sample_values[:, 3] = 1.5
+    correlations, valid = rolling_correlations_multi(sample_values, left, right, [5, 20, 200])
+    for k, window_size in enumerate([5, 20, 200]):
+        expected, expected_valid = rolling_correlations(sample_values, left, right, window_size)
+        assert (valid[k] == expected_valid).all()
+        np.testing.assert_allclose(correlations[k][valid[k]], expected[expected_valid], atol=1e-10)
+    assert not valid[2].any()
+
+
+def test_rolling_correlations_multi_invalid_window(sample_values):
+    with pytest.raises(ValueError, match="The window size must be at least 1."):
+        rolling_correlations_multi(sample_values, *pair_indices(4), windows=[20, 0])
+
+
+def test_rolling_correlations_pairwise_matches_brute_force():
+    rng = np.random.default_rng(3)
+    values = rng.normal(size=(150, 6))
+    values[rng.random(values.shape) < 0.05] = np.nan
+    # A late listing, a delisting, a constant stretch and a column without any value
+    values[:60, 1] = np.nan
+    values[110:, 2] = np.nan
+    values[30:50, 3] = 1.0
+    values[:, 5] = np.nan
+    left, right = pair_indices(6)
+    correlations, valid = rolling_correlations_pairwise(values, left, right, [10, 30], min_observations=8,
+                                                        chunk_size=4)
+    for k, window_size in enumerate([10, 30]):
+        for pair, (i, j) in enumerate(zip(left, right)):
+            for row in range(window_size - 1, 150):
+                x, y = values[row - window_size + 1:row + 1, i], values[row - window_size + 1:row + 1, j]
+                both = ~np.isnan(x) & ~np.isnan(y)
+                assert valid[k, pair, row] == (both.sum() >= 8)
+                if valid[k, pair, row] and x[both].std() > 0 and y[both].std() > 0:
+                    assert correlations[k, pair, row] == pytest.approx(np.corrcoef(x[both], y[both])[0, 1], abs=1e-10)
+                elif valid[k, pair, row]:
+                    assert np.isnan(correlations[k, pair, row])
+
+
+def test_rolling_correlations_pairwise_full_windows_match_multi(sample_values):
+    # Requiring every row of a window, the threshold being capped at the window size, is the dense mode
+    left, right = pair_indices(4)
+    correlations, valid = rolling_correlations_pairwise(sample_values, left, right, [5, 20], min_observations=200)
+    expected, expected_valid = rolling_correlations_multi(sample_values, left, right, [5, 20])
+    assert (valid == expected_valid).all()
+    np.testing.assert_allclose(correlations[valid], expected[expected_valid], atol=1e-10)
+
+
+def test_rolling_correlations_pairwise_invalid_min_observations(sample_values):
+    with pytest.raises(ValueError, match="A correlation needs at least two observations."):
+        rolling_correlations_pairwise(sample_values, *pair_indices(4), [20], min_observations=1)
+
+
+def test_ewma_correlations_matches_weighted_correlation(sample_values):
+    values = sample_values[1:].copy()
+    values[49, 1] = 0.0
+    left, right = pair_indices(4)
+    correlations, valid = ewma_correlations(values, left, right, [5, 30])
+    for k, half_life in enumerate([5, 30]):
+        decay = 0.5 ** (1 / half_life)
+        for row in (10, 60, 118):
+            # The first row weighs decay^row, row t > 0 weighs (1 - decay) * decay^(row - t), summing to 1
+            weights = (1 - decay) * decay ** np.arange(row, -1, -1)
+            weights[0] = decay ** row
+            covariance = np.cov(values[:row + 1].T, aweights=weights)
+            expected = (covariance / np.sqrt(np.outer(np.diag(covariance), np.diag(covariance))))[left, right]
+            np.testing.assert_allclose(correlations[k, :, row], expected, atol=1e-10)
+        assert (valid[k].argmax(axis=1) == half_life - 1).all()
+
+
+def test_ewma_correlations_skips_missing_rows(sample_values):
+    left, right = pair_indices(4)
+    values = sample_values[1:].copy()
+    values[20:40, 2] = np.nan
+    correlations, valid = ewma_correlations(values, left, right, [10])
+    pair = next(p for p, (i, j) in enumerate(zip(left, right)) if (i, j) == (0, 2))
+    # A pair keeps its correlation while one of its columns is missing
+    assert (correlations[0, pair, 20:40] == correlations[0, pair, 19]).all()
+    assert valid[0, pair, 19:].all()
+    assert not np.allclose(correlations[0, pair, 40:], correlations[0, pair, 19])
+
+
+def test_shrinkage_intensities():
+    rng = np.random.default_rng(5)
+    noise = rng.normal(size=(400, 10))
+    factor = noise + 3 * rng.normal(size=(400, 1))
+    intensities = shrinkage_intensities(np.column_stack([noise, factor]), [20, 100])
+    assert np.isnan(intensities[1, :99]).all() and not np.isnan(intensities[:, 99:]).any()
+    assert ((intensities[:, 99:] >= 0) & (intensities[:, 99:] <= 1)).all()
+    # Strongly correlated columns are shrunk less than noise, and more for a shorter half-life
+    assert (shrinkage_intensities(factor, [20])[0, -1] < shrinkage_intensities(noise, [20])[0, -1])
+    assert intensities[0, -1] > intensities[1, -1]
+
+
+def test_ewma_correlations_invalid_half_life(sample_values):
+    with pytest.raises(ValueError, match="The half-life must be at least 1."):
+        ewma_correlations(sample_values, *pair_indices(4), [0])
+
+
+@pytest.mark.parametrize("first_row, last_row", [(80, 80), (30, 110)])
+def test_top_k_correlations_matches_rolling_mean(sample_values, first_row, last_row):
+    values = sample_values.copy()
+    values[:, 3] = values[:, 0] * 0.8 + values[:, 3] * 0.2
+    left, right = pair_indices(4)
+    correlations, valid = rolling_correlations(values, left, right, window_size=20)
+    rows = slice(first_row, last_row + 1)
+    expected = np.array([correlations[p, rows][valid[p, rows]].mean() for p in range(len(left))])
+    most, least = top_k_correlations(values, 20, first_row, last_row, k=2, block_size=3, date_chunk_size=7)
+    order = np.argsort(-expected)
+    assert most[:, :2].tolist() == [[left[p], right[p]] for p in order[:2]]
+    assert least[:, :2].tolist() == [[left[p], right[p]] for p in order[::-1][:2]]
+    np.testing.assert_allclose(most[:, 2], expected[order[:2]], atol=1e-10)
+    np.testing.assert_allclose(least[:, 2], expected[order[::-1][:2]], atol=1e-10)
+
+
+def test_top_k_correlations_anchor(sample_values):
+    most, least = top_k_correlations(sample_values, 20, 119, 119, k=10, anchor=2)
+    assert len(most) == len(least) == 3
+    assert all(2 in (int(i), int(j)) and i < j for i, j, _ in most)
+
+
+def test_top_k_correlations_skips_constant_columns():
+    values = np.column_stack([np.arange(30, dtype=float), np.full(30, 0.1), np.arange(30, dtype=float) ** 2])
+    most, _ = top_k_correlations(values, 5, 29, 29, k=3)
+    assert most[:, :2].tolist() == [[0, 2]]
@@ -0,0 +1,153 @@
+import datetime
+
+import polars as pl
+import pytest
+
+from src.main.correlation_store import CorrelationStore, migrate_per_pair_cache
+
+
+def make_pair(name, n_rows, start=datetime.date(2023, 1, 1)):
+    return pl.DataFrame({
+        "Date": pl.date_range(start, start + datetime.timedelta(days=n_rows - 1), eager=True),
+        "Name": [name] * n_rows,
+        "Correlation": [i / n_rows for i in range(n_rows)],
+    })
+
+
+@pytest.fixture
+def store(tmp_path):
+    return CorrelationStore(tmp_path / "store")
+
+
+def test_write_and_read_subset(store):
+    store.write(pl.concat([make_pair("AAPL-MSFT", 5), make_pair("AAPL-GOOG", 5), make_pair("GOOG-MSFT", 3)]))
+    assert store.names() == {"AAPL-MSFT", "AAPL-GOOG", "GOOG-MSFT"}
+    result = store.read(["AAPL-MSFT", "GOOG-MSFT"]).collect()
+    assert result.sort("Name", "Date").equals(pl.concat([make_pair("AAPL-MSFT", 5), make_pair("GOOG-MSFT", 3)]))
+
+
+def test_write_packs_pairs_into_segments(store):
+    store.write(pl.concat([make_pair("AAPL-MSFT", 5), make_pair("AAPL-GOOG", 5), make_pair("GOOG-MSFT", 3)]))
+    index = store.index()
+    # One segment per series length
+    assert index["File"].n_unique() == 2
+    assert len(list(store.store_dir.glob("part-*.parquet"))) == 2
+
+
+def test_read_unknown_pairs_is_empty(store):
+    assert store.read(["AAPL-MSFT"]).collect().is_empty()
+
+
+def test_index_is_persisted(store):
+    store.write(make_pair("AAPL-MSFT", 5))
+    reopened = CorrelationStore(store.store_dir)
+    assert reopened.names() == {"AAPL-MSFT"}
+    assert reopened.end_dates().row(0) == ("AAPL-MSFT", datetime.date(2023, 1, 5))
+
+
+def test_compact_merges_appended_segments(store):
+    store.write(make_pair("AAPL-MSFT", 5))
+    store.write(make_pair("AAPL-MSFT", 2, start=datetime.date(2023, 1, 6)))
+    store.compact()
+    assert store.index()["File"].n_unique() == 1
+    assert len(list(store.store_dir.glob("part-*.parquet"))) == 1
+    assert store.read(["AAPL-MSFT"]).collect()["Date"].to_list() == make_pair("AAPL-MSFT", 7)["Date"].to_list()
+
+
+def test_migrate_per_pair_cache(store, tmp_path):
+    legacy_dir = tmp_path / "legacy"
+    legacy_dir.mkdir()
+    make_pair("AAPL-MSFT", 5).write_parquet(legacy_dir / "AAPL-MSFT.parquet")
+    make_pair("AAPL-GOOG", 4).write_parquet(legacy_dir / "AAPL-GOOG.parquet")
+    pl.DataFrame({"Date": ["2023-01-01"], "Correlation": ["bad"]}).write_parquet(legacy_dir / "BAD-PAIR.parquet")
+    assert migrate_per_pair_cache(legacy_dir, store, batch_size=1) == 2
+    assert store.names() == {"AAPL-MSFT", "AAPL-GOOG"}
+    assert store.read(["AAPL-GOOG"]).collect().equals(make_pair("AAPL-GOOG", 4))
+
+
+def test_migrate_per_pair_cache_twice_and_delete(store, tmp_path):
+    legacy_dir = tmp_path / "legacy"
+    legacy_dir.mkdir()
+    make_pair("AAPL-MSFT", 5).write_parquet(legacy_dir / "AAPL-MSFT.parquet")
+    pl.DataFrame({"Date": ["2023-01-01"], "Correlation": ["bad"]}).write_parquet(legacy_dir / "BAD-PAIR.parquet")
+    assert migrate_per_pair_cache(legacy_dir, store) == 1
+    assert migrate_per_pair_cache(legacy_dir, store, delete=True) == 0
+    assert store.read(["AAPL-MSFT"]).collect().height == 5
+    assert [path.name for path in legacy_dir.iterdir()] == ["BAD-PAIR.parquet"]
+
+
+def test_concurrent_stores_merge_their_writes(store):
+    other = CorrelationStore(store.store_dir)
+    store.names()
+    other.names()
+    store.write(make_pair("A-B", 5))
+    other.write(make_pair("C-D", 5))
+    # Both pairs computed again by a store that has not seen the other writes yet
+    other.write(pl.concat([make_pair("A-B", 5), make_pair("C-D", 5)]))
+    assert store.names() == {"A-B", "C-D"}
+    assert CorrelationStore(store.store_dir).names() == {"A-B", "C-D"}
+    assert store.read(["A-B", "C-D"]).collect().height == 10
+    assert len(list(store.store_dir.glob("part-*.parquet"))) == store.segment_count() == 2
+
+
+def test_compact_in_batches(store, monkeypatch):
+    monkeypatch.setattr("src.main.correlation_store.CORRELATION_STORE_PAIRS_PER_SEGMENT", 2)
+    for name in ["A-B", "A-C", "B-C"]:
+        store.write(make_pair(name, 3))
+    store.write(pl.concat([make_pair(name, 2, start=datetime.date(2023, 1, 4)) for name in ["A-B", "A-C", "B-C"]]))
+    assert store.segment_count() == 5
+    store.compact()
+    assert store.segment_count() == 2
+    assert store.read(["B-C"]).collect()["Date"].to_list() == make_pair("B-C", 5)["Date"].to_list()
+
+
+def test_index_records_entry_metadata(tmp_path):
+    store = CorrelationStore(tmp_path / "store", window_size=20)
+    store.write(make_pair("AAPL-MSFT", 5), fingerprint="v1")
+    assert store.index().select("Name", "Rows", "Window", "Fingerprint").rows() == [("AAPL-MSFT", 5, 20, "v1")]
+
+
+def test_truncated_segment_is_dropped(store):
+    store.write(make_pair("AAPL-MSFT", 5))
+    store.write(make_pair("AAPL-GOOG", 3))
+    file = store.index().filter(pl.col("Name") == "AAPL-MSFT")["File"].item()
+    path = store.store_dir / file
+    path.write_bytes(path.read_bytes()[:-20])
+    assert CorrelationStore(store.store_dir).names() == {"AAPL-GOOG"}
+
+    reopened = CorrelationStore(store.store_dir)
+    reopened.write(make_pair("AAPL-MSFT", 5))
+    assert reopened.read(["AAPL-MSFT"]).collect().height == 5
+
+
+def test_entries_of_another_window_are_dropped(tmp_path):
+    CorrelationStore(tmp_path / "store", window_size=20).write(make_pair("AAPL-MSFT", 5))
+    assert CorrelationStore(tmp_path / "store", window_size=60).names() == set()
+    assert CorrelationStore(tmp_path / "store").names() == {"AAPL-MSFT"}
+
+
+def test_compact_store_shares_the_date_axis(tmp_path):
+    store = CorrelationStore(tmp_path / "store", storage_mode="compact")
+    shifted = make_pair("GOOG-MSFT", 5, start=datetime.date(2023, 2, 1))
+    pairs = pl.concat([make_pair("AAPL-MSFT", 5), make_pair("AAPL-GOOG", 5), shifted])
+    store.write(pairs)
+    # Pairs with other dates go to a segment of their own
+    assert store.segment_count() == 2
+    segment = pl.read_parquet(store.store_dir / store.index().filter(pl.col("Name") == "AAPL-MSFT")["File"].item())
+    assert segment.schema == pl.Schema({"Name": pl.String, "Correlation": pl.Float32})
+
+    result = CorrelationStore(store.store_dir).read(["AAPL-GOOG", "GOOG-MSFT"]).collect().sort("Name", "Date")
+    expected = pl.concat([make_pair("AAPL-GOOG", 5), shifted])
+    assert result.schema == expected.schema
+    assert result.select("Date", "Name").equals(expected.select("Date", "Name"))
+    assert result["Correlation"].to_list() == pytest.approx(expected["Correlation"].to_list(), abs=1e-7)
+
+
+def test_store_mode_can_change(tmp_path):
+    CorrelationStore(tmp_path / "store").write(make_pair("AAPL-MSFT", 5))
+    store = CorrelationStore(tmp_path / "store", storage_mode="compact")
+    store.write(make_pair("AAPL-MSFT", 3, start=datetime.date(2023, 1, 6)))
+    store.compact()
+    result = store.read(["AAPL-MSFT"]).collect()
+    assert result["Date"].to_list() == pl.date_range(datetime.date(2023, 1, 1), datetime.date(2023, 1, 8), eager=True).to_list()
+    assert store.segment_count() == 1
@@ -5,7 +5,9 @@ import polars as pl
 import pytest
 
 from src.config.settings import ZIP_FILE_PATH
-from src.main.data_loader import load_from_zip, parse_date
+from src.benchmark.synthetic_data import write_synthetic_zip
+from src.main.data_loader import load_from_zip, parse_date, zip_fingerprint, ingest_zip, parse_file_dates, \
+    date_format_candidates, AmbiguousDateFormatWarning
 
 
 @pytest.fixture
@@ -64,3 +66,84 @@ def test_parse_date_invalid_format():
     lf = pl.LazyFrame(data)
     result = parse_date(lf).collect()
     assert result["Date"].to_list() == [None, None]
+
+
+def test_date_format_candidates():
+    dates = pl.Series(["01/02/2023", "01/31/2023"])
+    assert date_format_candidates(dates, sample_size=1) == ["%m/%d/%Y", "%d/%m/%Y"]
+    assert date_format_candidates(dates, sample_size=2) == ["%m/%d/%Y"]
+
+
+def test_parse_file_dates_validates_the_full_column():
+    # The sample only holds the first date, which parses as both %m/%d/%Y and %d/%m/%Y
+    df = pl.DataFrame({"Date": ["02/01/2023"] + ["31/01/2023"] * 200})
+    result, date_format = parse_file_dates(df, "sample.csv")
+    assert date_format.format == "%d/%m/%Y"
+    assert not date_format.ambiguous
+    assert result["Date"].to_list() == [datetime.date(2023, 1, 2)] + [datetime.date(2023, 1, 31)] * 200
+
+
+def test_parse_file_dates_flags_ambiguous_file():
+    df = pl.DataFrame({"Date": ["01/02/2023", "03/04/2023"]})
+    with pytest.warns(AmbiguousDateFormatWarning, match="'sample.csv'"):
+        result, date_format = parse_file_dates(df, "sample.csv")
+    assert date_format.format == "%m/%d/%Y"
+    assert date_format.ambiguous
+    assert result["Date"].to_list() == [datetime.date(2023, 1, 2), datetime.date(2023, 3, 4)]
+
+
+def test_parse_file_dates_mixed_formats_fall_back_to_parse_date():
+    df = pl.DataFrame({"Date": ["01/31/2023", "2023-01-31", None]})
+    result, date_format = parse_file_dates(df, "sample.csv")
+    assert date_format.format is None
+    assert result["Date"].to_list() == [datetime.date(2023, 1, 31), datetime.date(2023, 1, 31), None]
+
+
+def test_ingest_zip_reports_ambiguous_files(tmp_path):
+    zip_file_path = str(write_synthetic_zip(tmp_path / "stock_data.zip", n_tickers=2, n_days=5,
+                                            date_formats=["%Y-%m-%d", "%d/%m/%Y"]))
+    _, stats = ingest_zip(zip_file_path, staging_dir=tmp_path / "staging")
+    assert stats.ambiguous_files == ["T00001.csv"]
+    with pytest.warns(AmbiguousDateFormatWarning, match="T00001.csv"):
+        load_from_zip(zip_file_path)
+
+
+def test_zip_fingerprint_changes_with_contents(tmp_path):
+    zip_file_path = write_synthetic_zip(tmp_path / "stock_data.zip", n_tickers=2, n_days=5)
+    fingerprint = zip_fingerprint(str(zip_file_path))
+    assert fingerprint == zip_fingerprint(str(zip_file_path))
+    write_synthetic_zip(zip_file_path, n_tickers=2, n_days=6)
+    assert fingerprint != zip_fingerprint(str(zip_file_path))
+
+
+def test_zip_fingerprint_missing_file():
+    with pytest.raises(FileNotFoundError, match="Zip file not found:"):
+        zip_fingerprint("non_existent.zip")
+
+
+@pytest.mark.timeout(60)
+@pytest.mark.parametrize("executor", ["thread", "process"])
+def test_ingest_zip_matches_load_from_zip(tmp_path, executor):
+    zip_file_path = str(write_synthetic_zip(tmp_path / "stock_data.zip", n_tickers=5, n_days=30))
+    result, stats = ingest_zip(zip_file_path, staging_dir=tmp_path / "staging", workers=2, executor=executor)
+    expected = load_from_zip(zip_file_path).collect().sort("Ticker", "Date")
+    assert result.collect().sort("Ticker", "Date").equals(expected)
+    assert stats.files == 5
+    assert stats.rows == 150
+    assert stats.bytes_read > 0
+    assert stats.run_dir.parent == tmp_path / "staging"
+
+
+def test_ingest_zip_stages_each_run_separately(tmp_path):
+    staging_dir = tmp_path / "staging"
+    first, _ = ingest_zip(str(write_synthetic_zip(tmp_path / "large.zip", n_tickers=3, n_days=10)),
+                          staging_dir=staging_dir)
+    second, _ = ingest_zip(str(write_synthetic_zip(tmp_path / "small.zip", n_tickers=1, n_days=10)),
+                           staging_dir=staging_dir)
+    assert first.collect().height == 30
+    assert second.collect().height == 10
+
+
+def test_ingest_zip_missing_file(tmp_path):
+    with pytest.raises(FileNotFoundError, match="Zip file not found:"):
+        ingest_zip("non_existent.zip", staging_dir=tmp_path)
@@ -0,0 +1,45 @@
+import datetime
+
+import numpy as np
+import polars as pl
+import pytest
+
+from src.main.downsampling import min_max_downsample
+
+
+@pytest.fixture
+def long_series():
+    rng = np.random.default_rng(3)
+    dates = pl.date_range(datetime.date(2020, 1, 1), datetime.date(2022, 9, 26), eager=True)
+    correlations = rng.uniform(-1, 1, size=(2, len(dates)))
+    correlations[0, :30] = np.nan
+    return pl.DataFrame({
+        "Date": pl.concat([dates, dates]),
+        "Name": ["A-B"] * len(dates) + ["A-C"] * len(dates),
+        "Correlation": correlations.ravel(),
+    }).fill_nan(None)
+
+
+def test_min_max_downsample_bounds_points(long_series):
+    result = min_max_downsample(long_series.lazy(), max_points=100).collect()
+    assert result.group_by("Name").len()["len"].max() <= 100
+    assert result.schema == long_series.schema
+
+
+def test_min_max_downsample_keeps_extremes_and_gaps(long_series):
+    result = min_max_downsample(long_series.lazy(), max_points=100).collect()
+    for (name,), series in long_series.group_by("Name"):
+        sampled = result.filter(pl.col("Name") == name)
+        assert sampled["Correlation"].max() == series["Correlation"].max()
+        assert sampled["Correlation"].min() == series["Correlation"].min()
+    assert result.filter(pl.col("Name") == "A-B")["Correlation"][0] is None
+
+
+def test_min_max_downsample_keeps_short_series(long_series):
+    short = long_series.head(40)
+    assert min_max_downsample(short.lazy(), max_points=200).collect().equals(short)
+
+
+def test_min_max_downsample_invalid_points(long_series):
+    with pytest.raises(ValueError, match="At least two points per series are required."):
+        min_max_downsample(long_series.lazy(), max_points=1)
@@ -0,0 +1,79 @@
+import json
+from unittest.mock import patch
+
+import pytest
+import polars as pl
+
+from src.benchmark.synthetic_data import write_synthetic_zip
+from src.main.correlation_engine import CorrelationEngine
+from src.main.instrumentation import span, instrumented_collect
+from src.main.result_cache import CorrelationCache
+from src.main.returns_engine import ReturnEngine
+
+
+@pytest.fixture
+def log_path(tmp_path):
+    log_path = tmp_path / "logs" / "instrumentation.jsonl"
+    with patch("src.main.instrumentation.INSTRUMENTATION_ENABLED", True), \
+         patch("src.main.instrumentation.INSTRUMENTATION_LOG_PATH", log_path):
+        yield log_path
+
+
+def read_spans(log_path):
+    return [json.loads(line) for line in log_path.read_text().splitlines()]
+
+
+def test_span_disabled_writes_nothing(tmp_path):
+    log_path = tmp_path / "instrumentation.jsonl"
+    with patch("src.main.instrumentation.INSTRUMENTATION_LOG_PATH", log_path):
+        with span("stage") as record:
+            record["rows"] = 3
+    assert not log_path.exists()
+
+
+def test_span_records_nesting_counters_and_errors(log_path):
+    with span("outer", files=2) as outer:
+        with span("inner") as inner:
+            inner["rows"] = 10
+        outer["bytes_read"] = 100
+    with pytest.raises(ValueError):
+        with span("failing"):
+            raise ValueError("boom")
+
+    inner, outer, failing = read_spans(log_path)
+    assert (inner["span"], inner["rows"], inner["parent"]) == ("inner", 10, outer["id"])
+    assert (outer["span"], outer["files"], outer["bytes_read"], outer["parent"]) == ("outer", 2, 100, None)
+    assert outer["seconds"] >= inner["seconds"] >= 0
+    assert failing["error"] == "ValueError: boom"
+
+
+def test_instrumented_collect_records_plan(log_path):
+    lf = pl.LazyFrame({"a": [1, 2, 3]}).filter(pl.col("a") > 1)
+    with patch("src.main.instrumentation.INSTRUMENTATION_QUERY_PLANS", True):
+        df = instrumented_collect(lf, "query")
+    (record,) = read_spans(log_path)
+    assert df.height == record["rows"] == 2
+    assert "FILTER" in record["plan"]
+
+
+def test_pipeline_spans(log_path, tmp_path):
+    zip_file_path = write_synthetic_zip(tmp_path / "stock_data.zip", n_tickers=3, n_days=30, date_formats=["%Y-%m-%d"])
+    returns_engine = ReturnEngine(str(zip_file_path), cache_dir=tmp_path / "returns")
+    engine = CorrelationEngine(returns=returns_engine.returns, window_size=5, cache_dir=tmp_path / "correlation",
+                               result_cache=CorrelationCache())
+    engine.get_correlations(set(returns_engine.ticker_list)).collect()
+    engine.get_correlations(set(returns_engine.ticker_list)).collect()
+
+    spans = {}
+    for record in read_spans(log_path):
+        spans.setdefault(record["span"], []).append(record)
+    assert spans["returns.open_store"][0]["outcome"] == "rebuild"
+    assert spans["load_from_zip.decompress"][0]["bytes_decompressed"] > 0
+    assert spans["load_from_zip.parse_dates"][0]["coalesce_files"] == 0
+    assert spans["returns.pivot"][0]["tickers"] == 3
+    assert all(record["bytes_written"] > 0 for record in spans["returns.write"])
+    first_lookup, second_lookup = spans["correlations.lookup"]
+    assert (first_lookup["cache_misses"], first_lookup["store_misses"]) == (3, 3)
+    assert second_lookup["cache_hits"] == 3
+    assert spans["correlations.compute"][0]["pairs"] == 3
+    assert spans["correlation_store.write"][0]["bytes_written"] > 0
@@ -0,0 +1,52 @@
+import json
+
+import pytest
+
+from src.benchmark.synthetic_data import write_synthetic_zip
+from src.main.correlation_engine import CorrelationEngine
+from src.main.correlation_store import CorrelationStore, store_path
+from src.main.precompute import precompute
+from src.main.returns_engine import ReturnEngine
+
+
+@pytest.fixture
+def zip_file_path(tmp_path):
+    return str(write_synthetic_zip(tmp_path / "stock_data.zip", n_tickers=6, n_days=60))
+
+
+@pytest.mark.timeout(120)
+def test_precompute_stores_every_pair(tmp_path, zip_file_path):
+    result = precompute(zip_file_path, window_size=5, workers=2, shard_pairs=4, cache_dir=tmp_path / "correlation",
+                        returns_cache_dir=tmp_path / "returns", progress=None)
+    assert (result["shards"], result["resumed_shards"], result["pairs"]) == (4, 0, 15)
+    assert len(result["workers"]) >= 1
+
+    store = CorrelationStore(store_path(tmp_path / "correlation", 5))
+    assert len(store.names()) == 15
+    returns_engine = ReturnEngine(zip_file_path, cache_dir=tmp_path / "returns")
+    engine = CorrelationEngine(returns=returns_engine.returns, window_size=5, cache_dir=tmp_path / "expected")
+    ticker1, ticker2 = sorted(returns_engine.ticker_list)[:2]
+    expected = engine.calculate_correlation(ticker1, ticker2, f"{ticker1}-{ticker2}").collect()
+    actual = store.read([f"{ticker1}-{ticker2}"]).collect().sort("Date")
+    assert actual["Correlation"].to_list() == pytest.approx(expected["Correlation"].to_list(), nan_ok=True)
+
+
+@pytest.mark.timeout(120)
+def test_precompute_resumes_missing_shards(tmp_path, zip_file_path):
+    kwargs = dict(window_size=5, workers=1, shard_pairs=4, cache_dir=tmp_path / "correlation",
+                  returns_cache_dir=tmp_path / "returns", progress=None)
+    precompute(zip_file_path, **kwargs)
+    manifest_path = store_path(tmp_path / "correlation", 5) / "precompute.json"
+    manifest = json.loads(manifest_path.read_text())
+    assert manifest["done"] == [0, 1, 2, 3]
+
+    assert precompute(zip_file_path, **kwargs)["resumed_shards"] == 4
+
+    # A run killed after its first shard: the rest are resumed, their stored pairs are not recomputed
+    manifest_path.write_text(json.dumps({**manifest, "done": [0]}))
+    result = precompute(zip_file_path, **kwargs)
+    assert (result["resumed_shards"], result["pairs"]) == (1, 0)
+    assert json.loads(manifest_path.read_text())["done"] == [0, 1, 2, 3]
+    assert CorrelationStore(store_path(tmp_path / "correlation", 5)).index()["Name"].is_unique().all()
+
+    assert precompute(zip_file_path, restart=True, **kwargs)["resumed_shards"] == 0
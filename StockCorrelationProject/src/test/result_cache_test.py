@@ -0,0 +1,65 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import polars as pl
+
+from src.main.result_cache import CorrelationCache, SingleFlight
+
+
+def make_frame(n_rows):
+    return pl.DataFrame({"Correlation": [0.5] * n_rows})
+
+
+def test_get_and_put_count_hits_and_misses():
+    cache = CorrelationCache(max_bytes=1024)
+    assert cache.get("AAPL-MSFT") is None
+    cache.put("AAPL-MSFT", make_frame(10))
+    assert cache.get("AAPL-MSFT").equals(make_frame(10))
+    assert cache.stats() == {"hits": 1, "misses": 1, "evictions": 0, "entries": 1, "bytes": 80}
+
+
+def test_put_evicts_least_recently_used():
+    cache = CorrelationCache(max_bytes=200)
+    cache.put("a", make_frame(10))
+    cache.put("b", make_frame(10))
+    cache.get("a")
+    cache.put("c", make_frame(10))
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["bytes"] == 160
+
+
+def test_put_skips_frames_larger_than_the_budget():
+    cache = CorrelationCache(max_bytes=40)
+    cache.put("a", make_frame(10))
+    assert cache.stats()["entries"] == 0
+
+
+def test_concurrent_use_keeps_the_budget():
+    cache = CorrelationCache(max_bytes=800)
+
+    def use(i):
+        cache.put(i % 20, make_frame(10))
+        cache.get((i + 1) % 20)
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(use, range(2000)))
+    stats = cache.stats()
+    assert stats["bytes"] <= 800
+    assert stats["hits"] + stats["misses"] == 2000
+
+
+def test_single_flight_claims_each_key_once():
+    flights = SingleFlight()
+    claimed, pending = flights.claim(["a", "b"])
+    assert claimed == {"a", "b"} and pending == []
+    claimed_again, pending = flights.claim(["b", "c"])
+    assert claimed_again == {"c"} and len(pending) == 1
+
+    waiter = threading.Thread(target=pending[0].wait)
+    waiter.start()
+    flights.release(claimed)
+    waiter.join(timeout=5)
+    assert not waiter.is_alive()
+    assert flights.claim(["a"])[0] == {"a"}
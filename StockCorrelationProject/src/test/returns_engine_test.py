@@ -1,11 +1,14 @@
 import os
+from zipfile import ZipFile
 
 import pytest
 import polars as pl
 from polars import LazyFrame
 from unittest.mock import patch, MagicMock
 
-from src.config.settings import ZIP_FILE_PATH
+from src.benchmark.synthetic_data import write_synthetic_zip
+from src.config.settings import ZIP_FILE_PATH, RETURNS_STORE_VERSION
+from src.main.data_loader import load_from_zip
 from src.main.returns_engine import ReturnEngine
 
 
@@ -38,6 +41,9 @@ def mock_invalid_lazyframe():
 def test_get_returns_from_cache_valid_schema(mock_cache_path, mock_valid_lazyframe):
     with patch("src.main.returns_engine.parquet.scan_parquet", return_value=mock_valid_lazyframe), \
          patch("src.main.returns_engine.ReturnEngine._validate_schema", return_value=True), \
+         patch("src.main.returns_engine.ReturnEngine._read_metadata",
+               return_value={"version": RETURNS_STORE_VERSION, "fingerprint": None, "tickers": ["AAPL"],
+                             "parts": ["returns.parquet"], "part_rows": [3]}), \
          patch("pathlib.Path.exists", return_value=True):
         engine = ReturnEngine()
         engine.cache_dir = mock_cache_path.parent
@@ -60,4 +66,133 @@ def test_get_returns_runtime_error(mock_cache_path):
             engine.cache_dir = mock_cache_path.parent
             engine.zip_file_path = "/mock/path/to/zip_file.zip"  # Mock the zip file path
             with pytest.raises(RuntimeError, match="error occurred in ReturnEngine: Unexpected error"):
-                engine.get_returns()
\ No newline at end of file
+                engine.get_returns()
+
+
+@pytest.fixture
+def synthetic_zip_path(tmp_path):
+    return write_synthetic_zip(tmp_path / "stock_data.zip", n_tickers=3, n_days=10, date_formats=["%Y-%m-%d"])
+
+
+def test_get_returns_builds_wide_store(synthetic_zip_path, tmp_path):
+    engine = ReturnEngine(str(synthetic_zip_path), cache_dir=tmp_path / "returns")
+    schema = engine.returns.collect_schema()
+    assert schema.names() == ["Date", "T00000", "T00001", "T00002"]
+    assert engine._validate_schema(engine.returns)
+    assert engine.ticker_list == ["T00000", "T00001", "T00002"]
+    assert (tmp_path / "returns" / "returns.json").exists()
+
+def test_get_returns_warm_start_skips_zip(synthetic_zip_path, tmp_path):
+    ReturnEngine(str(synthetic_zip_path), cache_dir=tmp_path / "returns").returns
+    with patch("src.main.returns_engine.load_from_zip", side_effect=AssertionError("zip was re-read")):
+        engine = ReturnEngine(str(synthetic_zip_path), cache_dir=tmp_path / "returns", startup_mode="eager")
+    assert engine.ticker_list == ["T00000", "T00001", "T00002"]
+    assert engine.returns.collect().height == 10
+
+def test_get_returns_rebuilds_on_source_change(synthetic_zip_path, tmp_path):
+    ReturnEngine(str(synthetic_zip_path), cache_dir=tmp_path / "returns").returns
+    write_synthetic_zip(synthetic_zip_path, n_tickers=4, n_days=10, date_formats=["%Y-%m-%d"])
+    engine = ReturnEngine(str(synthetic_zip_path), cache_dir=tmp_path / "returns")
+    assert engine.ticker_list == ["T00000", "T00001", "T00002", "T00003"]
+
+def test_get_returns_rebuilds_truncated_part(synthetic_zip_path, tmp_path):
+    ReturnEngine(str(synthetic_zip_path), cache_dir=tmp_path / "returns").returns
+    part = tmp_path / "returns" / "returns.parquet"
+    part.write_bytes(part.read_bytes()[:-20])
+    engine = ReturnEngine(str(synthetic_zip_path), cache_dir=tmp_path / "returns")
+    assert engine.returns.collect().height == 10
+
+def test_validate_schema_rejects_long_format(mock_valid_lazyframe):
+    with patch("src.main.returns_engine.ReturnEngine.__init__", return_value=None):
+        engine = ReturnEngine()
+        assert engine._validate_schema(mock_valid_lazyframe) is False
+
+def test_get_returns_appends_new_dates(synthetic_zip_path, tmp_path):
+    ReturnEngine(str(synthetic_zip_path), cache_dir=tmp_path / "returns").returns
+    write_synthetic_zip(synthetic_zip_path, n_tickers=3, n_days=15, date_formats=["%Y-%m-%d"])
+    with patch("src.main.returns_engine.ReturnEngine._calculate_returns",
+               side_effect=ReturnEngine._calculate_returns, autospec=True) as calculate_returns:
+        engine = ReturnEngine(str(synthetic_zip_path), cache_dir=tmp_path / "returns", startup_mode="eager")
+        # Only the seed prices and the five new dates are passed through the returns calculation
+        assert calculate_returns.call_args.args[1].collect().height == 3 * 5 + 3
+    expected = ReturnEngine(str(synthetic_zip_path), cache_dir=tmp_path / "rebuilt").returns.collect()
+    assert engine.ticker_list == ["T00000", "T00001", "T00002"]
+    assert engine.returns.collect().equals(expected)
+    assert (tmp_path / "returns" / "returns-000001.parquet").exists()
+
+def test_get_returns_rebuilds_on_new_ticker_with_history(synthetic_zip_path, tmp_path):
+    ReturnEngine(str(synthetic_zip_path), cache_dir=tmp_path / "returns").returns
+    write_synthetic_zip(synthetic_zip_path, n_tickers=4, n_days=15, date_formats=["%Y-%m-%d"])
+    engine = ReturnEngine(str(synthetic_zip_path), cache_dir=tmp_path / "returns")
+    expected = ReturnEngine(str(synthetic_zip_path), cache_dir=tmp_path / "rebuilt").returns.collect()
+    assert engine.returns.collect().equals(expected)
+    assert not (tmp_path / "returns" / "returns-000001.parquet").exists()
+
+def test_get_returns_rebuilds_on_backfill(synthetic_zip_path, tmp_path):
+    ReturnEngine(str(synthetic_zip_path), cache_dir=tmp_path / "returns").returns
+    with ZipFile(synthetic_zip_path, "a") as zip_file:
+        zip_file.writestr("backfill.csv", "Ticker,Date,Price\nT00000,1999-12-31,50.0\n")
+    engine = ReturnEngine(str(synthetic_zip_path), cache_dir=tmp_path / "returns")
+    expected = ReturnEngine(str(synthetic_zip_path), cache_dir=tmp_path / "rebuilt").returns.collect()
+    assert engine.returns.collect().equals(expected)
+    assert engine.returns.collect().height == 11
+
+def test_get_returns_parses_only_changed_members(synthetic_zip_path, tmp_path):
+    ReturnEngine(str(synthetic_zip_path), cache_dir=tmp_path / "returns").returns
+    with ZipFile(synthetic_zip_path, "a") as zip_file:
+        zip_file.writestr("daily.csv", "Ticker,Date,Price\nT00000,2000-01-17,101.0\nT00002,2000-01-17,99.0\n")
+    with patch("src.main.returns_engine.load_from_zip", side_effect=load_from_zip) as loader:
+        engine = ReturnEngine(str(synthetic_zip_path), cache_dir=tmp_path / "returns", startup_mode="eager")
+        assert loader.call_args.kwargs["members"] == ["daily.csv"]
+    expected = ReturnEngine(str(synthetic_zip_path), cache_dir=tmp_path / "rebuilt").returns.collect()
+    assert engine.returns.collect().equals(expected)
+
+def test_get_returns_merges_appended_parts(synthetic_zip_path, tmp_path):
+    ReturnEngine(str(synthetic_zip_path), cache_dir=tmp_path / "returns").returns
+    with patch("src.main.returns_engine.RETURNS_STORE_MAX_PARTS", 2):
+        for n_days in (11, 12):
+            write_synthetic_zip(synthetic_zip_path, n_tickers=3, n_days=n_days, date_formats=["%Y-%m-%d"])
+            engine = ReturnEngine(str(synthetic_zip_path), cache_dir=tmp_path / "returns", startup_mode="eager")
+    expected = ReturnEngine(str(synthetic_zip_path), cache_dir=tmp_path / "rebuilt").returns.collect()
+    assert engine.returns.collect().equals(expected)
+    assert list((tmp_path / "returns").glob("returns-*.parquet")) == []
+
+def test_get_returns_parallel_ingest_removes_staged_parts(synthetic_zip_path, tmp_path):
+    with patch("src.main.returns_engine.INGEST_MODE", "parallel"), \
+         patch("src.main.returns_engine.INGEST_STAGING_PATH", tmp_path / "staging"):
+        engine = ReturnEngine(str(synthetic_zip_path), cache_dir=tmp_path / "returns", startup_mode="eager")
+    expected = ReturnEngine(str(synthetic_zip_path), cache_dir=tmp_path / "serial").returns.collect()
+    assert engine.returns.collect().equals(expected)
+    assert list((tmp_path / "staging").iterdir()) == []
+
+def test_lazy_startup_defers_the_store(synthetic_zip_path, tmp_path):
+    with patch("src.main.returns_engine.load_from_zip", side_effect=AssertionError("zip was read")):
+        engine = ReturnEngine(str(synthetic_zip_path), cache_dir=tmp_path / "returns", startup_mode="lazy")
+    assert not (tmp_path / "returns").exists()
+    assert engine.ticker_list == ["T00000", "T00001", "T00002"]
+    assert (tmp_path / "returns" / "returns.json").exists()
+
+def test_index_reads_metadata_only(synthetic_zip_path, tmp_path):
+    built = ReturnEngine(str(synthetic_zip_path), cache_dir=tmp_path / "returns").returns.collect()
+    with patch("src.main.returns_engine.parquet.scan_parquet", side_effect=AssertionError("store was scanned")):
+        index = ReturnEngine(str(synthetic_zip_path), cache_dir=tmp_path / "returns").index()
+    assert index == {"tickers": ["T00000", "T00001", "T00002"], "start_date": built["Date"].min(),
+                     "end_date": built["Date"].max()}
+
+def test_index_updates_stale_store(synthetic_zip_path, tmp_path):
+    ReturnEngine(str(synthetic_zip_path), cache_dir=tmp_path / "returns").returns
+    write_synthetic_zip(synthetic_zip_path, n_tickers=4, n_days=10, date_formats=["%Y-%m-%d"])
+    engine = ReturnEngine(str(synthetic_zip_path), cache_dir=tmp_path / "returns")
+    assert engine.index()["tickers"] == ["T00000", "T00001", "T00002", "T00003"]
+    assert engine.returns.collect_schema().names()[1:] == engine.ticker_list
+
+def test_get_returns_date_range_and_tickers(synthetic_zip_path, tmp_path):
+    engine = ReturnEngine(str(synthetic_zip_path), cache_dir=tmp_path / "returns")
+    full = engine.returns.collect()
+    start_date, end_date = full["Date"][3], full["Date"][6]
+    result = engine.get_returns(start_date, end_date, tickers=["T00002", "T00000"]).collect()
+    assert result.columns == ["Date", "T00002", "T00000"]
+    assert result.equals(full.slice(3, 4).select("Date", "T00002", "T00000"))
+    assert engine.get_returns(start_date=end_date).collect().height == 4
+    with pytest.raises(ValueError, match="T99999"):
+        engine.get_returns(tickers=["T99999"])
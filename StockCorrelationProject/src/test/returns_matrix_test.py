@@ -0,0 +1,67 @@
+import datetime
+
+import numpy as np
+import polars as pl
+import pytest
+
+from src.benchmark.synthetic_data import write_synthetic_zip
+from src.main.correlation_engine import CorrelationEngine
+from src.main.returns_engine import ReturnEngine
+from src.main.returns_matrix import ReturnsMatrix, write_returns_matrix
+
+
+@pytest.fixture
+def sample_returns():
+    return pl.DataFrame({
+        "Date": pl.date_range(datetime.date(2023, 1, 1), datetime.date(2023, 1, 30), eager=True),
+        "AAPL": [float((i * 7) % 11) for i in range(30)],
+        "GOOG": [float((i * 3) % 7) for i in range(30)],
+        "MSFT": [float((i * 5) % 13) if i != 12 else None for i in range(30)],
+    })
+
+
+def test_write_and_map_returns_matrix(sample_returns, tmp_path):
+    matrix = write_returns_matrix(sample_returns, tmp_path, "abc")
+    assert matrix.tickers == ["AAPL", "GOOG", "MSFT"]
+    assert isinstance(matrix.values, np.memmap)
+    np.testing.assert_array_equal(matrix.column("GOOG"), sample_returns["GOOG"].to_numpy())
+    assert matrix.date_series().equals(sample_returns["Date"])
+    reopened = ReturnsMatrix(tmp_path)
+    assert reopened.fingerprint == "abc"
+    assert np.isnan(reopened.column("MSFT")[12])
+
+
+def test_select_adjacent_tickers_is_a_view(sample_returns, tmp_path):
+    matrix = write_returns_matrix(sample_returns, tmp_path, None)
+    assert np.shares_memory(matrix.select(["GOOG", "MSFT"], offset=5), matrix.values)
+    assert not np.shares_memory(matrix.select(["AAPL", "MSFT"]), matrix.values)
+    np.testing.assert_array_equal(matrix.select(["MSFT", "AAPL"])[:, 1], sample_returns["AAPL"].to_numpy())
+
+
+def test_rewrite_replaces_older_versions(sample_returns, tmp_path):
+    write_returns_matrix(sample_returns, tmp_path, "old")
+    write_returns_matrix(sample_returns.head(10), tmp_path, "new")
+    assert len(list(tmp_path.glob("matrix-*"))) == 1
+    assert ReturnsMatrix(tmp_path).values.shape == (10, 3)
+
+
+def test_correlation_engine_with_matrix_matches_frame(sample_returns, tmp_path):
+    matrix = write_returns_matrix(sample_returns, tmp_path / "returns", None)
+    pairs = [("AAPL", "GOOG"), ("AAPL", "MSFT"), ("GOOG", "MSFT")]
+    expected = CorrelationEngine(sample_returns.lazy(), window_size=5, cache_dir=tmp_path).calculate_correlations(pairs, 3)
+    engine = CorrelationEngine(sample_returns.lazy(), window_size=5, cache_dir=tmp_path, matrix=matrix)
+    assert engine.calculate_correlations(pairs, 3).equals(expected)
+    frame_engine = CorrelationEngine(sample_returns.lazy(), window_size=5, cache_dir=tmp_path)
+    assert engine.calculate_correlation("AAPL", "GOOG", "AAPL-GOOG").collect().equals(
+        frame_engine.calculate_correlations([("AAPL", "GOOG")]))
+
+
+def test_return_engine_matrix_follows_the_store(tmp_path):
+    zip_file_path = write_synthetic_zip(tmp_path / "stock_data.zip", n_tickers=3, n_days=10, date_formats=["%Y-%m-%d"])
+    engine = ReturnEngine(str(zip_file_path), cache_dir=tmp_path / "returns")
+    matrix = engine.matrix()
+    assert matrix.values.shape == (10, 3)
+    assert engine.matrix().fingerprint == matrix.fingerprint
+    write_synthetic_zip(zip_file_path, n_tickers=3, n_days=12, date_formats=["%Y-%m-%d"])
+    engine = ReturnEngine(str(zip_file_path), cache_dir=tmp_path / "returns")
+    assert engine.matrix().values.shape == (12, 3)